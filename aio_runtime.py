@@ -0,0 +1,116 @@
+""" Optional asyncio runtime: the car, gpsd and MQTT share one event loop
+    instead of running a thread each. The car awaits the replies of the
+    dongle, so a sample is published as soon as it is decoded and the
+    process mostly sleeps in a single select(). Enabled with
+    "runtime": "asyncio" in config.json. """
+from threading import get_ident
+from time import monotonic
+import asyncio
+import paho.mqtt.client as mqtt
+
+
+class MqttLoop:
+    """ Runs a paho client on the event loop instead of its network
+        thread: the socket is watched with add_reader/add_writer and
+        loop_misc (keepalive and reconnect) runs once a second. Create it
+        on the thread that runs the loop, before connecting. """
+
+    def __init__(self, loop, client=None):
+        self.loop = loop
+        self.client = client if client is not None else mqtt.Client()
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+        self._thread = get_ident()
+
+    def _call(self, func, *args):
+        # The MQTT buffer publishes from its own thread
+        if get_ident() == self._thread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self._call(self.loop.add_reader, sock, client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        self._call(self.loop.remove_reader, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._call(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self.loop.remove_writer, sock)
+
+    async def run(self):
+        """ Keep the connection alive, reconnect when it was lost. The
+            reconnect resolves the broker name and blocks until connected,
+            so it runs in the default executor. """
+        while True:
+            if self.client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+                try:
+                    await self.loop.run_in_executor(None, self.client.reconnect)
+                except OSError as err:
+                    print(f"[WARNING] MQTT reconnect failed: {err}")
+            await asyncio.sleep(1)
+
+
+async def read_gpsd(gps):
+    """ Feed the reports of gpsd into "gps", a GpsPoller whose thread is
+        not started """
+    host, port = gps.gpsd
+    while True:
+        writer = None
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.write(b'?WATCH={"enable":true,"json":true};')
+            async for line in reader:
+                gps.update(line.rstrip(b'\r\n'))
+        except OSError:
+            pass
+        finally:
+            if writer is not None:
+                writer.close()
+        gps.reset()
+        await asyncio.sleep(1)
+
+
+async def poll_car(car):
+    """ The car polling loop: awaits the ECU replies, then sleeps until
+        the next command is due """
+    while True:
+        cycle_start = monotonic()
+        try:
+            await car.poll_once_async()
+        except Exception as err:
+            # The thread runtime restarts a failed car thread
+            print(f"[ERROR] Car polling failed: {err}. Restarting...")
+            await asyncio.sleep(1)
+            continue
+        await asyncio.sleep(car.next_delay(cycle_start))
+
+
+async def repeat(interval, func):
+    """ Call func() every "interval" seconds """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            func()
+        except Exception as err:
+            print(f"[ERROR] {func.__name__} failed: {err}")
+
+
+async def run(car, gps, mqtt_loop, metrics_interval=None, publish_metrics=None):
+    """ Run everything until cancelled """
+    tasks = [asyncio.ensure_future(poll_car(car)),
+             asyncio.ensure_future(read_gpsd(gps)),
+             asyncio.ensure_future(mqtt_loop.run())]
+    if metrics_interval and publish_metrics:
+        tasks.append(asyncio.ensure_future(repeat(metrics_interval, publish_metrics)))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
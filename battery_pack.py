@@ -0,0 +1,120 @@
+""" Compact model of the battery pack cell values """
+from array import array
+from operator import mul
+from math import sqrt
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Suffixes of the aggregated values, appended to the name of the cell values
+StatKeys = ('Min', 'Max', 'Mean', 'Spread', 'StdDev', 'MinCell', 'MaxCell')
+
+
+class CellValues:
+    """ One value per cell (or sensor), filled in blocks straight from the
+        decoded tuples. Uses NumPy if available, array('f') otherwise. """
+
+    def __init__(self, name, count, units=None):
+        self.name = name
+        self.units = units
+        self.count = count
+        if numpy is not None:
+            self._values = numpy.zeros(count, dtype=numpy.float32)
+        else:
+            self._values = array('f', bytes(4 * count))
+        self._seen = bytearray(count)
+        self._missing = count
+        self._stats = None
+
+    def update(self, start, values):
+        """ Store values for the cells numbered start, start + 1, ...
+            Cells are numbered from 1 like the field names. """
+        idx = start - 1
+        end = idx + len(values)
+        if numpy is not None:
+            self._values[idx:end] = values
+        else:
+            self._values[idx:end] = array('f', values)
+        if self._missing:
+            self._seen[idx:end] = b'\x01' * len(values)
+            self._missing = self.count - sum(self._seen)
+        self._stats = None
+
+    def values(self):
+        """ Return the stored values """
+        return self._values
+
+    def stats(self):
+        """ Return min, max, mean, spread, standard deviation and the numbers
+            of the lowest and highest cell. Values are None until every cell
+            has been read once. """
+        if self._stats is not None:
+            return self._stats
+        name = self.name
+        if self._missing:
+            return {name + key: None for key in StatKeys}
+
+        values = self._values
+        if numpy is not None:
+            min_idx = int(values.argmin())
+            max_idx = int(values.argmax())
+            low = float(values[min_idx])
+            high = float(values[max_idx])
+            mean = float(values.mean(dtype=numpy.float64))
+            std_dev = float(values.std(dtype=numpy.float64))
+        else:
+            low = min(values)
+            high = max(values)
+            min_idx = values.index(low)
+            max_idx = values.index(high)
+            mean = sum(values) / self.count
+            std_dev = sqrt(max(0.0, sum(map(mul, values, values)) / self.count - mean * mean))
+
+        self._stats = {
+            name + 'Min': round(low, 3),
+            name + 'Max': round(high, 3),
+            name + 'Mean': round(mean, 3),
+            name + 'Spread': round(high - low, 3),
+            name + 'StdDev': round(std_dev, 4),
+            name + 'MinCell': min_idx + 1,
+            name + 'MaxCell': max_idx + 1,
+        }
+        return self._stats
+
+    def fields(self):
+        """ Return field definitions for the aggregated values """
+        return tuple({'name': self.name + key, 'units': None if key.endswith('Cell') else self.units}
+                     for key in StatKeys)
+
+
+class BatteryPack:
+    """ All cell voltages and module temperatures of a pack """
+
+    def __init__(self, cells, temps):
+        self._values = {
+            'cellVoltage': CellValues('cellVoltage', cells, 'V'),
+            'cellTemp': CellValues('cellTemp', temps, '°C'),
+        }
+
+    def update(self, kind, start, values):
+        """ Sink for the decoder: store a block of values of "kind" """
+        self._values[kind].update(start, values)
+
+    def __getitem__(self, kind):
+        """ Return the CellValues of "kind" """
+        return self._values[kind]
+
+    def stats(self):
+        """ Return the aggregates of all cell values """
+        stats = {}
+        for values in self._values.values():
+            stats.update(values.stats())
+        return stats
+
+    def get_fields(self):
+        """ Return the aggregated values in the format of a field table """
+        return {'group': 'pack',
+                'fields': tuple(field for values in self._values.values()
+                                for field in values.fields())}
@@ -0,0 +1,430 @@
+""" Benchmarks for the hot paths of the polling loop. Runs on fake
+    transports without a car or dongle:
+
+        python3 benchmark.py [names...] [--json results.json]
+
+    The JSON output can be compared across releases. """
+from contextlib import redirect_stdout
+from time import perf_counter, time
+from timeit import repeat
+import argparse
+import json
+import os
+import platform
+import re
+import sys
+
+import ioniq_bev
+import ioniq_traces
+import isotp_decoder
+from elm327 import Elm327, reassemble
+from elm327_emulator import EmulatedSerial
+from gpspoller import empty_fix
+from isotp_decoder import IsoTpDecoder, compile_fields
+from mqtt_handler import MqttHandler
+from torque_formula import compile_formula
+
+
+class CannedDongle:
+    """ Dongle answering send_command_ex straight from the sample responses """
+
+    def __init__(self, responses=None):
+        self._responses = ioniq_traces.Responses if responses is None else responses
+
+    def set_protocol(self, prot):
+        """ Nothing to configure """
+
+    def send_command_ex(self, cmd, cantx, canrx, canmask=None, frames=None):
+        """ Return the sample payload of the command """
+        return self._responses[(cantx, cmd)]
+
+
+class CachedSerial(EmulatedSerial):
+    """ EmulatedSerial that formats each distinct command only once,
+        so the benchmark measures Elm327 and not the emulator. """
+
+    def __init__(self, emulator=None):
+        super().__init__(emulator)
+        self._cache = {}
+
+    def write(self, data):
+        """ Queue the cached reply of the command """
+        reply = self._cache.get(data)
+        if reply is None:
+            super().write(data)
+            reply = self._cache[data] = bytes(self._output)
+            self._output.clear()
+        self._output.extend(reply)
+        return len(data)
+
+
+class StubClient:
+    """ MQTT client that only counts the messages """
+
+    def __init__(self):
+        self.messages = 0
+        self.on_connect = None
+
+    def username_pw_set(self, username, password):
+        """ Not needed """
+
+    def connect(self, broker, port, keepalive):
+        """ Not needed """
+
+    def publish(self, topic, payload, retain=False):
+        """ Count the message """
+        self.messages += 1
+
+
+class NoGps:
+    """ GPS without a fix """
+
+    def fix(self):
+        """ Return an empty fix """
+        return empty_fix()
+
+
+def sample_response(command):
+    """ Build a deterministic response matching the struct of a command """
+    return bytes((idx * 37 + 11) % 256 for idx in range(command.struct.size))
+
+
+def legacy_decode(command, raw):
+    """ The per-field decode loop IsoTpDecoder.get_data used before the
+        schema got compiled. Kept as the reference for the benchmark. """
+    data = {}
+    raw_fields = command.struct.unpack(raw)
+    for field in command.fields:
+        name = field['name']
+        fmt_idx = field['fmt_idx']
+        fmt_len = field['fmt_len']
+
+        if 'lambda' in field:
+            value = field['lambda'](raw_fields[fmt_idx:fmt_idx+fmt_len])
+        else:
+            value = raw_fields[fmt_idx]
+
+        data[name] = value * field['scale'] + field['offset']
+    return data
+
+
+def legacy_reassemble(ret):
+    """ The str based frame parsing Elm327.send_command_ex used before,
+        without its debug prints. Kept as the reference for the benchmark. """
+    data = None
+    data_len = 0
+    last_idx = 0
+    raw = str(ret, 'ascii').split('\r\n')
+
+    for line in raw:
+        if len(line) != 19:
+            raise ValueError
+
+        offset = 3
+        frame_type = int(line[offset:offset+1], 16)
+
+        if frame_type == 0:     # Single frame
+            data_len = int(line[offset+1:offset+2], 16)
+            data = bytes.fromhex(line[offset+2:data_len*2+offset+2])
+            break
+
+        elif frame_type == 1:   # First frame
+            data_len = int(line[offset+1:offset+4], 16)
+            data = bytearray.fromhex(line[offset+4:])
+            last_idx = 0
+
+        elif frame_type == 2:   # Consecutive frame
+            idx = int(line[offset+1:offset+2], 16)
+            if (last_idx + 1) % 0x10 != idx:
+                raise ValueError
+
+            frame_len = min(7, data_len - len(data))
+            data.extend(bytearray.fromhex(
+                line[offset+2:frame_len*2+offset+2]))
+            last_idx = idx
+
+            if data_len == len(data):
+                break
+
+    return data
+
+
+def legacy_parse_formula(equation, data_bytes):
+    """ ObdReader.parse_formula before the equations got compiled, without
+        its prints. Kept as the reference for the benchmark. """
+    context = {}
+    context_lower = {}
+    offset = 0
+    if len(data_bytes) > 3:
+        offset = 2
+    for idx, byte in enumerate(data_bytes[offset:]):
+        def excel_col_name(n):
+            name = ""
+            while n >= 0:
+                name = chr(n % 26 + ord('A')) + name
+                n = n // 26 - 1
+            return name
+
+        var = excel_col_name(idx)
+        context[var] = byte
+        context_lower[var.lower()] = byte
+    context = {**context, **context_lower}
+    try:
+        equation = equation.replace('>', '>>').replace('<', '<<')
+
+        def preprocess_expr(expr):
+            def int64_fn_repl(match):
+                bytes_vars = [v.strip() for v in match.group(1).split(',')]
+                n = len(bytes_vars)
+                exprs = [f"({v} << {8 * (n - i - 1)})" for i, v in enumerate(bytes_vars)]
+                return "(" + " | ".join(exprs) + ")"
+            expr = re.sub(r'Int64\s*\(\s*([^)]+)\s*\)', int64_fn_repl, expr)
+
+            def signed_repl(match):
+                inner = match.group(1)
+                return f"signed_int({inner})"
+            expr = re.sub(r'Signed\s+([^\s:()]+(?:\([^)]+\))?)', signed_repl, expr)
+            expr = re.sub(r'([a-zA-Z_][\w() ,]*)\s*:\s*(\d+)', r'((\1 >> \2) & 1)', expr)
+            return expr
+
+        def signed_int(x, bits=64):
+            mask = (1 << bits) - 1
+            x = x & mask
+            sign_bit = 1 << (bits - 1)
+            return x - (1 << bits) if (x & sign_bit) else x
+
+        def safe_eval(expr, context=None):
+            expr_transformed = preprocess_expr(expr)
+            return eval(expr_transformed, {"signed_int": signed_int}, context or {})
+
+        return safe_eval(equation, context)
+    except Exception:
+        return None
+
+
+# Equations in the style of the Torque PID lists for the Ioniq
+SampleEquations = (
+    'A/2', '((B<8)+C)/10', '(E*256+F)/10', 'Int64(B,C,D,E)/10',
+    'J:3', 'Signed AA', '(AB*256+AC)/100', 'ac*256+ad',
+)
+
+
+def best_of(func, number):
+    """ Return the best time of one call of func in microseconds """
+    return min(repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def bench_decode(number=2000):
+    """ Compare the legacy decode loop with the generated decoders """
+    schema = compile_fields(ioniq_bev.Fields)
+    results = {}
+    for command in schema.plan:
+        if command.computed:
+            continue
+        raw = sample_response(command)
+        names = command.names
+        decode = command.decode
+        assert legacy_decode(command, raw) == dict(zip(names, decode(raw)))
+
+        legacy = best_of(lambda: legacy_decode(command, raw), number)
+        compiled = best_of(lambda: dict(zip(names, decode(raw))), number)
+        flat = best_of(lambda: decode(raw), number)
+        results[command.cmd.hex()] = {
+            'fields': len(names),
+            'legacy_us': round(legacy, 2),
+            'compiled_us': round(compiled, 2),
+            'tuple_us': round(flat, 2),
+            'speedup': round(legacy / compiled, 1),
+        }
+    return results
+
+
+def bench_reassembly(number=2000):
+    """ Compare the legacy str based frame parsing with reassemble()
+        on the 2101 and 2102 sample responses """
+    results = {}
+    for cmd in ('2101', '2102'):
+        payload = ioniq_traces.Responses[(0x7e4, bytes.fromhex(cmd))]
+        ret = ioniq_traces.elm_response(payload, 0x7ec).strip(b'\r\n')
+        spaced = ioniq_traces.elm_response(payload, 0x7ec, headers=False,
+                                           spaces=True).strip(b'\r\n')
+        assert legacy_reassemble(ret) == reassemble(ret) == reassemble(spaced, headers=False)
+
+        legacy = best_of(lambda: legacy_reassemble(ret), number)
+        fast = best_of(lambda: reassemble(ret), number)
+        headers_off = best_of(lambda: reassemble(spaced, headers=False), number)
+        results[cmd] = {
+            'bytes': len(payload),
+            'legacy_us': round(legacy, 2),
+            'reassemble_us': round(fast, 2),
+            'headers_off_spaces_us': round(headers_off, 2),
+            'speedup': round(legacy / fast, 1),
+        }
+    return results
+
+
+def bench_formula(number=2000):
+    """ Compare the interpreted Torque equations of ObdReader with the
+        compiled ones """
+    data_bytes = list(range(3, 3 + 40))
+    results = {}
+    for equation in SampleEquations:
+        formula = compile_formula(equation)
+        compiled = formula(data_bytes) if formula else None
+        assert legacy_parse_formula(equation, data_bytes) == compiled, equation
+
+        legacy = best_of(lambda: legacy_parse_formula(equation, data_bytes), number // 10)
+        fast = best_of(lambda: formula(data_bytes), number) if formula else 0
+        results[equation] = {
+            'legacy_us': round(legacy, 2),
+            'compiled_us': round(fast, 3),
+            'speedup': round(legacy / fast) if fast else None,
+        }
+    return results
+
+
+def bench_preprocess(number=200):
+    """ Time IsoTpDecoder.preprocess_fields without the schema cache """
+    decoder = IsoTpDecoder(CannedDongle(), ioniq_bev.Fields)
+
+    def preprocess():
+        isotp_decoder._schema_cache.clear()
+        decoder.preprocess_fields()
+    return {'ioniq': {'us': round(best_of(preprocess, number), 2)}}
+
+
+def bench_get_data(number=500):
+    """ Time IsoTpDecoder.get_data on a canned dongle, with all commands
+        due and with only the fast 2101 due """
+    decoder = IsoTpDecoder(CannedDongle(), ioniq_bev.Fields)
+    clock = [0.0]
+
+    def cycle(step):
+        clock[0] += step
+        decoder.get_data(clock[0])
+    return {
+        'all_due': {'us': round(best_of(lambda: cycle(1000.0), number), 2)},
+        '2101_due': {'us': round(best_of(lambda: cycle(0.25), number), 2)},
+    }
+
+
+def bench_send_command_ex(number=500):
+    """ Time Elm327.send_command_ex including talk_to_dongle on replies
+        served from memory. Debug prints go to /dev/null. """
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        dongle = Elm327({'port': 'emulated', 'baudrate': 0}, transport=CachedSerial())
+        dongle.set_protocol('CAN_11_500')
+        results = {}
+        for cmd in ('2101', '2102', '2180'):
+            request = bytes.fromhex(cmd)
+            cantx = next(tx for tx, req in ioniq_traces.Responses if req == request)
+            dongle.send_command_ex(request, cantx, cantx + 8)
+            results[cmd] = {'us': round(best_of(
+                lambda: dongle.send_command_ex(request, cantx, cantx + 8), number), 2)}
+    return results
+
+
+def bench_mqtt(number=200):
+    """ Time MqttHandler.initialize_pid for all fields and update_values
+        with one cycle of data against a stub client """
+    decoder = IsoTpDecoder(CannedDongle(), ioniq_bev.Fields)
+    data = decoder.get_data()
+    # Grouped by command like main.py does, for the "command" state mode
+    fields = [(field['name'], cmd_data['cmd'].hex() if 'cmd' in cmd_data
+               else cmd_data.get('group', 'computed'))
+              for cmd_data in decoder.fields for field in cmd_data['fields']]
+    results = {}
+    for mode in ('field', 'command', 'cycle'):
+        handler = MqttHandler('stub', 0, None, None, 'bench', log_enabled=False,
+                              state_mode=mode, heartbeat=None, client=StubClient())
+
+        def initialize():
+            handler.initialized_pids.clear()
+            for name, group in fields:
+                handler.initialize_pid(name, name, None, name, group=group)
+        initialize_us = best_of(initialize, max(1, number // 10))
+        handler.client.messages = 0
+        update_us = best_of(lambda: handler.update_values(data), number)
+        results[mode] = {
+            'pids': len(fields),
+            'initialize_us': round(initialize_us, 2),
+            'update_us': round(update_us, 2),
+            'messages_per_update': handler.client.messages // (5 * number),
+        }
+    return results
+
+
+def bench_poll_cycle(number=100):
+    """ Time Car.poll_once on IoniqBev with Elm327 over in-memory replies
+        and MQTT publishing to a stub client """
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        dongle = Elm327({'port': 'emulated', 'baudrate': 0}, transport=CachedSerial())
+        car = ioniq_bev.IoniqBev({}, dongle, NoGps())
+        handler = MqttHandler('stub', 0, None, None, 'bench', log_enabled=False,
+                              heartbeat=None, client=StubClient())
+        car.register_data(handler.update_values)
+
+        def full_cycle():
+            car._isotp.preprocess_fields()     # Makes every command due
+            car.poll_once()
+        full_us = best_of(full_cycle, number)
+        idle_us = best_of(car.poll_once, number)
+    return {
+        'all_due': {'us': round(full_us, 2)},
+        'nothing_due': {'us': round(idle_us, 2)},
+    }
+
+
+Benchmarks = {
+    'preprocess': bench_preprocess,
+    'decode': bench_decode,
+    'formula': bench_formula,
+    'get_data': bench_get_data,
+    'reassembly': bench_reassembly,
+    'send_command_ex': bench_send_command_ex,
+    'mqtt': bench_mqtt,
+    'poll_cycle': bench_poll_cycle,
+}
+
+
+def main():
+    """ Run the selected benchmarks, print the results and optionally
+        write them as JSON """
+    parser = argparse.ArgumentParser(description="Benchmarks of the polling loop")
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help="benchmarks to run, default all: " + ", ".join(Benchmarks))
+    parser.add_argument('--json', help="write results to this file, '-' for stdout")
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in Benchmarks]
+    if unknown:
+        parser.error("unknown benchmark: " + ", ".join(unknown))
+
+    started = perf_counter()
+    results = {}
+    for name in args.names or Benchmarks:
+        results[name] = Benchmarks[name]()
+        print(f"{name}:", file=sys.stderr)
+        for key, values in results[name].items():
+            print(f"  {key:10s} " + "  ".join(f"{k} {v}" for k, v in values.items()),
+                  file=sys.stderr)
+
+    report = {
+        'meta': {
+            'time': time(),
+            'duration_s': round(perf_counter() - started, 2),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+    elif args.json:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
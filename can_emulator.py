@@ -0,0 +1,106 @@
+""" ECUs answering ISO-TP requests on a CAN bus, to test the SocketCAN
+    backend on the python-can virtual bus or vcan without a car:
+
+        sudo ip link add dev vcan0 type vcan && sudo ip link set up vcan0
+        python3 can_emulator.py --channel vcan0
+"""
+from threading import Thread, Timer
+from time import sleep
+import argparse
+import can
+import ioniq_traces
+
+
+class EcuEmulator:
+    """ ECUs behind the OBD port, answering from "responses" like the
+        ELM327 emulator. "latency" is the response time of every ECU in
+        seconds, "latencies" overrides it per request id. The ECUs answer
+        independently of each other, as on a real bus. """
+
+    def __init__(self, bus, responses=None, latency=0.0, latencies=None, extended=False):
+        self.bus = bus
+        self.responses = ioniq_traces.Responses if responses is None else responses
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.extended = extended
+        self.requests = 0
+        self._waiting = {}
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        """ Start answering in a thread """
+        self._running = True
+        self._thread = Thread(target=self.run, name="EVNotiPi/CAN-Emulator", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop answering """
+        self._running = False
+        if self._thread:
+            self._thread.join()
+
+    def _send(self, can_id, frame):
+        self.bus.send(can.Message(arbitration_id=can_id, data=frame,
+                                  is_extended_id=self.extended))
+
+    def _respond(self, cantx, payload):
+        """ Send the first frame, the rest waits for the flow control """
+        frames = ioniq_traces.isotp_frames(payload)
+        canrx = cantx + 8
+        if len(frames) > 1:
+            self._waiting[cantx] = (canrx, frames[1:])
+        self._send(canrx, frames[0])
+
+    def run(self):
+        """ Receive requests and flow control frames """
+        while self._running:
+            msg = self.bus.recv(0.1)
+            if msg is None or msg.is_error_frame:
+                continue
+            cantx = msg.arbitration_id
+            frame = msg.data
+            if frame[0] >> 4 == 3:
+                # Flow control: send the remaining frames
+                waiting = self._waiting.pop(cantx, None)
+                if waiting:
+                    canrx, frames = waiting
+                    for data in frames:
+                        self._send(canrx, data)
+            elif frame[0] >> 4 == 0:
+                request = bytes(frame[1:1 + (frame[0] & 0xf)])
+                payload = self.responses.get((cantx, request))
+                if payload is None:
+                    continue    # Unknown requests stay unanswered
+                self.requests += 1
+                latency = self.latencies.get(cantx, self.latency)
+                if latency:
+                    Timer(latency, self._respond, (cantx, payload)).start()
+                else:
+                    self._respond(cantx, payload)
+
+
+def main():
+    """ Run the emulator until interrupted """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--interface', default='socketcan')
+    parser.add_argument('--channel', default='vcan0')
+    parser.add_argument('--latency', type=float, default=0.02, help="ECU response time [s]")
+    args = parser.parse_args()
+
+    bus = can.Bus(interface=args.interface, channel=args.channel)
+    emulator = EcuEmulator(bus, latency=args.latency)
+    emulator.start()
+    print(f"[INFO] ECU emulator answering on {args.interface} {args.channel}")
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.stop()
+        bus.shutdown()
+
+
+if __name__ == '__main__':
+    main()
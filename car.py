@@ -1,7 +1,10 @@
 """ The car polling loop and associated infrastructure """
-from time import time, sleep
+from time import time, sleep, monotonic
 from threading import Thread
+import asyncio
 from elm327 import NoData, CanError
+from sample import Missing, SampleLayout
+import metrics
 
 def ifbu(in_bytes):
     """ int from bytes unsigned """
@@ -23,6 +26,55 @@ def ffbs(in_bytes):
     return float(int.from_bytes(in_bytes, byteorder='big', signed=True))
 
 
+# Fields merged into the data by poll_data, in the same format as the car's
+# field tables so they can be announced like the decoded fields.
+LocationFields = (
+    {'name': 'latitude', 'units': '°'},
+    {'name': 'longitude', 'units': '°'},
+    {'name': 'speed', 'units': 'm/s'},
+    {'name': 'altitude', 'units': 'm'},
+    {'name': 'fix_mode'},
+    {'name': 'hdop'},
+    {'name': 'vdop'},
+)
+
+# Fields every sample has, with their value before anything was read
+BaseData = (
+    ('timestamp',   None),
+    # Base:
+    ('SOC_BMS',     None),
+    ('SOC_DISPLAY', None),
+    # Extended:
+    ('auxBatteryVoltage',           None),
+    ('batteryInletTemperature',     None),
+    ('batteryMaxTemperature',       None),
+    ('batteryMinTemperature',       None),
+    ('cumulativeEnergyCharged',     None),
+    ('cumulativeEnergyDischarged',  None),
+    ('charging',                    None),
+    ('normalChargePort',            None),
+    ('rapidChargePort',             None),
+    ('dcBatteryCurrent',            None),
+    ('dcBatteryVoltage',            None),
+    ('dcBatteryPower',              None),
+    ('soh',                         None),
+    ('externalTemperature',         None),
+    ('odo',                         None),
+    # Location:
+    ('latitude',    None),
+    ('longitude',   None),
+    ('speed',       None),
+    ('fix_mode',    0),
+)
+
+# Fields taken from the GPS fix, in the order finish_cycle writes them
+GpsNames = ('fix_mode', 'latitude', 'longitude', 'speed', 'gdop', 'pdop',
+            'hdop', 'vdop', 'tdop', 'altitude', 'gps_device')
+
+# The GPS fields of a sample without a fix
+NoLocation = (0, None, None, None) + (Missing,) * (len(GpsNames) - 4)
+
+
 class DataError(ValueError):
     """ Problem with data occurred """
 
@@ -36,16 +88,49 @@ class Car:
         self._dongle = dongle
         self._gps = gps
         self._poll_interval = 1
+        self._next_poll = 0
         self._thread = None
         self._running = False
         self._skip_polling = False
         self.last_data = 0
         self._data_callbacks = []
+        self._sample = None
+        self._metrics = metrics.Registry
+        self._cycle_times = self._metrics.histogram('car_cycle_seconds')
+        self._rate_interval = 10.0
+        self._rate_start = None
+        self._rate_cycles = 0
 
     def read_dongle(self, data):
-        """ Get data from CAN bus and put it into "data" dictionary """
+        """ Get data from CAN bus and put it into the sample "data" """
         raise NotImplementedError()
 
+    def get_fields(self):
+        """ Return the field tables of the car """
+        return ()
+
+    @property
+    def sample(self):
+        """ The sample the car and its decoders write into. It is created
+            on first use with a field for every name in get_fields, so
+            subclasses have to set up their fields before. """
+        if self._sample is None:
+            names = [field['name'] for cmd_data in self.get_fields()
+                     for field in cmd_data['fields'] if 'name' in field]
+            names += [name for name, _ in BaseData]
+            self._sample = SampleLayout(names + list(GpsNames), dict(BaseData)).new()
+        return self._sample
+
+    async def read_dongle_async(self, data):
+        """ read_dongle for the asyncio runtime. Cars whose decoder can
+            await the dongle override this, the default blocks. """
+        self.read_dongle(data)
+
+    def next_deadline(self):
+        """ Return the monotonic time at which read_dongle has new work.
+            Subclasses with a command scheduler return its next deadline. """
+        return self._next_poll
+
     def start(self):
         """ Start the poller thread. """
         self._running = True
@@ -60,90 +145,120 @@ class Car:
     def poll_data(self):
         """ The poller thread. """
         while self._running:
-            now = time()
-
-            # Initialize data with required fields; saves all those checks later
-            data = {
-                'timestamp':    now,
-                # Base:
-                'SOC_BMS':      None,
-                'SOC_DISPLAY':  None,
-                # Extended:
-                'auxBatteryVoltage':        None,
-                'batteryInletTemperature':  None,
-                'batteryMaxTemperature':    None,
-                'batteryMinTemperature':    None,
-                'cumulativeEnergyCharged':  None,
-                'cumulativeEnergyDischarged':   None,
-                'charging':                 None,
-                'normalChargePort':         None,
-                'rapidChargePort':          None,
-                'dcBatteryCurrent':         None,
-                'dcBatteryPower':           None,
-                'dcBatteryVoltage':         None,
-                'soh':                      None,
-                'externalTemperature':      None,
-                'odo':                      None,
-                # Location:
-                'latitude':     None,
-                'longitude':    None,
-                'speed':        None,
-                'fix_mode':     0,
-            }
-
-                
-            if not self._skip_polling or self._watchdog.is_car_available():
-                if self._skip_polling:
-                    self._skip_polling = False
-                try:
-                    self.read_dongle(data)  # readDongle updates data inplace
-                    self.last_data = now
-                except CanError as err:
-                    print(f"CAN: ERROR: {err}")
-                except NoData:
-                    print(f"CAN: NO DATA")
-                    # if not self._watchdog.is_car_available():
-                    #     print(f"CAN: NO DATA")
-                    #     self._skip_polling = True
-                    sleep(1)
-
-            fix = self._gps.fix()
-            if fix and fix['mode'] > 1:
-                if data['charging'] or data['normalChargePort'] or data['rapidChargePort']:
-                    speed = 0.0
-                else:
-                    speed = fix['speed']
-
-                data.update({
-                    'fix_mode':     fix['mode'],
-                    'latitude':     fix['latitude'],
-                    'longitude':    fix['longitude'],
-                    'speed':        speed,
-                    'gdop':         fix['gdop'],
-                    'pdop':         fix['pdop'],
-                    'hdop':         fix['hdop'],
-                    'vdop':         fix['vdop'],
-                    'tdop':         fix['tdop'],
-                    'altitude':     fix['altitude'],
-                    'gps_device':   fix['device'],
-                })
-
-            # if hasattr(self._dongle, 'get_obd_voltage'):
-            #     data.update({
-            #         'obdVoltage': self._dongle.get_obd_voltage(),
-            #     })
-
-            for call_back in self._data_callbacks:
-                call_back(data)
+            cycle_start = monotonic()
+            self.poll_once()
 
             if self._running:
-                if self._poll_interval > 0:
-                    interval = self._poll_interval - (time() - now)
-                    sleep(max(0, interval))
+                sleep(self.next_delay(cycle_start))
+
+    def next_delay(self, cycle_start):
+        """ Return the time to wait after the cycle that started at
+            "cycle_start": until the next deadline instead of a fixed
+            interval, so the cycle time follows the fastest due command. """
+        self._next_poll += self._poll_interval
+        if self._next_poll <= cycle_start:
+            self._next_poll = cycle_start + self._poll_interval
+        return max(0, self.next_deadline() - monotonic())
+
+    def poll_once(self):
+        """ Run one polling cycle and hand the data to the subscribers.
+            Returns the read-only snapshot. If nothing could be read, the
+            subscribers get the values and timestamp of the last good
+            cycle with the current location. """
+        now = time()
+        cycle_start = monotonic()
+        data = self.sample
+
+        if not self._skip_polling or self._watchdog.is_car_available():
+            if self._skip_polling:
+                self._skip_polling = False
+            try:
+                self.read_dongle(data)  # readDongle updates data inplace
+                data['timestamp'] = now
+                self.got_data(now)
+            except CanError as err:
+                print(f"CAN: ERROR: {err}")
+            except NoData:
+                print(f"CAN: NO DATA")
+                # if not self._watchdog.is_car_available():
+                #     print(f"CAN: NO DATA")
+                #     self._skip_polling = True
                 sleep(1)
 
+        return self.finish_cycle(data, cycle_start)
+
+    async def poll_once_async(self):
+        """ poll_once for the asyncio runtime """
+        now = time()
+        cycle_start = monotonic()
+        data = self.sample
+        try:
+            await self.read_dongle_async(data)
+            data['timestamp'] = now
+            self.got_data(now)
+        except CanError as err:
+            print(f"CAN: ERROR: {err}")
+        except NoData:
+            print(f"CAN: NO DATA")
+            await asyncio.sleep(1)
+        return self.finish_cycle(data, cycle_start)
+
+    def got_data(self, now):
+        """ Book a successful read of the dongle """
+        if not self.last_data:
+            self._metrics.gauge('car_first_sample_seconds',
+                                round(monotonic() - metrics.ProcessStart, 3))
+        self.last_data = now
+
+    def finish_cycle(self, data, cycle_start):
+        """ Add the location to the data of a cycle and hand it to the
+            subscribers. Returns the read-only snapshot. """
+        fix = self._gps.fix()
+        if fix and fix['mode'] > 1:
+            if data['charging'] or data['normalChargePort'] or data['rapidChargePort']:
+                speed = 0.0
+            else:
+                speed = fix['speed']
+
+            location = (fix['mode'], fix['latitude'], fix['longitude'], speed,
+                        fix['gdop'], fix['pdop'], fix['hdop'], fix['vdop'],
+                        fix['tdop'], fix['altitude'], fix['device'])
+        else:
+            location = NoLocation
+        data.write(data.layout.slot(GpsNames), location)
+
+        # if hasattr(self._dongle, 'get_obd_voltage'):
+        #     data.update({
+        #         'obdVoltage': self._dongle.get_obd_voltage(),
+        #     })
+
+        # poll_data is the only producer. Subscribers get a read-only copy
+        # of this cycle's data, the sample itself is reused.
+        snapshot = data.view()
+        for call_back in self._data_callbacks:
+            try:
+                call_back(snapshot)
+            except Exception as err:
+                print(f"[ERROR] Data callback {call_back} failed: {err}")
+
+        self._cycle_times.observe(monotonic() - cycle_start)
+        self.count_cycle(cycle_start)
+        return snapshot
+
+    def count_cycle(self, cycle_start):
+        """ Update the achieved polling rate every "_rate_interval" seconds """
+        if self._rate_start is None:
+            self._rate_start = cycle_start
+        elapsed = cycle_start - self._rate_start
+        if elapsed >= self._rate_interval:
+            self._metrics.gauge('car_cycle_rate_hz', round(self._rate_cycles / elapsed, 2))
+            self._rate_start = cycle_start
+            self._rate_cycles = 0
+        self._rate_cycles += 1
+
     def register_data(self, callback):
-        """ Register a callback that gets called with new data. """
+        """ Register a callback that gets called with new data.
+            The data is passed as a read-only mapping. """
         if callback not in self._data_callbacks:
             self._data_callbacks.append(callback)
 
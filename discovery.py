@@ -0,0 +1,130 @@
+""" Home Assistant MQTT discovery with change detection """
+from hashlib import sha1
+import json
+import os
+
+# Home Assistant publishes "online" here when it (re)starts
+BIRTH_TOPIC = "homeassistant/status"
+
+# How discovery configs are published:
+#   sensor: one retained config per sensor with the device repeated
+#   device: one retained config for the device with all sensors as
+#           components (Home Assistant 2024.11 and later)
+DISCOVERY_MODES = ("sensor", "device")
+
+# Device class and state class by unit
+UNIT_CLASSES = {
+    "V": ("voltage", "measurement"),
+    "mV": ("voltage", "measurement"),
+    "A": ("current", "measurement"),
+    "W": ("power", "measurement"),
+    "kW": ("power", "measurement"),
+    "Wh": ("energy", "total_increasing"),
+    "kWh": ("energy", "total_increasing"),
+    "°C": ("temperature", "measurement"),
+    "km": ("distance", "total_increasing"),
+    "m": ("distance", "measurement"),
+    "km/h": ("speed", "measurement"),
+    "m/s": ("speed", "measurement"),
+    "s": ("duration", "total_increasing"),
+    "ms": ("duration", "measurement"),
+    "Hz": ("frequency", "measurement"),
+}
+
+
+def infer_classes(unit, name=""):
+    """ Return Home Assistant device class and state class for a unit.
+        Percentages are only a battery level if the name says SOC. """
+    if unit == "%" and "soc" in name.lower():
+        return "battery", "measurement"
+    return UNIT_CLASSES.get(unit, (None, "measurement"))
+
+
+class DiscoveryManager:
+    """ Publishes retained discovery configs only if they changed.
+        A hash of every published config is kept in "state_file", so
+        unchanged configs are not sent again after a restart; the broker
+        still has them retained. When Home Assistant announces itself on
+        BIRTH_TOPIC all configs are published again. """
+
+    def __init__(self, publish, state_file=None, log_enabled=True):
+        self._publish = publish
+        self.state_file = state_file
+        self.log_enabled = log_enabled
+        self._configs = {}
+        self._hashes = {}
+        self._dirty = False
+        self.published = 0
+        self.skipped = 0
+        if state_file:
+            try:
+                with open(state_file) as file:
+                    self._hashes = json.load(file)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as err:
+                print(f"[WARNING] Ignoring discovery state {state_file}: {err}")
+
+    def announce(self, topic, payload):
+        """ Publish the retained config "payload" on "topic" unless the
+            same config was published before """
+        text = json.dumps(payload, sort_keys=True)
+        digest = sha1(text.encode()).hexdigest()
+        self._configs[topic] = text
+        if self._hashes.get(topic) == digest:
+            self.skipped += 1
+            return False
+        self._publish(topic, text, True)
+        self._hashes[topic] = digest
+        self._dirty = True
+        self.published += 1
+        return True
+
+    def clear(self, topic):
+        """ Remove a retained config from the broker, which removes the
+            entities from Home Assistant """
+        self._publish(topic, "", True)
+        self._hashes.pop(topic, None)
+        self._configs.pop(topic, None)
+        self._dirty = True
+
+    def prune(self, prefix):
+        """ Clear the configs below "prefix" published by an earlier run
+            but not in this one, i.e. after switching the discovery mode """
+        stale = [topic for topic in self._hashes
+                 if topic.startswith(prefix) and topic not in self._configs]
+        for topic in stale:
+            self.clear(topic)
+        if stale and self.log_enabled:
+            print(f"Removed {len(stale)} stale discovery configs")
+
+    def republish(self):
+        """ Publish all known configs again """
+        for topic, text in list(self._configs.items()):
+            self._publish(topic, text, True)
+        if self.log_enabled:
+            print(f"Republished {len(self._configs)} discovery configs")
+
+    def save(self):
+        """ Write the hashes of the published configs to the state file """
+        if not self._dirty or not self.state_file:
+            return
+        tmp_file = self.state_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as file:
+                json.dump(self._hashes, file)
+            os.replace(tmp_file, self.state_file)
+            self._dirty = False
+        except OSError as err:
+            print(f"[WARNING] Could not write discovery state {self.state_file}: {err}")
+
+    def on_connect(self, client):
+        """ Subscribe to the Home Assistant birth message """
+        client.message_callback_add(BIRTH_TOPIC, self.on_birth)
+        client.subscribe(BIRTH_TOPIC)
+
+    def on_birth(self, client, userdata, message):
+        """ Home Assistant (re)started and lost its discovered entities
+            unless they are retained: publish everything again """
+        if message.payload.strip().lower() == b'online':
+            self.republish()
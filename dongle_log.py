@@ -0,0 +1,217 @@
+""" Capture and replay of the raw traffic with an ELM327 dongle.
+
+    Enable the capture with "capture": "/path/drive.elmlog" in the obd
+    section of config.json. Replay a capture through the decoder, much
+    faster than real time:
+
+        python3 dongle_log.py /path/drive.elmlog [--dump]
+
+    File format: the magic FileMagic, then one record per command:
+    Record (time, round trip time, CAN header, command length, reply
+    length), followed by the command and the raw reply up to the prompt. """
+from collections import namedtuple
+from contextlib import redirect_stdout
+from time import monotonic, perf_counter
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+
+FileMagic = b'ELMLOG1\n'
+Record = struct.Struct('<dfIHH')
+
+Entry = namedtuple('Entry', ('time', 'rtt', 'header', 'cmd', 'reply'))
+
+
+class CaptureLog:
+    """ Appends records to a capture file. Writes go to a buffer that is
+        flushed when full or after "flush_interval" seconds, so capturing
+        costs no system call per command. """
+
+    def __init__(self, path, buffer_size=65536, flush_interval=5.0):
+        self.path = path
+        self._flush_interval = flush_interval
+        self._file = open(path, 'ab', buffering=buffer_size)
+        if self._file.tell() == 0:
+            self._file.write(FileMagic)
+        self._next_flush = monotonic() + flush_interval
+
+    def record(self, timestamp, rtt, header, cmd, reply):
+        """ Append one command with its raw reply """
+        write = self._file.write
+        write(Record.pack(timestamp, rtt, header, len(cmd), len(reply)))
+        write(cmd)
+        write(reply)
+        now = monotonic()
+        if now >= self._next_flush:
+            self._file.flush()
+            self._next_flush = now + self._flush_interval
+
+    def close(self):
+        """ Flush and close the file """
+        self._file.close()
+
+
+def read_log(path):
+    """ Iterate over the Entries of a capture file """
+    with open(path, 'rb') as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for offset, cmd_len, reply_len in _scan(data):
+            timestamp, rtt, header, _, _ = Record.unpack_from(data, offset)
+            cmd = offset + Record.size
+            yield Entry(timestamp, rtt, header, data[cmd:cmd + cmd_len],
+                        data[cmd + cmd_len:cmd + cmd_len + reply_len])
+
+
+def _scan(data):
+    """ Yield offset, command length and reply length of each record.
+        A record cut off by a crash ends the scan. """
+    if data[:len(FileMagic)] != FileMagic:
+        raise ValueError("Not a dongle capture file")
+    offset = len(FileMagic)
+    end = len(data)
+    while offset + Record.size <= end:
+        _, _, _, cmd_len, reply_len = Record.unpack_from(data, offset)
+        if offset + Record.size + cmd_len + reply_len > end:
+            break
+        yield offset, cmd_len, reply_len
+        offset += Record.size + cmd_len + reply_len
+
+
+def _key(cmd, header):
+    """ Replay lookup key of a command line. Requests depend on the CAN
+        header, AT commands do not. The response count after a request
+        is dropped, so captures replay with it on or off. """
+    cmd = cmd.rstrip(b'\r').replace(b' ', b'').upper()
+    if cmd.startswith(b'AT'):
+        return cmd, None
+    return cmd[:len(cmd) & ~1], header
+
+
+class ReplayTransport:
+    """ Serial port stand-in answering from a capture file, for
+        Elm327(config, transport=ReplayTransport(path)). The file is
+        mapped into memory and only indexed on open, replies are sliced
+        out when requested.
+
+        Each request gets the next recorded reply of the same command to
+        the same header, so the decoder may schedule differently than
+        during the drive. AT commands get their first recorded reply, or
+        OK. EOFError is raised when a request has no more replies. """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._replies = {}
+        self._first_time = None
+        for offset, cmd_len, reply_len in _scan(self._data):
+            timestamp, _, header, _, _ = Record.unpack_from(self._data, offset)
+            if self._first_time is None:
+                self._first_time = timestamp
+            cmd = offset + Record.size
+            key = _key(self._data[cmd:cmd + cmd_len], header)
+            self._replies.setdefault(key, []).append((offset, cmd + cmd_len, reply_len))
+        self._cursors = dict.fromkeys(self._replies, 0)
+        self._header = 0
+        self.timeout = 1
+        self.clock = self._first_time
+        self._pending = bytearray()
+        self._output = bytearray()
+
+    @property
+    def in_waiting(self):
+        """ Number of bytes ready to be read """
+        return len(self._output)
+
+    def write(self, data):
+        """ Queue the recorded reply of each complete command line """
+        self._pending.extend(data)
+        while True:
+            end = self._pending.find(b'\r')
+            if end < 0:
+                break
+            line = bytes(self._pending[:end]).strip(b'\n')
+            del self._pending[:end + 1]
+            self._output.extend(self._reply(line))
+            self._output.extend(b'>')
+        return len(data)
+
+    def _reply(self, line):
+        """ Look up the recorded reply of a command line """
+        cmd, header = key = _key(line, self._header)
+        if cmd.startswith(b'ATSH'):
+            self._header = int(cmd[4:], 16)
+        replies = self._replies.get(key)
+        if header is None:
+            if not replies:
+                return b'OK\r\r'
+            offset, reply, reply_len = replies[0]
+        else:
+            idx = self._cursors.get(key, 0)
+            if not replies or idx >= len(replies):
+                raise EOFError(f"No more recorded replies to {cmd} for {header:X}")
+            self._cursors[key] = idx + 1
+            offset, reply, reply_len = replies[idx]
+        self.clock = Record.unpack_from(self._data, offset)[0]
+        return self._data[reply:reply + reply_len]
+
+    @property
+    def duration(self):
+        """ Recorded time up to the last served reply """
+        return self.clock - self._first_time if self._first_time is not None else 0.0
+
+    def read(self, size=1):
+        """ Read up to "size" bytes, never blocks """
+        data = bytes(self._output[:size])
+        del self._output[:size]
+        return data
+
+    def close(self):
+        """ Unmap and close the file """
+        self._data.close()
+        self._file.close()
+
+
+def main():
+    """ Replay a capture through the Ioniq decoder """
+    from elm327 import CanError, Elm327, NoData
+    from isotp_decoder import IsoTpDecoder
+    import ioniq_bev
+
+    parser = argparse.ArgumentParser(description="Replay a dongle capture through the decoder")
+    parser.add_argument('path', help="capture file")
+    parser.add_argument('--dump', action='store_true', help="print every sample as JSON")
+    args = parser.parse_args()
+
+    transport = ReplayTransport(args.path)
+    samples = errors = 0
+    started = perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        dongle = Elm327({'port': args.path, 'baudrate': 0}, transport=transport)
+        dongle.set_protocol('CAN_11_500')
+        decoder = IsoTpDecoder(dongle, ioniq_bev.Fields)
+        # Simulated time: jump straight to the next deadline
+        now = decoder.next_deadline()
+        while True:
+            try:
+                data = decoder.get_data(now)
+            except EOFError:
+                break
+            except (CanError, NoData):
+                errors += 1
+            else:
+                samples += 1
+                if args.dump:
+                    print(json.dumps(dict(data, timestamp=transport.clock)), file=sys.__stdout__)
+            now = decoder.next_deadline()
+    elapsed = perf_counter() - started
+    transport.close()
+
+    print(f"[INFO] {samples} samples, {errors} errors, {transport.duration:.1f}s recorded, "
+          f"replayed in {elapsed:.2f}s ({transport.duration / max(elapsed, 1e-9):.0f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,15 @@
 """ Module for ELM327 based dongles """
+from binascii import a2b_hex
+from math import ceil
 from threading import Lock
-from time import sleep
-import math
+from select import select
+from time import monotonic, perf_counter, time
+import asyncio
+import json
+import os
 import serial
+from dongle_log import CaptureLog
+import metrics
 
 class CanError(Exception):
     """ CAN communication failed """
@@ -10,63 +17,237 @@ class CanError(Exception):
 
 class NoData(Exception):
     """ CAN did not return any data in time """
-    
+
+
+# Power on UART rate of an ELM327, AT BRD sets it to BrdClock / divisor
+DefaultBaudrate = 38400
+BrdClock = 4000000
+
+# Response count tuning of AT ST: the timeout is recomputed from the
+# slowest ECU after this many replies, as a multiple of its worst round
+# trip, but not below MinTimeout (in units of 4 ms)
+TuneWindow = 100
+TimeoutMargin = 2.0
+MinTimeout = 0x10
+
+# Learned frame count of a request whose reply got garbled by the count,
+# it is sent without one from then on
+CountUnsupported = -1
+
+# Polling interval of talk_to_dongle_async on transports without a file
+# descriptor, i.e. the emulator
+PollInterval = 0.001
+
+# ASCII hex digit of each ISO-TP sequence number, to check the order of
+# consecutive frames without converting the digit
+SeqDigits = b'0123456789ABCDEF'
+
+
+def reassemble(ret, extended=False, headers=True):
+    """ Reassemble the ISO-TP payload from the raw output of an ELM327
+        with CAN auto formatting, headers on or off, spaces on or off.
+        Works on the raw bytes: frame data is decoded straight into a
+        buffer preallocated to the length given by the first frame.
+        Raises ValueError on malformed output, NoData if there are no
+        frames and CanError on bad frame order or length. """
+    text = ret.translate(None, b' \n')
+    view = memoryview(text)
+    end = len(text)
+    offset = 8 if extended else 3
+
+    data = None
+    buf = None
+    data_len = pos = seq = 0
+    start = 0
+    while start < end:
+        line = start
+        eol = text.find(b'\r', start)
+        if eol < 0:
+            eol = end
+        start = eol + 1
+        if eol == line:
+            continue
+
+        if headers:
+            pci = line + offset
+            frame_type = text[pci]
+            if frame_type == 0x32:      # '2' consecutive frame
+                if data is None:
+                    raise ValueError(bytes(view[line:eol]))
+                if text[pci+1] != SeqDigits[seq]:
+                    raise CanError("Bad frame order: idx(%s) expected(%s)" %
+                                   (chr(text[pci+1]), chr(SeqDigits[seq])))
+                seq = (seq + 1) & 0xf
+                frame = pci + 2
+            elif frame_type == 0x31:    # '1' first frame
+                data_len = int(text[pci+1:pci+4], 16)
+                data = bytearray(data_len)
+                buf = memoryview(data)
+                seq = 1
+                frame = pci + 4
+            elif frame_type == 0x30:    # '0' single frame
+                data_len = int(text[pci+1:pci+2], 16)
+                data = a2b_hex(view[pci+2:pci+2+data_len*2])
+                pos = len(data)
+                break
+            else:                       # Unexpected frame
+                raise ValueError(bytes(view[line:eol]))
+        elif eol - line < 2 or text[line+1] != 0x3a:
+            if data is None and eol - line == 3:
+                # Headers off: a multi frame response starts with its length
+                data_len = int(text[line:eol], 16)
+                data = bytearray(data_len)
+                buf = memoryview(data)
+                continue
+            # Headers off single frame, the ELM already removed the PCI
+            data = a2b_hex(view[line:eol])
+            data_len = pos = len(data)
+            break
+        else:
+            # Headers off: frames are numbered '0:', '1:', ... from the
+            # first frame on
+            if data is None:
+                raise ValueError(bytes(view[line:eol]))
+            if text[line] != SeqDigits[seq]:
+                raise CanError("Bad frame order: idx(%s) expected(%s)" %
+                               (chr(text[line]), chr(SeqDigits[seq])))
+            seq = (seq + 1) & 0xf
+            frame = line + 2
+
+        size = (eol - frame) >> 1
+        if pos + size >= data_len:
+            # Last frame, cut off the padding
+            size = data_len - pos
+            buf[pos:] = a2b_hex(view[frame:frame+size*2])
+            pos = data_len
+            break
+        buf[pos:pos+size] = a2b_hex(view[frame:eol])
+        pos += size
+
+    if not data or data_len == 0:
+        raise NoData('NO DATA')
+
+    if data_len != pos:
+        raise CanError("Data length mismatch: %d vs %d %s" %
+                       (data_len, pos, bytes(data[:pos]).hex()))
+
+    return data
+
+
+def frame_count(length):
+    """ Number of CAN frames of an ISO-TP message of "length" bytes: a
+        single frame holds 7 bytes, a first frame 6 and every consecutive
+        frame 7 more """
+    if length <= 7:
+        return 1
+    return 1 + ceil((length - 6) / 7)
+
+
+async def wait_readable(transport, timeout):
+    """ Wait until "transport" has input or "timeout" passed, without
+        blocking the event loop. Transports without a file descriptor
+        are polled. """
+    if transport.in_waiting:
+        return
+    try:
+        fileno = transport.fileno()
+    except (AttributeError, OSError):
+        await asyncio.sleep(min(timeout, PollInterval))
+        return
+    await wait_fileno(fileno, timeout)
+
+
+async def wait_fileno(fileno, timeout):
+    """ Wait until the file descriptor "fileno" is readable or "timeout"
+        passed, without blocking the event loop """
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    loop.add_reader(fileno, lambda: ready.done() or ready.set_result(None))
+    try:
+        await asyncio.wait_for(ready, timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        loop.remove_reader(fileno)
+
+
 class Elm327:
     """ Implementation for ELM327 """
 
-    def __init__(self, config):
-        print(f"[DEBUG] Initializing ELM327 dongle on port {config['port']} with baudrate {config['baudrate']}...")
+    def __init__(self, config, transport=None):
+        """ "transport" replaces the serial port with an object offering
+            the same read/write/in_waiting/timeout interface.
+            config['capture'] names a file that records all traffic,
+            see dongle_log. config['uart_baudrate'] is a faster rate to
+            switch to with AT BRD; the rate that worked is kept in
+            config['baudrate_state'] and tried first on the next start.
+            config['response_count'] appends the expected number of frames
+            to requests, so the dongle answers without waiting for more;
+            config['tune_timeout'] lowers AT ST to what the ECUs need and
+            config['adaptive_timing'] selects AT AT0/1/2. """
+        self._port = config['port']
+        self._baudrate = config['baudrate']
+        self._warm_start = config.get('warm_start', True)
+        self._target_baudrate = config.get('uart_baudrate') \
+            if config.get('mode', 'uart') == 'uart' else None
+        self._baudrate_state = config.get('baudrate_state') if self._target_baudrate else None
+        baudrate = self._load_baudrate() or self._baudrate
+        print(f"[DEBUG] Initializing ELM327 dongle on port {config['port']} with baudrate {baudrate}...")
         self._serial_lock = Lock()
-        self._serial = serial.Serial(config['port'],
-                                     baudrate=config['baudrate'],
-                                     timeout=1)
+        # Coroutines awaiting the prompt must not block the loop on _serial_lock
+        self._async_lock = asyncio.Lock()
+        if transport is None:
+            transport = serial.Serial(config['port'],
+                                      baudrate=baudrate,
+                                      timeout=1)
+        self._serial = transport
+        try:
+            self._fileno = transport.fileno()
+        except (AttributeError, OSError, ValueError):
+            self._fileno = None
         self._config = config
+        self._timeout = config.get('timeout', 2.0)
+        self._late_prompt_timeout = 0.2
+        self._probe_timeout = 0.5
+        self._protocol = None
+        self._rx_buffer = bytearray()
+        self._awaiting_prompt = False
         self._current_canid = 0
         self._current_canfilter = 0
         self._current_canmask = 0
         self._is_extended = False
-        self._ret_no_data = (b'NO DATA', b'DATA ERROR', b'ACT ALERT')
+        self._headers = True
+        self._response_count = config.get('response_count', False)
+        self._tune_timeout = config.get('tune_timeout', True)
+        self._adaptive_timing = config.get('adaptive_timing', 1)
+        self._frames = {}
+        self._timeout_st = None
+        self._latency = {}
+        self._latency_samples = 0
+        self._metrics = metrics.Registry
+        self._at_count = 0
+        self.last_rtt = None
+        self._capture = None
+        if config.get('capture'):
+            print(f"[INFO] Capturing dongle traffic to {config['capture']}")
+            self._capture = CaptureLog(config['capture'])
+        self._ret_no_data = (b'NO DATA', b'DATA ERROR', b'ACT ALERT', b'TIMEOUT')
         self._ret_can_error = (b'BUFFER FULL', b'BUS BUSY', b'BUS ERROR', b'CAN ERROR',
                                b'ERR', b'FB ERROR', b'LP ALERT', b'LV RESET', b'STOPPED',
                                b'UNABLE TO CONNECT')
         self.init_dongle()
         print("[DEBUG] ELM327 dongle initialized successfully.")
 
-    def talk_to_dongle(self, cmd, expect=None):
-        """ Send command to dongle and return the response as string. """
-        print(f"[DEBUG] Sending command to dongle: {cmd}")
+    def talk_to_dongle(self, cmd, expect=None, timeout=None):
+        """ Send command to dongle and return the response as string.
+            Returns as soon as the ELM prompt arrives or the deadline
+            for this command has passed. """
+        cmd, timeout = self._prepare(cmd, timeout)
         try:
             with self._serial_lock:
-                # Input-Buffer komplett leeren (Alternative zu flushInput)
-                while self._serial.in_waiting:
-                    self._serial.read(self._serial.in_waiting)
-                    sleep(0.05)
-                self._serial.flushOutput()  # Output-Buffer leeren
-                self._serial.timeout = 0.5  # Set timeout for reading
-                
-                # Stelle sicher, dass cmd ein Byte-Objekt ist
-                if isinstance(cmd, str):
-                    cmd = (cmd + '\r').encode()  # String zu Bytes und Zeilenende anhängen
-                elif isinstance(cmd, bytes):
-                    if not cmd.endswith(b'\r'):
-                        cmd += b'\r'
-                self._serial.write(cmd)
-                ret = bytearray()
-                while expect is not None:
-                    if not self._serial.in_waiting:
-                        sleep(0.1)
-                        continue
-                    data = self._serial.read(self._serial.in_waiting)
-
-                    endidx = data.find(b'>')
-                    if endidx >= 0:
-                        ret.extend(data[:endidx])
-                        break
-
-                    ret.extend(data)
-
-                if expect and expect not in ret:
-                    print(f"[WARNING] Expected '{expect}', but got '{ret}'")
+                start = self._write(cmd)
+                ret = self._read_until_prompt(start + timeout)
+                ret = self._received(cmd, ret, start, timeout, expect)
 
         except serial.SerialTimeoutException:
             print("[ERROR] Serial timeout occurred while communicating with dongle.")
@@ -75,13 +256,163 @@ class Elm327:
         print(f"[DEBUG] Response from dongle: {ret}")
         return ret.strip(b'\r\n')
 
-    def send_at_cmd(self, cmd, expect=None):
-        """ Send AT command to dongle and return response. """
+    async def talk_to_dongle_async(self, cmd, expect=None, timeout=None):
+        """ Like talk_to_dongle, but awaits the prompt instead of blocking.
+            For a dongle used from a single event loop only. """
+        cmd, timeout = self._prepare(cmd, timeout)
+        try:
+            async with self._async_lock:
+                start = self._write(cmd)
+                ret = await self._read_until_prompt_async(start + timeout)
+                ret = self._received(cmd, ret, start, timeout, expect)
+
+        except serial.SerialTimeoutException:
+            print("[ERROR] Serial timeout occurred while communicating with dongle.")
+            ret = b'TIMEOUT'
+
+        print(f"[DEBUG] Response from dongle: {ret}")
+        return ret.strip(b'\r\n')
+
+    def _prepare(self, cmd, timeout):
+        """ Command line as bytes with line end, and its timeout """
+        print(f"[DEBUG] Sending command to dongle: {cmd}")
+        if timeout is None:
+            timeout = self._timeout
+
+        # Stelle sicher, dass cmd ein Byte-Objekt ist
+        if isinstance(cmd, str):
+            cmd = (cmd + '\r').encode()  # String zu Bytes und Zeilenende anhängen
+        elif isinstance(cmd, bytes):
+            if not cmd.endswith(b'\r'):
+                cmd += b'\r'
+        return cmd, timeout
+
+    def _write(self, cmd):
+        """ Send a command line, returns the time it was sent """
+        self._discard_stale_input()
+        start = monotonic()
+        self._serial.write(cmd)
+        return start
+
+    def _received(self, cmd, ret, start, timeout, expect):
+        """ Book the reply to a command, None if it timed out """
+        self.last_rtt = monotonic() - start
+        if self._capture:
+            self._capture.record(time(), self.last_rtt,
+                                 int(self._current_canid or '0', 16),
+                                 cmd, ret if ret is not None else b'')
+
+        if ret is None:
+            print(f"[WARNING] No prompt within {timeout}s for {cmd}")
+            self._metrics.count('elm_timeouts_total')
+            self._awaiting_prompt = True
+            ret = b'TIMEOUT'
+        elif expect and expect not in ret:
+            print(f"[WARNING] Expected '{expect}', but got '{ret}'")
+        return ret
+
+    def _read_until_prompt(self, deadline, prompt=b'>'):
+        """ Read from the serial port until the ELM prompt shows up.
+            Returns the bytes before the prompt, or None if the deadline
+            passed first. Bytes after the prompt stay in the receive buffer. """
+        buf = self._rx_buffer
+        end = buf.find(prompt)
+        while end < 0:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return None
+            # Return as soon as anything arrives, so there is no polling
+            # delay between the prompt and returning. Ports with a file
+            # descriptor are waited on with select: setting the timeout of
+            # pyserial reconfigures the port with an ioctl every time.
+            if self._fileno is not None:
+                select((self._fileno,), (), (), remaining)
+                chunk = self._serial.read(self._serial.in_waiting)
+            else:
+                self._serial.timeout = remaining
+                chunk = self._serial.read(self._serial.in_waiting or 1)
+            if chunk:
+                start = len(buf)
+                buf.extend(chunk)
+                end = buf.find(prompt, start)
+
+        ret = bytes(buf[:end])
+        del buf[:end + 1]
+        return ret
+
+    async def _read_until_prompt_async(self, deadline):
+        """ Like _read_until_prompt, awaiting input instead of blocking """
+        buf = self._rx_buffer
+        end = buf.find(b'>')
+        while end < 0:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return None
+            await wait_readable(self._serial, remaining)
+            waiting = self._serial.in_waiting
+            if waiting:
+                start = len(buf)
+                buf.extend(self._serial.read(waiting))
+                end = buf.find(b'>', start)
+
+        ret = bytes(buf[:end])
+        del buf[:end + 1]
+        return ret
+
+    def _discard_stale_input(self):
+        """ Drop replies that belong to earlier commands. If the last command
+            ran into its deadline, wait a little for its late prompt so the
+            late reply is not mistaken for the answer to the next command. """
+        if self._awaiting_prompt:
+            late = self._read_until_prompt(monotonic() + self._late_prompt_timeout)
+            if late is not None:
+                print(f"[DEBUG] Discarding late response: {late}")
+            else:
+                self._rx_buffer.clear()
+            self._awaiting_prompt = False
+
+        waiting = self._serial.in_waiting
+        if waiting:
+            self._rx_buffer.extend(self._serial.read(waiting))
+
+        end = self._rx_buffer.rfind(b'>')
+        if end >= 0:
+            del self._rx_buffer[:end + 1]
+
+    def _run(self, exchange):
+        """ Drive an exchange with the dongle: a generator that yields
+            (command, expect) and gets the response of talk_to_dongle
+            sent back. Returns what the generator returns. The same
+            exchanges run on an event loop with _run_async. """
+        try:
+            request = next(exchange)
+            while True:
+                request = exchange.send(self.talk_to_dongle(*request))
+        except StopIteration as stop:
+            return stop.value
+
+    async def _run_async(self, exchange):
+        """ Drive an exchange with talk_to_dongle_async """
+        try:
+            request = next(exchange)
+            while True:
+                request = exchange.send(await self.talk_to_dongle_async(*request))
+        except StopIteration as stop:
+            return stop.value
+
+    def _at(self, cmd, expect=None):
+        """ Exchange of an AT command """
         print(f"[DEBUG] Sending AT command: {cmd}")
-        ret = self.talk_to_dongle(cmd, expect)
+        self._at_count += 1
+        self._metrics.count('elm_at_commands_total')
+        ret = yield cmd, expect
         print(f"[DEBUG] AT command response: {ret}")
         return ret.split(b"\r\n")[-1]
 
+    def send_at_cmd(self, cmd, expect=None):
+        """ Send AT command to dongle and return response. """
+        return self._run(self._at(cmd, expect))
+
     def send_command(self, cmd):
         """ Convert bytearray "cmd" to string,
             send to dongle and parse the response. """
@@ -100,151 +431,328 @@ class Elm327:
         print(f"[DEBUG] Command response: {ret}")
         return ret
 
-    def send_command_ex(self, cmd, cantx, canrx):
+    def send_command_ex(self, cmd, cantx, canrx, canmask=None, frames=None):
         """ Convert bytearray "cmd" to string,
             send to dongle and parse the response.
-            Also handles filters and masks. """
+            Also handles filters and masks. "canmask" allows
+            a wider filter, so several ECUs can share one.
+            "frames" is the number of CAN frames the response is expected
+            to take; the count learned from earlier responses wins. """
+        return self._run(self._command_ex(cmd, cantx, canrx, canmask, frames))
+
+    async def send_command_ex_async(self, cmd, cantx, canrx, canmask=None, frames=None):
+        """ send_command_ex for the asyncio runtime """
+        return await self._run_async(self._command_ex(cmd, cantx, canrx, canmask, frames))
+
+    def _command_ex(self, cmd, cantx, canrx, canmask, frames):
+        """ Exchange of send_command_ex """
         print(f"[DEBUG] Sending extended command: {cmd.hex()}, CAN TX: {cantx}, CAN RX: {canrx}")
+        key = (cantx, cmd)
+        request_bytes = cmd
         cmd = cmd.hex()
-        self.set_can_id(cantx)
-        self.set_can_rx_filter(canrx)
-        self.set_can_rx_mask(0x1fffffff if self._is_extended else 0x7ff)
-
-        ret = self.talk_to_dongle(cmd)
+        count = self._frames.get(key, frames) if self._response_count else None
+        if count and 0 < count <= 0xf:
+            # The ELM prints the prompt right after this many frames
+            # instead of waiting out the AT ST timeout
+            request = cmd + '%X' % count
+        else:
+            request = cmd
+            count = None
+        metrics = self._metrics
+        full_mask = 0x1fffffff if self._is_extended else 0x7ff
+        canmask = full_mask if canmask is None else canmask & full_mask
+        start = perf_counter()
+        at_count = self._at_count
+        yield from self._set_id('AT SH', '_current_canid', cantx)
+        yield from self._set_id('AT CF', '_current_canfilter', canrx & canmask)
+        yield from self._set_id('AT CM', '_current_canmask', canmask)
+        if self._at_count != at_count:
+            metrics.observe('elm_at_setup_seconds', perf_counter() - start)
+
+        ret = yield request, None
+        metrics.observe('elm_rtt_seconds', self.last_rtt, cmd)
 
         if ret in self._ret_no_data:
             print("[WARNING] No data received from dongle.")
+            metrics.count('elm_no_data_total', cmd)
+            if self._frames.get(key) and self._timeout_st != 0xff:
+                # It answered before, the tuned timeout may be too short
+                yield from self._set_timeout(0xff)
             raise NoData(ret)
 
         if ret in self._ret_can_error:
             print("[ERROR] CAN error occurred.")
+            metrics.count('elm_can_error_total', cmd)
             raise CanError("Failed Command %s\n%s" % (cmd, ret))
 
         print(f"[DEBUG] Extended command response: {ret}")
 
         try:
-            data = None
-            data_len = 0
-            last_idx = 0
-            raw = str(ret, 'ascii').split('\r\n')
-
-            for line in raw:
-                if ((self._is_extended is False and len(line) != 19)
-                        or (self._is_extended is True and len(line) != 27)):
-                    raise ValueError
-
-                offset = 8 if self._is_extended else 3
-
-                frame_type = int(line[offset:offset+1], 16)
-
-                if frame_type == 0:     # Single frame
-                    print(f"%s single frame", line)
-                    data_len = int(line[offset+1:offset+2], 16)
-                    data = bytes.fromhex(line[offset+2:data_len*2+offset+2])
-                    break
-
-                elif frame_type == 1:   # First frame
-                    print(f"%s first frame", line)
-                    data_len = int(line[offset+1:offset+4], 16)
-                    data = bytearray.fromhex(line[offset+4:])
-                    last_idx = 0
-
-                elif frame_type == 2:   # Consecutive frame
-                    print(f"%s consecutive frame", line)
-                    idx = int(line[offset+1:offset+2], 16)
-                    if (last_idx + 1) % 0x10 != idx:
-                        raise CanError("Bad frame order: last_idx(%d) idx(%d)" %
-                                       (last_idx, idx))
-
-                    frame_len = min(7, data_len - len(data))
-                    data.extend(bytearray.fromhex(
-                        line[offset+2:frame_len*2+offset+2]))
-                    last_idx = idx
-
-                    if data_len == len(data):
-                        break
-
-                else:                   # Unexpected frame
-                    raise ValueError
-
-            if not data or data_len == 0:
-                raise NoData('NO DATA')
-
-            if data_len != len(data):
-                raise CanError("Data length mismatch %s: %d vs %d %s" %
-                               (cmd, data_len, len(data), data.hex()))
-
-        except ValueError:
+            start = perf_counter()
+            data = reassemble(ret, self._is_extended, self._headers)
+            metrics.observe('elm_reassembly_seconds', perf_counter() - start, cmd)
+        except NoData:
+            metrics.count('elm_no_data_total', cmd)
+            raise
+        except CanError:
+            metrics.count('elm_can_error_total', cmd)
+            if count:
+                # Cut short by a count too low, ask without one next time
+                metrics.count('elm_frame_count_misses_total', cmd)
+                self._frames[key] = 0
+            raise
+        except (ValueError, IndexError):
+            metrics.count('elm_can_error_total', cmd)
+            if count:
+                # Clones without the count answer '?' or garbage, retry
+                # without it
+                metrics.count('elm_frame_count_misses_total', cmd)
+                if ret == b'?':
+                    print("[WARNING] Dongle does not support response counts, turning them off")
+                    self._response_count = False
+                else:
+                    self._frames[key] = CountUnsupported
+                return (yield from self._command_ex(request_bytes, cantx, canrx, canmask, frames))
             raise CanError("Failed Command %s\n%s" % (cmd, ret))
 
+        if self._response_count and self._frames.get(key) != CountUnsupported:
+            frames = self._frames[key] = frame_count(len(data))
+            if frames == count:
+                yield from self._track_latency(cantx)
         return data
 
+    def _track_latency(self, cantx):
+        """ Keep the worst round trip per ECU of replies that ended with
+            their last frame, and set AT ST from the slowest ECU once per
+            TuneWindow replies. AT ST applies to all ECUs, switching it
+            with the header would cost more than it saves. """
+        if not self._tune_timeout:
+            return
+        if self.last_rtt > self._latency.get(cantx, 0.0):
+            self._latency[cantx] = self.last_rtt
+        self._latency_samples += 1
+        if self._latency_samples >= TuneWindow:
+            worst = max(self._latency.values())
+            self._latency.clear()
+            self._latency_samples = 0
+            yield from self._set_timeout(min(0xff, max(MinTimeout, ceil(worst * TimeoutMargin / 0.004))))
+
+    def _set_timeout(self, value):
+        """ Set the response timeout AT ST in units of 4 ms """
+        if value != self._timeout_st:
+            print(f"[INFO] Setting response timeout to {value * 4} ms")
+            yield from self._at('AT ST %02X' % value)
+            self._timeout_st = value
+            self._metrics.gauge('elm_response_timeout_seconds', value * 0.004)
+
+    def probe_dongle(self):
+        """ Ask the dongle for its protocol number (AT DPN) and look at the
+            raw reply: echo and line ends show the current E and L settings.
+            Returns (echo, linefeeds, protocol) or None if the dongle does
+            not answer in time or not as expected. """
+        with self._serial_lock:
+            self._discard_stale_input()
+            self._serial.write(b'AT DPN\r')
+            ret = self._read_until_prompt(monotonic() + self._probe_timeout)
+        print(f"[DEBUG] Probe response: {ret}")
+        if ret is None:
+            self._awaiting_prompt = True
+            return None
+        echo = b'DPN' in ret
+        lines = [line.strip() for line in ret.replace(b'\n', b'').split(b'\r')
+                 if line.strip() and b'DPN' not in line]
+        if len(lines) != 1 or not 1 <= len(lines[0]) <= 2 or \
+                lines[0].strip(b'0123456789ABC') not in (b'', b'A'):
+            return None
+        return echo, b'\n' in ret, lines[0].decode()
+
     def init_dongle(self):
-        """ Send some initializing commands to the dongle. """
+        """ Send some initializing commands to the dongle.
+            A dongle that answers a probe is not reset: if it still has the
+            settings of an earlier run (i.e. after a restart of the service)
+            only the reply format is set again, otherwise all settings. The
+            full reset is the fallback for dongles that do not answer sanely. """
         print("[DEBUG] Initializing dongle with AT commands...")
-        cmds = (('AT D', None),  # Set all settings to default
-                ('AT Z', None), #'ELM327'),
-                ('AT E0', None), #'OK'),
-                ('AT L1', None), #'OK'),
-                ('AT S0', None), #'OK'),
-                ('AT H1', None), #'OK'),
-                ('AT ST FF', None), #'OK'),
-                ('AT FE', None), #'OK'))
-                )
-
+        started = monotonic()
+        probe = self.probe_dongle() if self._warm_start else None
+        if probe is None and getattr(self._serial, 'baudrate', None) not in (None, self._baudrate):
+            # The remembered rate is gone once the dongle lost power,
+            # it starts at the configured rate again
+            print(f"[INFO] No probe at {self._serial.baudrate} baud, "
+                  f"falling back to {self._baudrate}")
+            if not self._warm_start:
+                # Not probed: it may still run at the remembered rate,
+                # AT Z takes it back to the power on rate
+                with self._serial_lock:
+                    self._serial.write(b'AT Z\r')
+            self._set_uart_baudrate(self._baudrate)
+            self._awaiting_prompt = True
+            probe = self.probe_dongle() if self._warm_start else None
+        if probe is None:
+            cmds = (('AT D', None),  # Set all settings to default
+                    ('AT Z', None), #'ELM327'),
+                    ('AT E0', None), #'OK'),
+                    ('AT L1', None), #'OK'),
+                    ('AT S0', None), #'OK'),
+                    ('AT H1', None), #'OK'),
+                    ('AT ST FF', None), #'OK'),
+                    ('AT FE', None), #'OK'))
+                    )
+            self._protocol = None
+            self._timeout_st = 0xff
+        else:
+            echo, linefeeds, self._protocol = probe
+            # The probe can not tell spaces and headers, another tool may
+            # have changed them. Both are set again, that costs little.
+            # The timeout may still be tuned down by the last run, it
+            # starts over from the maximum.
+            # Header, filter and mask are set with the first request.
+            cmds = ((('AT E0', None),) if echo else ()) + \
+                   ((('AT L1', None),) if not linefeeds else ()) + \
+                   (('AT S0', None), ('AT H1', None), ('AT ST FF', None))
+            self._timeout_st = 0xff
+            if echo or not linefeeds:
+                # Echo on or linefeeds off are the power on defaults, the
+                # dongle was reset since our last run
+                cmds += (('AT FE', None),)
+            print(f"[DEBUG] Warm start, protocol {self._protocol}, {len(cmds)} settings to apply")
+
+        if cmds and self._adaptive_timing != 1:
+            # AT AT1 is the default
+            cmds += (('AT AT%d' % self._adaptive_timing, None),)
         for cmd, exp in cmds:
             print(f"[DEBUG] Sending initialization command: {cmd}")
             self.send_at_cmd(cmd, exp)
+        if self._target_baudrate and self._serial.baudrate != self._target_baudrate:
+            # AT Z went back to the power on rate, or the rate was never raised
+            self.negotiate_baudrate(self._target_baudrate)
+        self._metrics.gauge('elm_init_seconds', round(monotonic() - started, 3))
+        self._metrics.gauge('elm_warm_start', int(probe is not None))
         print("[DEBUG] Dongle initialization complete.")
 
+    def negotiate_baudrate(self, baudrate):
+        """ Switch the UART to "baudrate" with the AT BRD handshake: the
+            dongle answers OK, changes its rate and sends its id. If we
+            receive the id at the new rate, a carriage return confirms it.
+            Otherwise the dongle goes back to the old rate by itself after
+            the AT BRT timeout, and so do we. Returns True on success. """
+        old = self._serial.baudrate
+        divisor = round(BrdClock / baudrate)
+        if not 8 <= divisor <= 0xff:
+            print(f"[ERROR] Baudrate {baudrate} not possible with AT BRD")
+            return False
+        print(f"[INFO] Switching dongle from {old} to {baudrate} baud")
+        with self._serial_lock:
+            self._discard_stale_input()
+            self._serial.write(b'AT BRD %02X\r' % divisor)
+            ret = self._read_until_prompt(monotonic() + self._probe_timeout, b'\r')
+            if ret is None or b'OK' not in ret:
+                # i.e. '?' from clones that do not support it
+                print(f"[WARNING] Dongle refused AT BRD: {ret}")
+                self._awaiting_prompt = True
+                return False
+
+            self._set_uart_baudrate(baudrate)
+            ident = self._read_until_prompt(monotonic() + self._probe_timeout, b'\r')
+            if ident is None or b'ELM' not in ident:
+                print(f"[WARNING] No id at {baudrate} baud: {ident}, staying at {old}")
+                self._set_uart_baudrate(old)
+                self._awaiting_prompt = True
+                return False
+
+            self._serial.write(b'\r')
+            ret = self._read_until_prompt(monotonic() + self._probe_timeout)
+            if ret is None:
+                print(f"[WARNING] Dongle did not confirm {baudrate} baud, staying at {old}")
+                self._set_uart_baudrate(old)
+                self._awaiting_prompt = True
+                return False
+
+        print(f"[INFO] Dongle runs at {baudrate} baud")
+        self._save_baudrate(baudrate)
+        return True
+
+    def _set_uart_baudrate(self, baudrate):
+        """ Change the rate of our end of the UART, dropping the rest of
+            what was received at the old rate """
+        self._serial.baudrate = baudrate
+        self._rx_buffer.clear()
+
+    def _load_baudrate(self):
+        """ Rate that worked for this port last time, or None """
+        if not self._baudrate_state:
+            return None
+        try:
+            with open(self._baudrate_state) as file:
+                state = json.load(file)
+            if state.get('port') == self._port:
+                return state.get('baudrate')
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError) as err:
+            print(f"[WARNING] Ignoring baudrate state {self._baudrate_state}: {err}")
+        return None
+
+    def _save_baudrate(self, baudrate):
+        """ Remember the rate that worked for the next start """
+        if not self._baudrate_state:
+            return
+        tmp_file = self._baudrate_state + '.tmp'
+        try:
+            with open(tmp_file, 'w') as file:
+                json.dump({'port': self._port, 'baudrate': baudrate}, file)
+            os.replace(tmp_file, self._baudrate_state)
+        except OSError as err:
+            print(f"[WARNING] Could not write baudrate state {self._baudrate_state}: {err}")
+
     def set_protocol(self, prot):
-        """ Set the variant of CAN protocol """
+        """ Set the variant of CAN protocol, unless the dongle uses it already """
         print(f"[DEBUG] Setting protocol: {prot}")
         if prot == 'CAN_11_500':
-            self.send_at_cmd('AT SP 6', None) #'OK')
+            protocol = '6'
             self._is_extended = False
         elif prot == 'CAN_29_500':
-            self.send_at_cmd('AT SP 7', None) #'OK')
+            protocol = '7'
             self._is_extended = True
         else:
             print(f"[ERROR] Unsupported protocol: {prot}")
             raise ValueError(f"Unsupported protocol {prot}")
+        if self._protocol != protocol:
+            self.send_at_cmd('AT SP ' + protocol, None) #'OK')
+            self._protocol = protocol
 
-    def set_can_id(self, can_id):
-        """ Set CAN id to use for sent frames """
-        print(f"[DEBUG] Setting CAN ID: {can_id}")
+    def _set_id(self, at_cmd, attr, can_id):
+        """ Exchange setting a CAN id with "at_cmd", unless the dongle
+            has it already. "attr" keeps the current value. """
         if isinstance(can_id, bytes):
             can_id = str(can_id)
         elif isinstance(can_id, int):
             can_id = format(can_id, '08X' if self._is_extended else '03X')
 
-        if self._current_canid != can_id:
-            self.send_at_cmd('AT SH ' + can_id)
-            self._current_canid = can_id
+        if getattr(self, attr) != can_id:
+            yield from self._at(at_cmd + ' ' + can_id)
+            setattr(self, attr, can_id)
+
+    def set_can_id(self, can_id):
+        """ Set CAN id to use for sent frames """
+        print(f"[DEBUG] Setting CAN ID: {can_id}")
+        self._run(self._set_id('AT SH', '_current_canid', can_id))
 
     def set_can_rx_mask(self, mask):
         """ Set the CAN id mask for receiving frames """
         print(f"[DEBUG] Setting CAN RX mask: {mask}")
-        if isinstance(mask, bytes):
-            mask = str(mask)
-        elif isinstance(mask, int):
-            mask = format(mask, '08X' if self._is_extended else '03X')
-
-        if self._current_canmask != mask:
-            self.send_at_cmd('AT CM ' + mask)
-            self._current_canmask = mask
+        self._run(self._set_id('AT CM', '_current_canmask', mask))
 
     def set_can_rx_filter(self, can_id):
         """ Set the CAN id filter for receiving frames """
         print(f"[DEBUG] Setting CAN RX filter: {can_id}")
-        if isinstance(can_id, bytes):
-            can_id = str(can_id)
-        elif isinstance(can_id, int):
-            can_id = format(can_id, '08X' if self._is_extended else '03X')
+        self._run(self._set_id('AT CF', '_current_canfilter', can_id))
 
-        if self._current_canfilter != can_id:
-            self.send_at_cmd('AT CF ' + can_id)
-            self._current_canfilter = can_id
+    def close(self):
+        """ Close the capture file """
+        if self._capture:
+            self._capture.close()
+            self._capture = None
 
     def get_obd_voltage(self):
         """ Get the voltage at the OBD port """
@@ -0,0 +1,367 @@
+""" ELM327 emulator on a pseudo terminal, answering with recorded ECU
+    responses. Lets the dongle, decoder and car code run without a car:
+
+        python3 elm327_emulator.py --link /tmp/ttyELM
+
+    and point "obd.port" in config.json to /tmp/ttyELM. """
+from threading import Thread
+from time import monotonic, sleep
+import argparse
+import os
+import random
+import select
+import tty
+
+from elm327 import BrdClock, DefaultBaudrate
+import ioniq_traces
+
+ELM_VERSION = b'ELM327 v1.5'
+
+
+def same_rate(rate, other):
+    """ Check if two UARTs at these rates understand each other; a few
+        percent off is fine, AT BRD 23 gives 114286 for 115200 baud """
+    return rate is None or other is None or abs(rate - other) <= 0.03 * other
+
+
+class Elm327Emulator:
+    """ Command interpreter of an ELM327 with a set of ECUs behind it.
+        "responses" maps (request id, command bytes) to ISO-TP payloads.
+        "latency" is the ECU response time in seconds, "latencies" overrides
+        it per command (hex string, i.e. '2101'). "no_data_rate" and
+        "can_error_rate" inject failures with the given probability.
+        With "settle" the emulator also spends the time a real ELM waits
+        for further frames when a request has no response count, and the
+        AT ST timeout before NO DATA. """
+
+    def __init__(self, responses=None, latency=0.0, latencies=None,
+                 no_data_rate=0.0, can_error_rate=0.0, seed=None, settle=False):
+        self.responses = ioniq_traces.Responses if responses is None else responses
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.no_data_rate = no_data_rate
+        self.can_error_rate = can_error_rate
+        self.settle = settle
+        self._random = random.Random(seed)
+        self.commands = 0
+        self.baudrate = DefaultBaudrate
+        self._switch = None
+        self.reset()
+
+    def reset(self):
+        """ Restore the power-on settings (AT Z / AT D) """
+        self.echo = True
+        self.linefeeds = False
+        self.spaces = True
+        self.headers = False
+        self.extended = False
+        self.protocol = 0
+        self.timeout = 0x32
+        self.header = None
+        self.rx_filter = None
+        self.rx_mask = None
+        self.brt = 0x0f
+        self.adaptive = 1
+
+    def eol(self):
+        """ Line end as configured with AT L """
+        return b'\r\n' if self.linefeeds else b'\r'
+
+    def handle(self, line):
+        """ Process one command line (without '\\r') and return everything
+            the ELM prints for it, up to and including the prompt. """
+        return b''.join(data for _, data in self.respond(line))
+
+    def respond(self, line, baudrate=None):
+        """ Like handle, but returns the output as (UART rate, bytes) chunks,
+            as AT BRD switches the rate in the middle of its reply.
+            "baudrate" is the rate the line was sent with, None if it
+            matches the current rate of the emulator. """
+        if self._switch is not None:
+            return self.confirm_baudrate(line, baudrate)
+        if not same_rate(baudrate, self.baudrate):
+            return []   # Garbled, the ELM does not see a command
+        self.commands += 1
+        cmd = line.replace(b' ', b'').upper()
+        out = line + self.eol() if self.echo else b''
+
+        if cmd.startswith(b'AT'):
+            reply = self.at_command(cmd[2:])
+        elif cmd:
+            reply = self.obd_request(cmd)
+        else:
+            reply = b''
+
+        if self._switch is not None:
+            # AT BRD: OK at the old rate, the id at the new rate, then
+            # wait for the host to answer at the new rate
+            return [(self._switch[1], out + reply + self.eol()),
+                    (self._switch[0], ELM_VERSION + b'\r')]
+        if reply:
+            out += reply + self.eol()
+        return [(self.baudrate, out + self.eol() + b'>')]
+
+    def confirm_baudrate(self, line, baudrate):
+        """ Finish AT BRD: a carriage return at the new rate within the
+            AT BRT time keeps the new rate, anything else reverts it """
+        new, old, deadline = self._switch
+        self._switch = None
+        if line == b'' and same_rate(baudrate, new) and monotonic() <= deadline:
+            self.baudrate = new
+            return [(new, b'OK' + self.eol() + self.eol() + b'>')]
+        return [(old, self.eol() + b'>')]
+
+    def at_command(self, cmd):
+        """ Handle the AT commands used by Elm327 and return the reply """
+        flags = {b'E': 'echo', b'L': 'linefeeds', b'S': 'spaces', b'H': 'headers'}
+        if cmd in (b'D', b'Z', b'WS'):
+            self.reset()
+            if cmd == b'Z':
+                # A full reset also drops a rate set with AT BRD
+                self.baudrate = DefaultBaudrate
+            return b'OK' if cmd == b'D' else self.eol() + ELM_VERSION
+        if cmd in (b'I', b'@1'):
+            return ELM_VERSION if cmd == b'I' else b'OBDII to RS232 Interpreter'
+        if cmd == b'RV':
+            return b'12.4V'
+        if cmd == b'DPN':
+            return b'%X' % self.protocol
+        if cmd == b'FE':
+            return b'OK'
+        if cmd.startswith(b'BRD') and len(cmd) == 5:
+            divisor = int(cmd[3:], 16)
+            if not divisor:
+                return b'?'
+            # The host has AT BRT * 5 ms to answer at the new rate
+            self._switch = (round(BrdClock / divisor), self.baudrate,
+                            monotonic() + self.brt * 0.005)
+            return b'OK'
+        if cmd.startswith(b'BRT') and len(cmd) == 5:
+            self.brt = int(cmd[3:], 16) or 0x100
+            return b'OK'
+        if cmd[:1] in flags and cmd[1:] in (b'0', b'1'):
+            setattr(self, flags[cmd[:1]], cmd[1:] == b'1')
+            return b'OK'
+        try:
+            if cmd.startswith(b'SP') and len(cmd) == 3:
+                self.protocol = int(cmd[2:], 16)
+                self.extended = self.protocol in (7, 9)
+                return b'OK'
+            if cmd.startswith(b'ST') and len(cmd) == 4:
+                self.timeout = int(cmd[2:], 16)
+                return b'OK'
+            if cmd.startswith(b'AT') and cmd[2:] in (b'0', b'1', b'2'):
+                self.adaptive = int(cmd[2:])
+                return b'OK'
+            if cmd.startswith(b'SH'):
+                self.header = int(cmd[2:], 16)
+                return b'OK'
+            if cmd.startswith(b'CF'):
+                self.rx_filter = int(cmd[2:], 16)
+                return b'OK'
+            if cmd.startswith(b'CM'):
+                self.rx_mask = int(cmd[2:], 16)
+                return b'OK'
+        except ValueError:
+            pass
+        return b'?'
+
+    def accepts(self, can_id):
+        """ Check a response id against the receive filter and mask """
+        if self.rx_filter is None:
+            return True
+        mask = self.rx_mask if self.rx_mask is not None else (0x1fffffff if self.extended else 0x7ff)
+        return can_id & mask == self.rx_filter & mask
+
+    def wait(self, latency):
+        """ Time a real ELM waits for more frames after the last one: the
+            AT ST timeout, or less with adaptive timing, which goes by the
+            response times it has seen """
+        timeout = (self.timeout or 0x100) * 0.004
+        if self.adaptive:
+            timeout = min(timeout, latency * (3 - self.adaptive) + 0.004)
+        return timeout
+
+    def obd_request(self, cmd):
+        """ Answer a request from the recorded responses. An odd digit at
+            the end is the number of frames to wait for. """
+        count = None
+        if len(cmd) % 2:
+            cmd, count = cmd[:-1], int(cmd[-1:], 16)
+        try:
+            request = bytes.fromhex(cmd.decode())
+        except ValueError:
+            return b'?'
+        if not self.protocol:
+            return b'UNABLE TO CONNECT'
+
+        latency = self.latencies.get(cmd.decode().lower(), self.latency)
+        if latency:
+            sleep(latency)
+
+        if self.can_error_rate and self._random.random() < self.can_error_rate:
+            return b'CAN ERROR'
+        payload = self.responses.get((self.header, request))
+        canrx = (self.header or 0) + 8
+        if (payload is None or not self.accepts(canrx) or
+                (self.no_data_rate and self._random.random() < self.no_data_rate)):
+            if self.settle:
+                sleep(max(0.0, (self.timeout or 0x100) * 0.004 - latency))
+            return b'NO DATA'
+
+        if self.settle and (not count or count > len(ioniq_traces.isotp_frames(payload))):
+            sleep(self.wait(latency))
+        return ioniq_traces.elm_response(payload, canrx, self.headers, self.spaces,
+                                         self.linefeeds, self.extended,
+                                         count or None).rstrip(b'\r\n')
+
+
+class EmulatedSerial:
+    """ In-process stand-in for serial.Serial talking to an Elm327Emulator,
+        for Elm327(config, transport=EmulatedSerial()). Replies are
+        available as soon as the command is written. Output sent at
+        another UART rate than "baudrate" reads as garbage, so AT BRD
+        can be tested. """
+
+    def __init__(self, emulator=None, baudrate=DefaultBaudrate):
+        self.emulator = emulator or Elm327Emulator()
+        self.baudrate = baudrate
+        self.timeout = 1
+        self._pending = bytearray()
+        self._output = bytearray()
+        self._chunks = []
+
+    @property
+    def in_waiting(self):
+        """ Number of bytes ready to be read """
+        if not self._output and self._chunks:
+            return len(self._chunks[0][1])
+        return len(self._output)
+
+    def write(self, data):
+        """ Feed data to the emulator """
+        self._pending.extend(data)
+        while True:
+            end = self._pending.find(b'\r')
+            if end < 0:
+                break
+            line = bytes(self._pending[:end]).strip(b'\n')
+            del self._pending[:end + 1]
+            chunks = self.emulator.respond(line, self.baudrate)
+            if len(chunks) == 1 and not self._chunks and same_rate(chunks[0][0], self.baudrate):
+                self._output.extend(chunks[0][1])
+            else:
+                self._chunks.extend(chunks)
+        return len(data)
+
+    def read(self, size=1):
+        """ Read up to "size" bytes. Never blocks, the emulator answers
+            synchronously. """
+        if not self._output and self._chunks:
+            # The UART decodes at the rate set when the bytes arrive, the
+            # next chunk comes after the reader had a chance to switch
+            rate, data = self._chunks.pop(0)
+            self._output.extend(data if same_rate(rate, self.baudrate) else b'\xff' * len(data))
+        data = bytes(self._output[:size])
+        del self._output[:size]
+        return data
+
+    def close(self):
+        """ Nothing to release """
+
+
+class PtyEmulator:
+    """ Runs an Elm327Emulator on a pseudo terminal. "link" creates a
+        symlink to the terminal like socat does, "baudrate" paces the
+        output like a serial line of that speed. """
+
+    def __init__(self, emulator=None, link=None, baudrate=None):
+        self.emulator = emulator or Elm327Emulator()
+        self.link = link
+        self.baudrate = baudrate
+        self.port = None
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        """ Create the terminal and start answering. Returns the port name. """
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        if self.link:
+            if os.path.islink(self.link):
+                os.unlink(self.link)
+            os.symlink(self.port, self.link)
+        self._running = True
+        self._thread = Thread(target=self.run, name="EVNotiPi/ELM327-Emulator", daemon=True)
+        self._thread.start()
+        return self.link or self.port
+
+    def stop(self):
+        """ Stop answering and remove the terminal """
+        self._running = False
+        if self._thread:
+            self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+        if self.link and os.path.islink(self.link):
+            os.unlink(self.link)
+
+    def write(self, data):
+        """ Write to the terminal, paced to the baud rate """
+        if self.baudrate:
+            sleep(len(data) * 10 / self.baudrate)
+        os.write(self._master, data)
+
+    def run(self):
+        """ The emulator thread """
+        pending = bytearray()
+        while self._running:
+            readable, _, _ = select.select([self._master], [], [], 0.1)
+            if not readable:
+                continue
+            pending.extend(os.read(self._master, 1024))
+            while True:
+                end = pending.find(b'\r')
+                if end < 0:
+                    break
+                line = bytes(pending[:end]).strip(b'\n')
+                del pending[:end + 1]
+                for rate, data in self.emulator.respond(line):
+                    if self.baudrate:
+                        # Pace at the rate the emulator switched to
+                        self.baudrate = rate
+                    self.write(data)
+
+
+def main():
+    """ Run the emulator until interrupted """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--link', default='/tmp/ttyELM', help="symlink to the terminal")
+    parser.add_argument('--baudrate', type=int, help="pace output like a serial line")
+    parser.add_argument('--latency', type=float, default=0.02, help="ECU response time [s]")
+    parser.add_argument('--no-data-rate', type=float, default=0.0)
+    parser.add_argument('--can-error-rate', type=float, default=0.0)
+    parser.add_argument('--settle', action='store_true',
+                        help="wait for more frames and NO DATA like a real ELM")
+    args = parser.parse_args()
+
+    pty = PtyEmulator(Elm327Emulator(latency=args.latency,
+                                     no_data_rate=args.no_data_rate,
+                                     can_error_rate=args.can_error_rate,
+                                     settle=args.settle),
+                      link=args.link, baudrate=args.baudrate)
+    print(f"[INFO] ELM327 emulator listening on {pty.start()}")
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pty.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,87 @@
 """ Interface to gpsd """
+from calendar import timegm
+from datetime import datetime
 from threading import Thread
-from time import sleep, strptime, mktime
+from time import sleep
 import json
 import socket
 
+# Fields of a fix
+FixFields = ('device', 'mode', 'latitude', 'longitude', 'speed', 'altitude',
+             'time', 'xdop', 'ydop', 'vdop', 'tdop', 'hdop', 'gdop', 'pdop')
+
+# Longest report kept while waiting for the rest of the line, gpsd reports
+# with many satellites are a few kB
+MaxLineLength = 65536
+
+
+class Fix:
+    """ Immutable fix. Fields read as attributes or like the dict this
+        used to be, i.e. fix['mode']. A new fix replaces the old one
+        instead of changing it, so readers always see a consistent fix. """
+    __slots__ = FixFields
+
+    def __init__(self, **values):
+        for name in FixFields:
+            object.__setattr__(self, name, values.get(name))
+        if self.mode is None:
+            object.__setattr__(self, 'mode', 0)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Fix is read-only")
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except (AttributeError, TypeError):
+            raise KeyError(name) from None
+
+    def get(self, name, default=None):
+        """ Return a field like dict.get """
+        return getattr(self, name, default)
+
+    def replace(self, **changes):
+        """ Return a copy with some fields changed """
+        values = {name: getattr(self, name) for name in FixFields}
+        values.update(changes)
+        return Fix(**values)
+
+    def __repr__(self):
+        return 'Fix(%s)' % ', '.join('%s=%r' % (name, getattr(self, name))
+                                     for name in FixFields)
+
+
+# A fix without any data
+EmptyFix = Fix()
+
 
 def empty_fix():
     """ Return an empty fix so all fields are guaranteed to exist. """
-    return {
-        'device': None,
-        'mode': 0,
-        'latitude': None,
-        'longitude': None,
-        'speed': None,
-        'altitude': None,
-        'time': None,
-        'xdop': None,
-        'ydop': None,
-        'vdop': None,
-        'tdop': None,
-        'hdop': None,
-        'gdop': None,
-        'pdop': None,
-    }
+    return EmptyFix
+
+
+# Date of the last timestamp and its midnight in seconds since the epoch
+_last_day = (None, None)
+
+
+def parse_time(text):
+    """ Seconds since the epoch of a UTC time in ISO 8601 as sent by gpsd,
+        i.e. 2024-05-01T12:34:56.000Z. The common form is sliced at fixed
+        positions, the date is only converted when it changes. Returns
+        None if the time can not be parsed. """
+    global _last_day
+    try:
+        if len(text) >= 20 and text[10] == 'T' and text[-1] == 'Z':
+            day, midnight = _last_day
+            if text[:10] != day:
+                day = text[:10]
+                midnight = timegm((int(day[:4]), int(day[5:7]), int(day[8:10]), 0, 0, 0))
+                _last_day = (day, midnight)
+            return (midnight + int(text[11:13]) * 3600 + int(text[14:16]) * 60
+                    + float(text[17:-1]))
+        return datetime.fromisoformat(text.replace('Z', '+00:00')).timestamp()
+    except (ValueError, TypeError):
+        return None
 
 
 class GpsPoller:
@@ -31,7 +90,8 @@ class GpsPoller:
     def __init__(self):
         self._thread = None
         self._gpsd = ('localhost', 2947)
-        self._last_fix = empty_fix()
+        self._last_fix = EmptyFix
+        self._buffer = b''
         self._running = False
 
     def run(self):
@@ -42,40 +102,9 @@ class GpsPoller:
             try:
                 if gps_sock:
                     data = gps_sock.recv(4096)
-                    for line in data.split(b'\r\n'):
-                        if len(line) == 0:
-                            continue
-                        try:
-                            fix = json.loads(line)
-                            if 'class' not in fix:
-                                continue
-
-                            if fix['class'] == 'TPV':
-                                fix_time = mktime(strptime(fix['time'][:23],
-                                                           "%Y-%m-%dT%H:%M:%S.%f"))
-
-                                self._last_fix.update({
-                                    'device':    fix['device'],
-                                    'mode':      fix['mode'],
-                                    'latitude':  fix.get('lat'),
-                                    'longitude': fix.get('lon'),
-                                    'speed':     fix.get('speed'),
-                                    'altitude':  fix.get('alt'),
-                                    'time':      fix_time,
-                                })
-                            elif fix['class'] == 'SKY':
-                                self._last_fix.update({
-                                    'xdop': fix.get('xdop', None),
-                                    'ydop': fix.get('ydop', None),
-                                    'vdop': fix.get('vdop', None),
-                                    'tdop': fix.get('tdop', None),
-                                    'hdop': fix.get('hdop', None),
-                                    'gdop': fix.get('gdop', None),
-                                    'pdop': fix.get('pdop', None),
-                                })
-
-                        except json.decoder.JSONDecodeError:
-                            pass  # Ignore JSON decode errors
+                    if not data:
+                        raise ConnectionResetError
+                    self.feed(data)
                 else:
                     gps_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                     gps_sock.connect(self._gpsd)
@@ -87,11 +116,64 @@ class GpsPoller:
             except (StopIteration, ConnectionResetError, OSError):
                 gps_sock.close()
                 gps_sock = None
-                self._last_fix = empty_fix()
+                self.reset()
                 sleep(1)
 
+    @property
+    def gpsd(self):
+        """ Host and port of gpsd """
+        return self._gpsd
+
+    def feed(self, data):
+        """ Take data received from gpsd. Reports are separated by newlines,
+            a report cut off at the end is kept until the rest arrives. """
+        lines = (self._buffer + data).split(b'\n')
+        self._buffer = lines.pop()
+        if len(self._buffer) > MaxLineLength:
+            print("[WARNING] Dropping overlong report from gpsd")
+            self._buffer = b''
+        for line in lines:
+            self.update(line.rstrip(b'\r'))
+
+    def update(self, line):
+        """ Take one JSON report of gpsd into the fix """
+        if len(line) == 0:
+            return
+        try:
+            report = json.loads(line)
+        except ValueError:
+            return  # Ignore JSON decode errors
+        if not isinstance(report, dict):
+            return
+
+        # The new fix is swapped in with a single assignment
+        report_class = report.get('class')
+        if report_class == 'TPV':
+            self._last_fix = self._last_fix.replace(
+                device=report.get('device'),
+                mode=report.get('mode', 0),
+                latitude=report.get('lat'),
+                longitude=report.get('lon'),
+                speed=report.get('speed'),
+                altitude=report.get('alt'),
+                time=parse_time(report['time']) if 'time' in report else None)
+        elif report_class == 'SKY':
+            self._last_fix = self._last_fix.replace(
+                xdop=report.get('xdop'),
+                ydop=report.get('ydop'),
+                vdop=report.get('vdop'),
+                tdop=report.get('tdop'),
+                hdop=report.get('hdop'),
+                gdop=report.get('gdop'),
+                pdop=report.get('pdop'))
+
+    def reset(self):
+        """ Forget the fix, i.e. when gpsd went away """
+        self._buffer = b''
+        self._last_fix = EmptyFix
+
     def fix(self):
-        """ Return the last fix. """
+        """ Return the last fix. It does not change, read it once per use. """
         return self._last_fix
 
     def start(self):
@@ -1,6 +1,7 @@
 """ Module for the Hyundai Ioniq Electric 28kWh """
 from car import Car
 from isotp_decoder import IsoTpDecoder
+from battery_pack import BatteryPack
 from elm327 import NoData, CanError
 
 b2101 = bytes.fromhex('2101')
@@ -12,18 +13,18 @@ b2180 = bytes.fromhex('2180')
 b22b002 = bytes.fromhex('22b002')
 
 Fields = (
-    {'cmd': b2101, 'canrx': 0x7ec, 'cantx': 0x7e4,
+    {'cmd': b2101, 'canrx': 0x7ec, 'cantx': 0x7e4, 'period': .25,
      'fields': (
          {'padding': 6},
          {'name': 'SOC_BMS', 'width': 1, 'scale': .5, "units": "%"},
-         {'name': 'availableChargePower', 'width': 2, 'scale': .01,'units': "kW"},
-         {'name': 'availableDischargePower', 'width': 2, 'scale': .01,'units': "kW"},
+         {'name': 'availableChargePower', 'width': 2, 'scale': .01,'units': "kW", 'deadband_rel': .02},
+         {'name': 'availableDischargePower', 'width': 2, 'scale': .01,'units': "kW", 'deadband_rel': .02},
          {'name': 'charging_bits', 'width': 1},
          {'name': 'dcBatteryCurrent', 'width': 2, 'signed': True, 'scale': .1, 'units': "A"},
-         {'name': 'dcBatteryVoltage', 'width': 2, 'scale': .1, 'units': "V"},
+         {'name': 'dcBatteryVoltage', 'width': 2, 'scale': .1, 'units': "V", 'deadband': .5},
          {'name': 'batteryMaxTemperature', 'width': 1, 'signed': True, 'units': "°C"},
          {'name': 'batteryMinTemperature', 'width': 1, 'signed': True, 'units': "°C"},
-         {'name': 'cellTemp%02d', 'idx': 1, 'cnt': 5, 'width': 1, 'signed': True, 'units': "°C"},
+         {'name': 'cellTemp%02d', 'idx': 1, 'cnt': 5, 'width': 1, 'signed': True, 'units': "°C", 'pack': 'cellTemp'},
          {'padding': 1},
          {'name': 'batteryInletTemperature', 'width': 1, 'signed': True, 'units': "°C"},
          {'padding': 4},
@@ -36,36 +37,39 @@ Fields = (
          {'name': 'cumulativeEnergyDischarged', 'width': 4, 'scale': .1, 'units': "kWh"},
          {'name': 'operatingTime', 'width': 4, 'units':'s'},  # seconds
          {'padding': 3},
-         {'name': 'driveMotorSpeed', 'width': 2, 'signed': True, 'offset': 0, 'scale': 1, 'units': "RPM"},
+         {'name': 'driveMotorSpeed', 'width': 2, 'signed': True, 'offset': 0, 'scale': 1, 'units': "RPM", 'deadband': 50},
          {'padding': 4},
          # Len: 56
      )
      },
-    {'cmd': b2102, 'canrx': 0x7ec, 'cantx': 0x7e4,
+    {'cmd': b2102, 'canrx': 0x7ec, 'cantx': 0x7e4, 'period': 10,
      'fields': (
          {'padding': 6},
-         {'name': 'cellVoltage%02d', 'idx': 1, 'cnt': 32, 'width': 1, 'scale': .02, 'units': "V"},
+         {'name': 'cellVoltage%02d', 'idx': 1, 'cnt': 32, 'width': 1, 'scale': .02, 'units': "V", 'deadband': .03,
+          'pack': 'cellVoltage'},
          # Len: 38
      )
      },
-    {'cmd': b2103, 'canrx': 0x7ec, 'cantx': 0x7e4,
+    {'cmd': b2103, 'canrx': 0x7ec, 'cantx': 0x7e4, 'period': 10,
      'fields': (
          {'padding': 6},
-         {'name': 'cellVoltage%02d', 'idx': 33, 'cnt': 32, 'width': 1, 'scale': .02, 'units': "V"},
+         {'name': 'cellVoltage%02d', 'idx': 33, 'cnt': 32, 'width': 1, 'scale': .02, 'units': "V", 'deadband': .03,
+          'pack': 'cellVoltage'},
          # Len: 38
      )
      },
-    {'cmd': b2104, 'canrx': 0x7ec, 'cantx': 0x7e4,
+    {'cmd': b2104, 'canrx': 0x7ec, 'cantx': 0x7e4, 'period': 10,
      'fields': (
          {'padding': 6},
-         {'name': 'cellVoltage%02d', 'idx': 65, 'cnt': 32, 'width': 1, 'scale': .02, 'units': "V"},
+         {'name': 'cellVoltage%02d', 'idx': 65, 'cnt': 32, 'width': 1, 'scale': .02, 'units': "V", 'deadband': .03,
+          'pack': 'cellVoltage'},
          # Len: 38
      )
      },
-    {'cmd': b2105, 'canrx': 0x7ec, 'cantx': 0x7e4,
+    {'cmd': b2105, 'canrx': 0x7ec, 'cantx': 0x7e4, 'period': 5,
      'fields': (
          {'padding': 11},
-         {'name': 'cellTemp%02d', 'idx': 6, 'cnt': 7, 'width': 1, 'signed': True, 'units': "°C"},
+         {'name': 'cellTemp%02d', 'idx': 6, 'cnt': 7, 'width': 1, 'signed': True, 'units': "°C", 'pack': 'cellTemp'},
          {'padding': 9},
          {'name': 'soh', 'width': 2, 'scale': .1, 'units': "%"},
          {'padding': 4},
@@ -74,7 +78,7 @@ Fields = (
          # Len: 45
      )
      },
-    {'cmd': b2180, 'canrx': 0x7ee, 'cantx': 0x7e6,
+    {'cmd': b2180, 'canrx': 0x7ee, 'cantx': 0x7e6, 'period': 10,
      'fields': (
          {'padding': 14},
          {'name': 'externalTemperature', 'width': 1, 'scale': .5, 'offset': -40, 'units': "°C"},
@@ -82,7 +86,7 @@ Fields = (
          # Len: 25
      )
      },
-    {'cmd': b22b002, 'canrx': 0x7ce, 'cantx': 0x7c6, 'optional': True,
+    {'cmd': b22b002, 'canrx': 0x7ce, 'cantx': 0x7c6, 'period': 30, 'optional': True,
      'fields': (
          {'padding': 9},
          {'name': 'odo', 'width': 3, 'units': "km"},
@@ -92,13 +96,13 @@ Fields = (
      },
     {'computed': True,
      'fields': (
-         {'name': 'dcBatteryPower',
+         {'name': 'dcBatteryPower', 'inputs': ('dcBatteryCurrent', 'dcBatteryVoltage'), 'deadband': .1,
           'lambda': lambda d: d['dcBatteryCurrent'] * d['dcBatteryVoltage'] / 1000.0},
-         {'name': 'charging',
+         {'name': 'charging', 'inputs': ('charging_bits',),
           'lambda': lambda d: int(d['charging_bits'] & 0x80 != 0)},
-         {'name': 'normalChargePort',
+         {'name': 'normalChargePort', 'inputs': ('charging_bits',),
           'lambda': lambda d: int(d['charging_bits'] & 0x20 != 0)},
-         {'name': 'rapidChargePort',
+         {'name': 'rapidChargePort', 'inputs': ('charging_bits',),
           'lambda': lambda d: int(d['charging_bits'] & 0x40 != 0)},
      )
      },
@@ -111,15 +115,27 @@ class IoniqBev(Car):
     def __init__(self, config, dongle, gps):
         super().__init__(config, dongle, gps)
         self._dongle.set_protocol('CAN_11_500')
-        self._isotp = IsoTpDecoder(self._dongle, self.get_fields())
+        self._isotp = IsoTpDecoder(self._dongle, Fields)
+        self._pack = BatteryPack(cells=96, temps=12)
+        self._isotp.add_vector_sink(self._pack.update)
+        self._isotp.attach(self.sample)
+
+    def next_deadline(self):
+        """ Return the deadline of the next due command """
+        return self._isotp.next_deadline()
 
     def get_fields(self):
-        """ Return the fields for the Ioniq Electric """
-        return Fields
+        """ Return the expanded fields for the Ioniq Electric """
+        return self._isotp.fields + (self._pack.get_fields(),)
 
     def read_dongle(self, data):
         """ Fetch data from CAN-bus and decode it.
-            "data" needs to be a dictionary that will
-            be modified with decoded data """
-        data.update(self._isotp.get_data())
+            The decoder writes straight into the sample "data" """
+        self._isotp.get_data()
+        data.update(self._pack.stats())
+
+    async def read_dongle_async(self, data):
+        """ read_dongle awaiting the dongle """
+        await self._isotp.get_data_async()
+        data.update(self._pack.stats())
 
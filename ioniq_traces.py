@@ -0,0 +1,63 @@
+""" Sample ECU responses of the Hyundai Ioniq Electric 28kWh, used by the
+    benchmarks and the ELM327 emulator. The payloads follow the layout of
+    ioniq_bev.Fields with plausible values (SOC 77 %, 370.5 V, -12.3 A). """
+
+# ISO-TP payloads by (request id, command)
+Responses = {
+    (0x7e4, bytes.fromhex('2101')): bytes.fromhex(
+        '6101ffffffff9a2710271004ff850e7914121313121413001200000000'
+        '00007c0001e2400001d4c000008f3c00008a2b00a1b2c3000000000000000000'),
+    (0x7e4, bytes.fromhex('2102')): bytes.fromhex(
+        '6102ffffffff' + 'bdbdbcbdbebdbdbd' * 4),
+    (0x7e4, bytes.fromhex('2103')): bytes.fromhex(
+        '6103ffffffff' + 'bdbcbdbdbdbebdbd' * 4),
+    (0x7e4, bytes.fromhex('2104')): bytes.fromhex(
+        '6104ffffffff' + 'bdbdbdbcbdbdbebd' * 4),
+    (0x7e4, bytes.fromhex('2105')): bytes.fromhex(
+        '6105ffffffff00000f0f001313121314131200000000000000000003e800'
+        '000000a00000000000000000000000'),
+    (0x7e6, bytes.fromhex('2180')): bytes.fromhex(
+        '6180000000000000000000000000' '64' '00000000000000000000'),
+    (0x7c6, bytes.fromhex('22b002')): bytes.fromhex(
+        '62b002000000000000009c40000000'),
+}
+
+
+def isotp_frames(payload, pad=0xaa):
+    """ Split a payload into the 8 data bytes of each ISO-TP CAN frame """
+    if len(payload) <= 7:
+        frame = bytes((len(payload),)) + payload
+        return [frame.ljust(8, bytes((pad,)))]
+
+    frames = [bytes((0x10 | len(payload) >> 8, len(payload) & 0xff)) + payload[:6]]
+    for seq, pos in enumerate(range(6, len(payload), 7), start=1):
+        frame = bytes((0x20 | seq & 0xf,)) + payload[pos:pos + 7]
+        frames.append(frame.ljust(8, bytes((pad,))))
+    return frames
+
+
+def elm_response(payload, canrx, headers=True, spaces=False, linefeeds=True, extended=False,
+                 count=None):
+    """ Format a payload the way an ELM327 with CAN auto formatting prints it,
+        without the trailing prompt. "count" stops after that many frames,
+        like the response count after a request does. """
+    sep = ' ' if spaces else ''
+    eol = '\r\n' if linefeeds else '\r'
+
+    def hexbytes(data):
+        return sep.join('%02X' % byte for byte in data)
+
+    frames = isotp_frames(payload)[:count]
+    if headers:
+        if extended:
+            can_id = sep.join('%02X' % byte for byte in canrx.to_bytes(4, 'big'))
+        else:
+            can_id = '%03X' % canrx
+        lines = [can_id + sep + hexbytes(frame) for frame in frames]
+    elif len(frames) == 1:
+        lines = [hexbytes(payload)]
+    else:
+        lines = ['%03X' % len(payload)]
+        lines += ['%X:%s%s' % (idx & 0xf, sep, hexbytes(frame[2 if idx == 0 else 1:]))
+                  for idx, frame in enumerate(frames)]
+    return (eol.join(lines) + eol + eol).encode()
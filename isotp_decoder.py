@@ -1,6 +1,14 @@
 """ Generic decoder for ISO-TP based cars """
+from collections import namedtuple
+from itertools import permutations
+from time import monotonic, perf_counter
+from types import MappingProxyType
 import logging
 import struct
+from elm327 import NoData, frame_count
+from torque_formula import byte_count, compile_function
+from sample import SampleLayout
+import metrics
 
 FormatMap = {
     0: {'f': 'x'},
@@ -12,135 +20,526 @@ FormatMap = {
 }
 
 
+# Largest mask that can be used for CAN id filters (29 bit ids). Dongles
+# using 11 bit ids only look at the lower bits.
+CanMaskAll = 0x1fffffff
+
+# Functional (broadcast) request ids of OBD-II. Every ECU may answer these,
+# so their response id always gets an exact filter.
+FunctionalIds = frozenset((0x7df, 0x18db33f1))
+
+# Number of command groups for which all orders are tried when building the
+# execution plan. Above that the declaration order of the groups is kept.
+MaxPermutedGroups = 7
+
+
+# A command of the compiled schema. For CAN commands "decode" turns the raw
+# response into a flat tuple of values in the order of "names". Computed
+# commands have "computed" set and their fields are (name, inputs, func).
+# "vectors" lists patterned fields marked with 'pack' as
+# (pack, first idx, position in the tuple, count).
+# "table" is the read-only, expanded entry of the field table. "frames" is
+# the number of CAN frames of the response if the struct gives its exact
+# size, None if it is only a minimum (equations). "canmask" is the rx mask
+# the plan uses for the command.
+CompiledCommand = namedtuple('CompiledCommand', (
+    'cmd', 'cantx', 'canrx', 'period', 'optional', 'computed',
+    'struct', 'names', 'decode', 'fields', 'vectors', 'table', 'frames', 'canmask'))
+
+# Immutable result of compile_fields. "plan" holds the commands in execution
+# order, "fields" the expanded field tables as read-only mappings.
+CompiledSchema = namedtuple('CompiledSchema', ('plan', 'rx_mask', 'stats', 'fields'))
+
+# Compiled schemas by id() of their field table. The table itself is kept
+# in the cache too, so the id can not be reused by another object.
+_schema_cache = {}
+
+
 def is_power_of_two(number):
     """ Check of argument has power of two """
     return (number & (number-1) == 0) and number != 0
 
 
+def common_rx_mask(can_ids):
+    """ Return a mask that only keeps the bits all can_ids have in common,
+        so one filter/mask pair receives all of them. """
+    can_ids = tuple(can_ids)
+    diff = 0
+    for can_id in can_ids[1:]:
+        diff |= can_id ^ can_ids[0]
+    return CanMaskAll & ~diff
+
+
+def group_mask(cantx, rx_mask):
+    """ Return the rx mask used for requests sent to "cantx" """
+    return CanMaskAll if cantx in FunctionalIds else rx_mask
+
+
+def header_switches(groups, rx_mask=CanMaskAll):
+    """ Count the AT commands needed to run through the (cantx, canrx)
+        groups once. The header state persists into the next cycle,
+        so the switch from the last group back to the first is counted. """
+    if len(groups) < 2:
+        return 0
+    switches = 0
+    prev_tx, prev_rx = groups[-1]
+    prev_mask = group_mask(prev_tx, rx_mask)
+    for cantx, canrx in groups:
+        mask = group_mask(cantx, rx_mask)
+        switches += cantx != prev_tx
+        switches += (canrx & mask) != (prev_rx & prev_mask)
+        switches += mask != prev_mask
+        prev_tx, prev_rx, prev_mask = cantx, canrx, mask
+    return switches
+
+
+def expand_fields(cmd_data, log):
+    """ Expand patterned fields (i.e. cellVolts%02d) into simple fields
+        and build the format string for unpack. Returns the format,
+        a tuple of new field dicts and the vectors of patterned fields;
+        cmd_data is left untouched. """
+    fmt = ">"
+    fmt_idx = 0
+    new_fields = []
+    vectors = []
+    for field in cmd_data['fields']:
+        log.debug(field)
+        # Non power of two types are hard as is. For now those can
+        # not be used in patterned fields.
+        if field.get('cnt', 1) > 1 and not is_power_of_two(field['width']):
+            raise ValueError('Non power of two field in patterned field not allowed')
+
+        if not field.get('width', 0) in FormatMap.keys():
+            raise ValueError('Unsupported field length')
+
+        if field.get('padding', 0) > 0:
+            field_fmt = str(field.get('padding')) + 'x'
+            log.debug("field_fmt(%s)", field_fmt)
+            fmt += field_fmt
+        elif not field.get('computed', False):
+            # For patterned fields (i.e. cellVolts%02d) use multipler
+            # in format string.
+            field_fmt = str(field.get('cnt', ''))
+            if field.get('signed', False):
+                field_fmt += FormatMap[field['width']]['f'].lower()
+            else:
+                field_fmt += FormatMap[field['width']]['f'].upper()
+
+            log.debug("field_fmt(%s)", field_fmt)
+            fmt += field_fmt
+
+            # Work on a copy, the field table may be shared
+            field = dict(field)
+            if not is_power_of_two(field['width']):
+                if 'lambda' in field:
+                    log.warning('defining lambda on non power ow two length fields may give unexpected results!')
+                else:
+                    field['lambda'] = FormatMap[field['width']]['l']
+
+            field['scale'] = field.get('scale', 1)
+            field['offset'] = field.get('offset', 0)
+
+            if 'name' not in field:
+                raise ValueError('Name missing in Field')
+
+            start = field.get('idx', 0)
+            cnt = field.get('cnt', 1)
+            if 'pack' in field:
+                vectors.append((field['pack'], start, len(new_fields), cnt))
+
+            for field_idx in range(start, start + cnt):
+                # Expand patterned fields into simple fields to
+                # match the format string. We need to copy the existing
+                # field, else all field names will reference the same
+                # string
+                new_field = field.copy()
+                if cnt > 1:
+                    new_field['name'] %= field_idx
+
+                new_field['fmt_idx'] = fmt_idx
+                new_field['fmt_len'] = len(FormatMap[field['width']])
+                fmt_idx += new_field['fmt_len']
+
+                new_fields.append(new_field)
+
+    log.debug("fmt(%s)", fmt)
+    return fmt, tuple(new_fields), tuple(vectors)
+
+
+def generate_decoder(fmt, fields):
+    """ Generate a function that unpacks a response and returns all scaled
+        field values as one flat tuple. Scale and offset are inlined as
+        constants, lambdas are bound by name. Returns function and source. """
+    env = {'_unpack': struct.Struct(fmt).unpack}
+    exprs = []
+    for idx, field in enumerate(fields):
+        fmt_idx = field['fmt_idx']
+        if 'lambda' in field:
+            env['_l%d' % idx] = field['lambda']
+            expr = '_l%d(v[%d:%d])' % (idx, fmt_idx, fmt_idx + field['fmt_len'])
+        else:
+            expr = 'v[%d]' % fmt_idx
+
+        if field['scale'] != 1:
+            expr = '%s * (%r)' % (expr, field['scale'])
+        if field['offset'] != 0:
+            expr = '%s + (%r)' % (expr, field['offset'])
+        exprs.append(expr)
+
+    source = ('def decode(raw):\n'
+              '    v = _unpack(raw)\n'
+              '    return (%s)\n' % ''.join(expr + ',\n            ' for expr in exprs))
+    exec(compile(source, '<isotp decoder %s>' % fmt, 'exec'), env)
+    return env['decode'], source
+
+
+def generate_formula_decoder(cmd_data, log):
+    """ Generate the decoder of a command whose fields carry Torque style
+        'equation's instead of widths, i.e. imported from a PID list.
+        Variables are bound to the bytes after the echoed command. Fields
+        whose equation does not compile are dropped. A field whose
+        equation fails, i.e. divides by zero, decodes to None.
+        Returns the function, a format giving the minimal response
+        length and the remaining fields. """
+    offset = len(cmd_data['cmd'])
+    size = offset
+    env = {'_error': struct.error}
+    new_fields = []
+    lines = []
+    for field in cmd_data['fields']:
+        func = compile_function(field['equation'], offset)
+        if func is None:
+            log.warning("Dropping field %s with invalid equation", field.get('name'))
+            continue
+        idx = len(new_fields)
+        env['_f%d' % idx] = func
+        size = max(size, offset + byte_count(field['equation']))
+        lines.append('    try:\n'
+                     '        v%d = _f%d(raw)\n'
+                     '    except ArithmeticError:\n'
+                     '        v%d = None\n' % (idx, idx, idx))
+        new_fields.append(dict(field))
+
+    source = ('def decode(raw):\n'
+              '    if len(raw) < %d:\n'
+              '        raise _error("response too short: %%d < %d" %% len(raw))\n'
+              '%s'
+              '    return (%s)\n' % (size, size, ''.join(lines),
+                                     ''.join('v%d, ' % idx for idx in range(len(new_fields)))))
+    exec(compile(source, '<isotp formulas %s>' % cmd_data['cmd'].hex(), 'exec'), env)
+    return env['decode'], '>%dx' % size, tuple(new_fields)
+
+
+def compile_fields(fields, log=None):
+    """ Compile a field table into an immutable CompiledSchema. Schemas are
+        cached per table, so decoders using the same table share one. """
+    cached = _schema_cache.get(id(fields))
+    if cached is not None and cached[0] is fields:
+        return cached[1]
+
+    log = log or logging.getLogger("EVNotiPi/ISO-TP-Decoder")
+    commands = []
+    for cmd_data in fields:
+        if cmd_data.get('computed', False):
+            compiled = tuple((field['name'], frozenset(field['inputs']) if 'inputs' in field else None,
+                              field['lambda'])
+                             for field in cmd_data['fields'])
+            table = MappingProxyType(dict(cmd_data, fields=tuple(
+                MappingProxyType(dict(field)) for field in cmd_data['fields'])))
+            commands.append(CompiledCommand(
+                None, None, None, None, False, True,
+                None, tuple(name for name, _, _ in compiled), None, compiled, (), table, None,
+                None))
+        else:
+            if any('equation' in field for field in cmd_data['fields']):
+                decode, fmt, new_fields = generate_formula_decoder(cmd_data, log)
+                vectors = ()
+                frames = None
+                if not new_fields:
+                    continue    # Nothing left worth a request
+            else:
+                fmt, new_fields, vectors = expand_fields(cmd_data, log)
+                decode, _ = generate_decoder(fmt, new_fields)
+                frames = frame_count(struct.calcsize(fmt))
+            new_fields = tuple(MappingProxyType(field) for field in new_fields)
+            table = MappingProxyType(dict(cmd_data, fields=new_fields))
+            commands.append(CompiledCommand(
+                cmd_data['cmd'], cmd_data['cantx'], cmd_data['canrx'],
+                cmd_data.get('period'), cmd_data.get('optional', False), False,
+                struct.Struct(fmt), tuple(field['name'] for field in new_fields), decode,
+                new_fields, vectors, table, frames, None))
+
+    plan, rx_mask, stats = build_plan(commands)
+    schema = CompiledSchema(plan, rx_mask, MappingProxyType(stats),
+                            tuple(command.table for command in commands))
+    log.info("plan: %d groups, rx mask %X, %d AT commands per cycle (%d saved)",
+             stats['groups'], rx_mask, stats['at_cmds_planned'], stats['at_cmds_saved'])
+
+    _schema_cache[id(fields)] = (fields, schema)
+    return schema
+
+
+def build_plan(commands):
+    """ Order the commands so that commands for the same ECU run back to
+        back and the dongle has to switch headers and filters as seldom
+        as possible. Computed fields run last, in declaration order, as
+        they depend on the data of the other commands.
+        Returns the plan, the shared rx mask and statistics. """
+    groups = {}
+    computed = []
+    for command in commands:
+        if command.computed:
+            computed.append(command)
+        else:
+            groups.setdefault((command.cantx, command.canrx), []).append(command)
+
+    # Only the addressed ECU answers a physical request, so one filter
+    # covering all response ids is enough. Header switches then only need
+    # an AT SH. Functional requests are answered by any ECU and keep an
+    # exact filter.
+    physical = [canrx for cantx, canrx in groups if cantx not in FunctionalIds]
+    rx_mask = common_rx_mask(physical) if physical else CanMaskAll
+    groups = {key: [command._replace(canmask=group_mask(key[0], rx_mask))
+                    for command in group]
+              for key, group in groups.items()}
+
+    order = tuple(groups)
+    if 2 < len(order) <= MaxPermutedGroups:
+        # The plan is cyclic, so keep the first group fixed
+        candidates = ((order[0],) + rest for rest in permutations(order[1:]))
+        order = min(candidates, key=lambda o: header_switches(o, rx_mask))
+
+    plan = tuple(command for key in order for command in groups[key]) + tuple(computed)
+
+    declared = [(command.cantx, command.canrx)
+                for command in commands if not command.computed]
+    stats = {
+        'groups': len(order),
+        'at_cmds_declared': header_switches(declared),
+        'at_cmds_planned': header_switches(order, rx_mask),
+    }
+    stats['at_cmds_saved'] = stats['at_cmds_declared'] - stats['at_cmds_planned']
+    return plan, rx_mask, stats
+
+
 class IsoTpDecoder:
     """ Generic decoder for ISO-TP based cars """
 
-    def __init__(self, dongle, fields):
+    def __init__(self, dongle, fields, default_period=1.0):
         self._log = logging.getLogger("EVNotiPi/ISO-TP-Decoder")
         self._dongle = dongle
         self._fields = fields
+        self._default_period = default_period
+        self._schema = None
+        self._due = []
+        self._last = []
+        # Names changed since the computed fields last ran. Kept across
+        # cycles, so a cycle aborted by an error does not lose them.
+        self._changed = set()
+        self._data = None
+        self._slots = []
+        self._vector_sinks = []
+        # Dongles with their own ISO-TP (SocketCan) take all due requests
+        # at once and send those to different ECUs concurrently
+        self._batch = hasattr(dongle, 'send_commands_ex')
 
         self.preprocess_fields()
 
+    @property
+    def schema(self):
+        """ The compiled, shared schema of this decoder """
+        return self._schema
+
+    @property
+    def fields(self):
+        """ The expanded field tables, read-only """
+        return self._schema.fields
+
+    @property
+    def plan_stats(self):
+        """ Header switch statistics of the execution plan """
+        return self._schema.stats
+
     def preprocess_fields(self):
-        """ Preprocess field structure, creating format strings for unpack etc.,"""
-        for cmd_data in self._fields:
-            fmt = ">"
-            fmt_idx = 0
-
-            # make sure 'computed' is set so we don't need to check for it
-            # in the decoder. Checking is slow.
-            cmd_data['computed'] = cmd_data.get('computed', False)
-
-            if not cmd_data['computed']:
-                # Build a new array instead of inserting into the existing one.
-                # Should be quicker.
-                new_fields = []
-                for field in cmd_data['fields']:
-                    self._log.debug(field)
-                    # Non power of two types are hard as is. For now those can
-                    # not be used in patterned fields.
-                    if field.get('cnt', 1) > 1 and not is_power_of_two(field['width']):
-                        raise ValueError('Non power of two field in patterned field not allowed')
-
-                    if not field.get('width', 0) in FormatMap.keys():
-                        raise ValueError('Unsupported field length')
-
-                    if field.get('padding', 0) > 0:
-                        field_fmt = str(field.get('padding')) + 'x'
-                        self._log.debug("field_fmt(%s)", field_fmt)
-                        fmt += field_fmt
-                    elif not field.get('computed', False):
-                        # For patterned fields (i.e. cellVolts%02d) use multipler
-                        # in format string.
-                        field_fmt = str(field.get('cnt', ''))
-                        if field.get('signed', False):
-                            field_fmt += FormatMap[field['width']]['f'].lower()
-                        else:
-                            field_fmt += FormatMap[field['width']]['f'].upper()
-
-                        self._log.debug("field_fmt(%s)", field_fmt)
-                        fmt += field_fmt
-
-                        if not is_power_of_two(field['width']):
-                            if 'lanbda' in field:
-                                self._log.warning('defining lambda on non power ow two length fields may give unexpected results!')
-                            else:
-                                field['lambda'] = FormatMap[field['width']]['l']
-
-                        field['scale'] = field.get('scale', 1)
-                        field['offset'] = field.get('offset', 0)
-
-                        if 'name' not in field:
-                            raise ValueError('Name missing in Field')
-
-                        start = field.get('idx', 0)
-                        cnt = field.get('cnt', 1)
-
-                        for field_idx in range(start, start + cnt):
-                            # Expand patterned fields into simple fields to
-                            # match the format string. Append new field to the
-                            # array of new fields. We need to copy the existing
-                            # field, else all field names will reference the same
-                            # string
-                            new_field = field.copy()
-                            if cnt > 1:
-                                new_field['name'] %= field_idx
-
-                            new_field['fmt_idx'] = fmt_idx
-                            new_field['fmt_len'] = len(FormatMap[field['width']])
-                            fmt_idx += new_field['fmt_len']
-
-                            new_fields.append(new_field)
-
-                self._log.debug("fmt(%s)", fmt)
-                cmd_data['struct'] = struct.Struct(fmt)
-                cmd_data['fields'] = new_fields
-
-    def get_data(self):
+        """ Preprocess field structure, creating format strings for unpack etc.,
+            compiled into a schema shared by all decoders of the same table """
+        self._schema = compile_fields(self._fields, self._log)
+        # Everything is due on the first call. Computed entries have no
+        # deadline of their own.
+        start = monotonic()
+        self._due = [None if command.computed else start for command in self._schema.plan]
+        self._decode_times = [None if command.computed else
+                              metrics.Registry.histogram('decode_seconds', command.cmd.hex())
+                              for command in self._schema.plan]
+        if self._data is None:
+            self._data = SampleLayout(field['name'] for cmd_data in self._schema.fields
+                                      for field in cmd_data['fields']).new()
+        self._bind_slots()
+
+    def attach(self, sample):
+        """ Decode straight into "sample", the record of the car, instead
+            of an own one. Its layout needs to have all fields. """
+        self._data = sample
+        self._bind_slots()
+
+    def _bind_slots(self):
+        """ Look up where the values of each command go in the sample.
+            All values are written again on the next cycle. """
+        layout = self._data.layout
+        self._slots = [None if command.computed else layout.slot(command.names)
+                       for command in self._schema.plan]
+        self._last = [None] * len(self._schema.plan)
+
+    def add_vector_sink(self, callback):
+        """ Register callback(pack, start, values) that gets the values of
+            patterned fields marked with 'pack' whenever they changed. """
+        self._vector_sinks.append(callback)
+
+    def _due_requests(self, now):
+        """ The due commands for a dongle that can have several requests
+            in flight: their indexes in the plan and the (cmd, cantx, canrx)
+            requests. The due times are advanced by the cycle. """
+        due = [idx for idx, command in enumerate(self._schema.plan)
+               if not command.computed and self._due[idx] <= now]
+        plan = self._schema.plan
+        return due, [(plan[idx].cmd, plan[idx].cantx, plan[idx].canrx) for idx in due]
+
+    def _send_due(self, now):
+        """ Send all due commands at once. Returns the replies by index
+            in the plan. """
+        due, requests = self._due_requests(now)
+        return dict(zip(due, self._dongle.send_commands_ex(requests)))
+
+    def next_deadline(self):
+        """ Return the monotonic time at which the next command is due """
+        return min(due for due in self._due if due is not None)
+
+    def get_data(self, now=None):
         """ Takes a structure which describes addresses,
-            commands and how to decode the return """
-        data = {}
-        for cmd_data in self._fields:
+            commands and how to decode the return.
+            Only commands whose period has elapsed are sent, the
+            returned read-only sample holds the latest value of every
+            field. """
+        if now is None:
+            now = monotonic()
+        replies = self._send_due(now) if self._batch else None
+        cycle = self._cycle(now, replies)
+        try:
+            command = next(cycle)
+            while True:
+                try:
+                    raw = self._dongle.send_command_ex(command.cmd,
+                                                       canrx=command.canrx,
+                                                       cantx=command.cantx,
+                                                       canmask=command.canmask,
+                                                       frames=command.frames)
+                except Exception as err:
+                    command = cycle.throw(err)
+                else:
+                    command = cycle.send(raw)
+        except StopIteration as stop:
+            return stop.value
+
+    async def get_data_async(self, now=None):
+        """ get_data for the asyncio runtime: the ECU replies are awaited,
+            if the dongle supports it """
+        if now is None:
+            now = monotonic()
+        replies = None
+        if self._batch:
+            send_all = getattr(self._dongle, 'send_commands_ex_async', None)
+            if send_all is None:
+                return self.get_data(now)
+            due, requests = self._due_requests(now)
+            replies = dict(zip(due, await send_all(requests)))
+            send = None
+        else:
+            send = getattr(self._dongle, 'send_command_ex_async', None)
+            if send is None:
+                return self.get_data(now)
+        cycle = self._cycle(now, replies)
+        try:
+            command = next(cycle)
+            while True:
+                try:
+                    raw = await send(command.cmd, canrx=command.canrx, cantx=command.cantx,
+                                     canmask=command.canmask, frames=command.frames)
+                except Exception as err:
+                    command = cycle.throw(err)
+                else:
+                    command = cycle.send(raw)
+        except StopIteration as stop:
+            return stop.value
+
+    def _cycle(self, now, replies):
+        """ One cycle of get_data as a generator: yields each due command
+            and expects its response to be sent back, or the exception of
+            the request to be thrown in. With "replies" (by index in the
+            plan) nothing is yielded. Returns a view of the data. """
+        data = self._data
+        changed = self._changed
+        for idx, command in enumerate(self._schema.plan):
+            if command.computed:
+                # Fields of computed "commands" are filled by executing
+                # the fields lambda with the sample as argument. They
+                # are only updated if one of their inputs changed.
+                for name, inputs, func in command.fields:
+                    if not changed or (inputs and changed.isdisjoint(inputs)):
+                        continue
+                    try:
+                        value = func(data)
+                    except KeyError:
+                        continue    # Inputs not read yet
+                    if data.get(name) != value:
+                        data[name] = value
+                        changed.add(name)
+                continue
+
+            due = self._due[idx]
+            if due > now:
+                continue
+            # Advance by whole periods so the schedule does not drift.
+            # Missed slots are skipped instead of being caught up.
+            period = command.period or self._default_period
+            self._due[idx] = due + ((now - due) // period + 1) * period
+
+            # Send a command to the CAN bus and decode the resulting
+            # bytearray with the generated decoder of the command.
             try:
-                if cmd_data['computed']:
-                    # Fields of computed "commands" are filled by executing
-                    # the fields lambda with the data dict as argument
-                    for field in cmd_data['fields']:
-                        name = field['name']
-                        func = field['lambda']
-                        data[name] = func(data)
+                if replies is None:
+                    raw = yield command
                 else:
-                    # Send a command to the CAN bus and parse the resulting
-                    # bytearray using unpack. The format for unpack was generated
-                    # in the preprocessor. Extracted values are scaled, shifted
-                    # and a lambda function is executed if provided
-                    raw = self._dongle.send_command_ex(cmd_data['cmd'],
-                                                       canrx=cmd_data['canrx'],
-                                                       cantx=cmd_data['cantx'])
-                    raw_fields = cmd_data['struct'].unpack(raw)
-
-                    for field in cmd_data['fields']:
-                        name = field['name']
-                        fmt_idx = field['fmt_idx']
-                        fmt_len = field['fmt_len']
-
-                        if 'lambda' in field:
-                            value = field['lambda'](raw_fields[fmt_idx:fmt_idx+fmt_len])
-                        else:
-                            value = raw_fields[fmt_idx]
-
-                        data[name] = value * field['scale'] + field['offset']
+                    raw = replies[idx]
+                    if isinstance(raw, Exception):
+                        raise raw
+            except NoData:
+                if command.optional:
+                    self._log.debug("No data for optional cmd(%s)", command.cmd.hex())
+                    continue
+                raise
 
+            try:
+                start = perf_counter()
+                values = command.decode(raw)
+                self._decode_times[idx].observe(perf_counter() - start)
             except struct.error as err:
-                self._log.error("err(%s) cmd(%s) fmt(%s):%d raw(%s):%d", err, cmd_data['cmd'].hex(),
-                                cmd_data['struct'].format, cmd_data['struct'].size,
+                self._log.error("err(%s) cmd(%s) fmt(%s):%d raw(%s):%d", err, command.cmd.hex(),
+                                command.struct.format, command.struct.size,
                                 raw.hex(), len(raw))
                 raise
 
-        return data
+            last = self._last[idx]
+            if values != last:
+                self._last[idx] = values
+                if last is None:
+                    changed.update(command.names)
+                else:
+                    changed.update(name for name, new, old in zip(command.names, values, last)
+                                   if new != old)
+                data.write(self._slots[idx], values)
+                for pack, start, pos, cnt in command.vectors:
+                    for sink in self._vector_sinks:
+                        sink(pack, start, values[pos:pos + cnt])
+
+        changed.clear()
+        return data.view()
@@ -1,35 +1,79 @@
-from mqtt_handler import MqttHandler
+from mqtt_handler import DEFAULT_HEARTBEAT, MqttHandler
+from mqtt_buffer import MessageBuffer
 from gpspoller import GpsPoller
+from car import LocationFields
 import ioniq_bev
 import elm327
+import metrics
 import time
 from config import load_config
 
-def initialize_homeassistant_sensors(mqtt_handler, car_instance):
-    """ Initialize Home Assistant sensors based on the car's fields. """
+def initialize_homeassistant_sensors(mqtt_handler, car_instance, publish_cells=True):
+    """ Initialize Home Assistant sensors based on the car's fields.
+        Without "publish_cells" the single cell values are left out,
+        the pack aggregates are published instead. """
     print("[INFO] Initializing Home Assistant sensors...")
     base_topic = mqtt_handler.topic_prefix
 
     # Extract fields from the car instance
     pids = car_instance.get_fields()
-    for fields in pids:
-        for field in fields:
-            if 'name' not in field:
-                continue  # Skip fields without a name
-
-            sensor_name = field['name']
-            unit = field.get('units', None)
-            scale = field.get('scale', None)
-            device_class = None  # Optional: Define device class if needed
-
-            # Publish sensor configuration to Home Assistant
+    fields = [(field, cmd_data['cmd'].hex() if 'cmd' in cmd_data else cmd_data.get('group', 'computed'))
+              for cmd_data in pids for field in cmd_data['fields']]
+    fields += [(field, 'location') for field in LocationFields]
+    for field, group in fields:
+        if 'name' not in field:
+            continue  # Skip fields without a name
+        if 'pack' in field and not publish_cells:
+            mqtt_handler.ignore_pid(field['name'])
+            continue
+
+        sensor_name = field['name']
+        unit = field.get('units', None)
+        scale = field.get('scale', None)
+        device_class = None  # Optional: Define device class if needed
+
+        # Publish sensor configuration to Home Assistant
+        mqtt_handler.initialize_pid(
+            pid=sensor_name,
+            name=sensor_name.replace("_", " ").capitalize(),
+            unit=unit,
+            pid_id=sensor_name,
+            group=group,
+            deadband=field.get('deadband'),
+            deadband_rel=field.get('deadband_rel')
+        )
+    mqtt_handler.publish_discovery()
+    print(f"[INFO] {len(mqtt_handler.initialized_pids)} sensors initialized, "
+          f"{mqtt_handler.discovery.published} discovery configs published, "
+          f"{mqtt_handler.discovery.skipped} unchanged.")
+
+def mqtt_publisher(mqtt_handler):
+    """ Return a data callback that publishes each snapshot of the car. """
+    def publish(data):
+        mqtt_handler.update_values(data)
+    return publish
+
+def publish_metrics(mqtt_handler, registry, prometheus_file=None):
+    """ Publish the dongle, decoder and car metrics as diagnostic sensors
+        and write them to a Prometheus text file. Sensors are announced
+        as the metrics show up. """
+    values = registry.snapshot()
+    for key in values:
+        if key not in mqtt_handler.initialized_pids:
+            is_counter = registry.is_counter(key)
             mqtt_handler.initialize_pid(
-                pid=sensor_name,
-                name=sensor_name.replace("_", " ").capitalize(),
-                unit=unit,
-                pid_id=sensor_name
+                pid=key,
+                name=key.replace("_", " ").capitalize(),
+                unit=registry.unit(key),
+                pid_id=key,
+                group="diagnostics",
+                state_class="total_increasing" if is_counter else "measurement",
+                entity_category="diagnostic"
             )
-            print(f"[INFO] Sensor '{sensor_name}' initialized.")
+    mqtt_handler.publish_discovery()
+    mqtt_handler.update_values(values)
+    if prometheus_file:
+        registry.write_prometheus(prometheus_file)
 
 def main():
     print("[INFO] Starting application...")
@@ -52,8 +96,23 @@ def main():
         socat_manager.start()
         print("[INFO] Socat started successfully.")
 
+    # With the asyncio runtime MQTT, gpsd and the car share one event
+    # loop, the MQTT client has to be hooked into it before connecting
+    loop = mqtt_loop = None
+    if config.get("runtime", "threads") == "asyncio":
+        import asyncio
+        from aio_runtime import MqttLoop
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        mqtt_loop = MqttLoop(loop)
+
     # Initialize MQTT Handler
     print("[INFO] Initializing MQTT handler...")
+    buffer = None
+    if config["mqtt"].get("buffer"):
+        buffer = MessageBuffer(config["mqtt"]["buffer"],
+                               max_messages=config["mqtt"].get("buffer_max_messages", 100000),
+                               rate=config["mqtt"].get("buffer_rate", 500.0))
     mqtt_handler = MqttHandler(
         broker=config["mqtt"]["broker"],
         port=config["mqtt"]["port"],
@@ -61,16 +120,27 @@ def main():
         password=config["mqtt"]["password"],
         topic_prefix=config["mqtt"]["topic_prefix"],
         device_name=config["obd"].get("device_name", "OBD2 Dongle"),
-        log_enabled=not config.get("debug", False)  # Logging nur wenn debug False!
+        log_enabled=not config.get("debug", False),  # Logging nur wenn debug False!
+        state_mode=config["mqtt"].get("state_mode", "field"),
+        heartbeat=config["mqtt"].get("heartbeat", DEFAULT_HEARTBEAT),
+        buffer=buffer,
+        discovery_state=config["mqtt"].get("discovery_state"),
+        discovery_mode=config["mqtt"].get("discovery_mode", "sensor"),
+        client=mqtt_loop.client if mqtt_loop else None
     )
-    mqtt_handler.start_loop()
+    mqtt_handler.start_loop(thread=mqtt_loop is None)
     print("[INFO] MQTT handler initialized and loop started.")
 
     Threads = []
 
     # Init dongle
-    print("[INFO] Initializing ELM327 dongle...")
-    dongle_instance = elm327.Elm327(config['obd'])
+    if config["obd"]["mode"] == "socketcan":
+        print("[INFO] Initializing CAN interface...")
+        from socketcan import SocketCan
+        dongle_instance = SocketCan(config['obd'])
+    else:
+        print("[INFO] Initializing ELM327 dongle...")
+        dongle_instance = elm327.Elm327(config['obd'])
     print("[INFO] Dongle initialized successfully.")
 
     # Init GPS interface
@@ -81,12 +151,45 @@ def main():
 
     # Init car
     print("[INFO] Initializing car interface...")
-    car_instance = ioniq_bev.IoniqBev(config, dongle_instance, gps)
+    if config['obd'].get('pid_file'):
+        from torque_car import TorqueCar
+        car_instance = TorqueCar(config, dongle_instance, gps)
+    else:
+        car_instance = ioniq_bev.IoniqBev(config, dongle_instance, gps)
     Threads.append(car_instance)
     print("[INFO] Car interface initialized successfully.")
 
     # Initialize Home Assistant sensors
-    initialize_homeassistant_sensors(mqtt_handler, car_instance)
+    initialize_homeassistant_sensors(mqtt_handler, car_instance,
+                                     publish_cells=config["mqtt"].get("publish_cells", True))
+
+    # The car thread is the only one polling the dongle, MQTT subscribes to it
+    car_instance.register_data(mqtt_publisher(mqtt_handler))
+
+    metrics_config = config.get("metrics", {})
+    metrics_interval = metrics_config.get("interval", 60)
+
+    def publish_diagnostics():
+        publish_metrics(mqtt_handler, metrics.Registry,
+                        metrics_config.get("prometheus_file"))
+
+    if loop is not None:
+        from aio_runtime import run
+        print("[INFO] Running on asyncio...")
+        task = loop.create_task(run(car_instance, gps, mqtt_loop,
+                                    metrics_interval, publish_diagnostics))
+        try:
+            loop.run_until_complete(task)
+        except KeyboardInterrupt:
+            print("[INFO] Shutting down...")
+            task.cancel()
+            loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+        finally:
+            dongle_instance.close()
+            mqtt_handler.stop_loop()
+            loop.close()
+            print("[INFO] MQTT loop stopped.")
+        return
 
     # Start polling loops
     print("[INFO] Starting polling threads...")
@@ -94,23 +197,23 @@ def main():
         t.start()
     print("[INFO] Polling threads started successfully.")
 
+    next_metrics = time.monotonic() + metrics_interval
+
     try:
         while True:
-            now = time.time()
+            if metrics_interval and time.monotonic() >= next_metrics:
+                next_metrics += metrics_interval
+                try:
+                    publish_diagnostics()
+                except Exception as err:
+                    print(f"[ERROR] Publishing metrics failed: {err}")
+
             for t in Threads:
                 status = t.check_thread()
                 if not status:
                     print(f"[ERROR] Thread {t} failed. Restarting...")
                     t.start()
 
-            # Publish car data to MQTT
-            car_data = {}
-            car_instance.read_dongle(car_data)
-            print(f"[DEBUG] Car data read: {car_data}")
-            for key, value in car_data.items():
-                mqtt_handler.update_pid_value(key, value)
-                print(f"[DEBUG] Published {key}: {value} to MQTT.")
-
             # Ensure messages get printed to the console.
             time.sleep(1)
 
@@ -121,6 +224,7 @@ def main():
         for t in Threads[::-1]:  # reverse Threads
             t.stop()
         print("[INFO] Threads stopped.")
+        dongle_instance.close()
         mqtt_handler.stop_loop()
         print("[INFO] MQTT loop stopped.")
 
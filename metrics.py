@@ -0,0 +1,194 @@
+""" Cheap runtime metrics: fixed-bucket histograms, counters and gauges,
+    exported as flat values for Home Assistant and as Prometheus text """
+from bisect import bisect_left
+from time import monotonic
+import os
+
+# Roughly the start of the process, this module is imported early
+ProcessStart = monotonic()
+
+# Upper bounds of the histogram buckets in seconds, from the decode of one
+# response to a command running into the dongle timeout
+DefaultBuckets = (.00005, .0001, .0002, .0005, .001, .002, .005,
+                  .01, .02, .05, .1, .2, .5, 1.0, 2.0, 5.0)
+
+# Quantiles reported in the snapshot
+SnapshotQuantiles = (('p50', .5), ('p95', .95))
+
+
+class Histogram:
+    """ Counts observations in fixed buckets. Observing is a bisect and
+        three additions, there is no per-observation allocation. """
+
+    def __init__(self, buckets=DefaultBuckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """ Add one observation """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, fraction):
+        """ Estimate a quantile, interpolating linearly within its bucket """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        lower = 0.0
+        for upper, count in zip(self.buckets + (self.max,), self.counts):
+            if count and seen + count >= rank:
+                upper = min(upper, self.max)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+            lower = upper
+        return self.max
+
+    def mean(self):
+        """ Mean of all observations """
+        return self.sum / self.count if self.count else None
+
+
+class Metrics:
+    """ Registry of named metrics. A metric can have a label, i.e. the
+        command it was measured for. Names follow the Prometheus
+        conventions: durations end in _seconds, counters in _total. """
+
+    def __init__(self, buckets=DefaultBuckets):
+        self._buckets = buckets
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._counter_keys = set()
+
+    def histogram(self, name, label=None):
+        """ Return the histogram "name", created on first use. Callers on
+            hot paths can keep it to save the lookup. """
+        key = (name, label)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram(self._buckets)
+        return histogram
+
+    def observe(self, name, value, label=None):
+        """ Add an observation to the histogram "name" """
+        self.histogram(name, label).observe(value)
+
+    def count(self, name, label=None, increment=1):
+        """ Increment the counter "name" """
+        key = (name, label)
+        self._counters[key] = self._counters.get(key, 0) + increment
+
+    def gauge(self, name, value, label=None):
+        """ Set the gauge "name" """
+        self._gauges[(name, label)] = value
+
+    @staticmethod
+    def key(name, label=None, suffix=None):
+        """ Flat name of a value in the snapshot, i.e. elm_rtt_2101_p95_ms """
+        for unit in ('_seconds', '_total'):
+            if name.endswith(unit):
+                name = name[:-len(unit)]
+        parts = [name]
+        if label is not None:
+            parts.append(str(label))
+        if suffix:
+            parts.append(suffix)
+        return '_'.join(parts)
+
+    @staticmethod
+    def unit(key):
+        """ Unit of a value in the snapshot """
+        if key.endswith('_ms'):
+            return 'ms'
+        if key.endswith('_s'):
+            return 's'
+        if key.endswith('_hz'):
+            return 'Hz'
+        return None
+
+    def is_counter(self, key):
+        """ Check if a value in the snapshot only ever increases """
+        return key in self._counter_keys
+
+    def snapshot(self):
+        """ Return all metrics as a flat dict. Histograms give the count,
+            mean, quantiles and maximum in milliseconds. """
+        values = {}
+        for (name, label), histogram in list(self._histograms.items()):
+            values[self.key(name, label, 'count')] = histogram.count
+            self._counter_keys.add(self.key(name, label, 'count'))
+            if not histogram.count:
+                continue
+            values[self.key(name, label, 'mean_ms')] = round(histogram.mean() * 1000, 3)
+            for suffix, fraction in SnapshotQuantiles:
+                values[self.key(name, label, suffix + '_ms')] = \
+                    round(histogram.quantile(fraction) * 1000, 3)
+            values[self.key(name, label, 'max_ms')] = round(histogram.max * 1000, 3)
+        for (name, label), value in list(self._counters.items()):
+            values[self.key(name, label)] = value
+            self._counter_keys.add(self.key(name, label))
+        for (name, label), value in list(self._gauges.items()):
+            values[self.key(name, label, 's' if name.endswith('_seconds') else None)] = value
+        return values
+
+    def prometheus(self, prefix='evnotipi_', label_name='cmd'):
+        """ Return all metrics in the Prometheus text exposition format """
+        def labels(label, extra=None):
+            pairs = []
+            if label is not None:
+                pairs.append(f'{label_name}="{label}"')
+            if extra:
+                pairs.append(extra)
+            return '{' + ','.join(pairs) + '}' if pairs else ''
+
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {prefix}{name} {kind}")
+
+        for (name, label), histogram in sorted(self._histograms.items(), key=_sort_key):
+            header(name, 'histogram')
+            cumulative = 0
+            for upper, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                bucket = labels(label, 'le="%s"' % upper)
+                lines.append(f'{prefix}{name}_bucket{bucket} {cumulative}')
+            bucket = labels(label, 'le="+Inf"')
+            lines.append(f'{prefix}{name}_bucket{bucket} {histogram.count}')
+            lines.append(f'{prefix}{name}_sum{labels(label)} {histogram.sum}')
+            lines.append(f'{prefix}{name}_count{labels(label)} {histogram.count}')
+        for (name, label), value in sorted(self._counters.items(), key=_sort_key):
+            header(name, 'counter')
+            lines.append(f'{prefix}{name}{labels(label)} {value}')
+        for (name, label), value in sorted(self._gauges.items(), key=_sort_key):
+            header(name, 'gauge')
+            lines.append(f'{prefix}{name}{labels(label)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path, prefix='evnotipi_'):
+        """ Write the Prometheus text to "path", i.e. for the textfile
+            collector of node_exporter. The file is replaced atomically. """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            file.write(self.prometheus(prefix))
+        os.replace(tmp_path, path)
+
+
+def _sort_key(item):
+    """ Sort metrics by name and label, unlabeled first """
+    (name, label), _ = item
+    return name, '' if label is None else str(label)
+
+
+# The registry used by the dongle, decoder and car
+Registry = Metrics()
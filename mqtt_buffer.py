@@ -0,0 +1,129 @@
+""" Disk backed store-and-forward buffer for MQTT messages """
+from collections import deque
+from threading import Event, Thread
+from time import monotonic, sleep, time
+import sqlite3
+
+
+class MessageBuffer:
+    """ FIFO of messages that could not be sent, kept in SQLite (WAL mode)
+        so they survive a restart. "max_messages" caps the size, the oldest
+        messages are dropped first.
+
+        put() only appends to a queue in memory; a worker thread writes the
+        queue to disk and, while connected, sends the stored messages in
+        batches of "batch_size" at no more than "rate" messages per second.
+        That way neither an outage nor a reconnect stalls the caller. """
+
+    def __init__(self, path, max_messages=100000, batch_size=100, rate=500.0):
+        self.path = path
+        self.max_messages = max_messages
+        self.batch_size = batch_size
+        self.rate = rate
+        self.connected = False
+        self._pending = deque()
+        self._wakeup = Event()
+        self._send = None
+        self._thread = None
+        self._running = False
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS messages ("
+                         "id INTEGER PRIMARY KEY AUTOINCREMENT, time REAL, "
+                         "topic TEXT, payload TEXT, retain INTEGER)")
+        self._stored = self._db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        if self._stored:
+            print(f"[INFO] MQTT buffer {path} holds {self._stored} messages")
+
+    @property
+    def backlog(self):
+        """ Number of messages waiting to be sent """
+        return self._stored + len(self._pending)
+
+    def put(self, topic, payload, retain=False):
+        """ Queue a message. "payload" is the JSON text. """
+        self._pending.append((time(), topic, payload, int(retain)))
+        self._wakeup.set()
+
+    def set_connected(self, connected):
+        """ Start or stop sending the stored messages """
+        self.connected = connected
+        self._wakeup.set()
+
+    def start(self, send):
+        """ Start the worker. send(topic, payload, retain, timestamp) returns
+            False if the message could not be handed to the client;
+            "timestamp" is the time the message was queued at. """
+        self._send = send
+        self._running = True
+        self._thread = Thread(target=self.run, name="EVNotiPi/MQTT-Buffer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the worker, the queue is written to disk first """
+        self._running = False
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+        self._store()
+        self._db.close()
+
+    def _store(self):
+        """ Move the queue to disk, dropping the oldest messages beyond
+            the cap """
+        rows = []
+        while self._pending:
+            rows.append(self._pending.popleft())
+        if not rows:
+            return
+        with self._db:
+            self._db.executemany("INSERT INTO messages (time, topic, payload, retain) "
+                                 "VALUES (?, ?, ?, ?)", rows)
+            stored = self._stored + len(rows)
+            if stored > self.max_messages:
+                self._db.execute("DELETE FROM messages WHERE id IN "
+                                 "(SELECT id FROM messages ORDER BY id LIMIT ?)",
+                                 (stored - self.max_messages,))
+                print(f"[WARNING] MQTT buffer full, dropped {stored - self.max_messages} "
+                      f"oldest messages")
+                stored = self.max_messages
+        self._stored = stored
+
+    def _drain(self):
+        """ Send one batch of stored messages, oldest first. Returns False
+            if the client refused a message. """
+        rows = self._db.execute("SELECT id, time, topic, payload, retain FROM messages "
+                                "ORDER BY id LIMIT ?", (self.batch_size,)).fetchall()
+        sent = 0
+        for _, stamp, topic, payload, retain in rows:
+            if not self._send(topic, payload, bool(retain), stamp):
+                break
+            sent += 1
+        if sent:
+            with self._db:
+                self._db.execute("DELETE FROM messages WHERE id <= ?", (rows[sent - 1][0],))
+            self._stored -= sent
+        return sent == len(rows)
+
+    def run(self):
+        """ The worker thread """
+        while self._running:
+            self._wakeup.wait(1.0)
+            self._wakeup.clear()
+            self._store()
+            if not self._stored or not self.connected:
+                continue
+
+            print(f"[INFO] Sending {self._stored} buffered MQTT messages")
+            while self._running and self.connected and self._stored:
+                started = monotonic()
+                if not self._drain():
+                    break
+                self._store()
+                # Rate limit, so a reconnect does not flood the broker
+                remaining = self.batch_size / self.rate - (monotonic() - started)
+                if remaining > 0:
+                    sleep(remaining)
+            if not self._stored:
+                print("[INFO] MQTT buffer drained")
@@ -1,4 +1,6 @@
 import paho.mqtt.client as mqtt
+from time import monotonic, time
+from discovery import DISCOVERY_MODES, DiscoveryManager, infer_classes
 import json
 import uuid
 import re
@@ -11,70 +13,340 @@ def make_safe_id(pid_id):
     # Erlaubt nur Buchstaben, Zahlen und Unterstriche
     return re.sub(r'[^a-zA-Z0-9_]', '_', pid_id.replace(" ", "_"))
 
+# How state values are published:
+#   field:   one message per value on its own topic
+#   command: one JSON document per command block (group)
+#   cycle:   one JSON document with all values per cycle
+STATE_MODES = ("field", "command", "cycle")
+DEFAULT_GROUP = "state"
+# Seconds after which an unchanged value is sent again
+DEFAULT_HEARTBEAT = 300
+
 class MqttHandler:
-    def __init__(self, broker, port, username, password, topic_prefix, device_name="OBD2 Dongle", log_enabled=True):
-        self.client = mqtt.Client()
+    def __init__(self, broker, port, username, password, topic_prefix, device_name="OBD2 Dongle", log_enabled=True,
+                 state_mode="field", heartbeat=DEFAULT_HEARTBEAT, client=None, buffer=None, discovery_state=None,
+                 discovery_mode="sensor"):
+        if state_mode not in STATE_MODES:
+            raise ValueError(f"Unsupported state mode {state_mode}")
+        if discovery_mode not in DISCOVERY_MODES:
+            raise ValueError(f"Unsupported discovery mode {discovery_mode}")
+        self.client = client if client is not None else mqtt.Client()
         self.client.username_pw_set(username, password)
         self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        # Store-and-forward: with a MessageBuffer, messages sent while the
+        # broker is not reachable are kept and sent after reconnecting
+        self.buffer = buffer
+        self.connected = False
+        # Discovery configs are only sent if changed, and again when
+        # Home Assistant restarts
+        self.discovery = DiscoveryManager(self.publish_text, discovery_state, log_enabled)
+        self.discovery_mode = discovery_mode
+        self._components = {}
+        self._components_changed = False
+        self._pruned = False
         self.client.connect(broker, port, 60)
         self.topic_prefix = topic_prefix
         self.initialized_pids = set()
         self.device_name = device_name
         self.mac_address = get_mac_address()
         self.log_enabled = log_enabled
+        self.state_mode = state_mode
+        self._safe_ids = {}
+        self._pid_groups = {}
+        self.ignored_pids = set()
+        # Change detection: values are only published if they moved by more
+        # than their deadband or were not sent for "heartbeat" seconds.
+        # With heartbeat None every value is published every time.
+        self.heartbeat = heartbeat
+        self._deadbands = {}
+        self._last_published = {}
 
     def on_connect(self, client, userdata, flags, rc):
+        self.connected = rc == 0
+        if self.connected:
+            self.discovery.on_connect(client)
+        if self.buffer is not None:
+            self.buffer.set_connected(self.connected)
         if self.log_enabled:
             if rc == 0:
                 print("Connected to MQTT Broker!")
             else:
                 print(f"Failed to connect, return code {rc}")
 
+    def on_disconnect(self, client, userdata, rc):
+        self.connected = False
+        if self.buffer is not None:
+            self.buffer.set_connected(False)
+        if self.log_enabled:
+            print(f"Disconnected from MQTT Broker, return code {rc}")
+
     def publish(self, topic, payload, retain=False):
-        self.client.publish(topic, json.dumps(payload), retain=retain)
+        buffer = self.buffer
+        if (buffer is not None and (not self.connected or buffer.backlog)
+                and isinstance(payload, dict) and "timestamp" not in payload):
+            # Will be buffered, keep the time it belongs to
+            payload = dict(payload, timestamp=time())
+        self.publish_text(topic, json.dumps(payload), retain)
+
+    def publish_text(self, topic, text, retain=False):
+        """
+        Publish an already encoded payload, through the buffer if one is set.
+        """
+        buffer = self.buffer
+        if buffer is None:
+            self.client.publish(topic, text, retain=retain)
+            return
+        # Keep the order: while older messages wait, new ones queue up behind them
+        if self.connected and not buffer.backlog and self.send(topic, text, retain):
+            return
+        buffer.put(topic, text, retain)
+
+    def send(self, topic, payload, retain=False, timestamp=None):
+        """
+        Hand an encoded message to the client, return False if it was refused.
+        "timestamp" is the time a buffered message belongs to. JSON documents
+        carry it already, for a plain value on a state topic it is
+        published first on the "timestamp" topic next to it. Other messages,
+        like discovery configs or the empty payloads clearing them, go
+        without.
+        """
+        if timestamp is not None and payload and topic.endswith('/state') \
+                and not payload.startswith('{'):
+            info = self.client.publish(self.timestamp_topic(topic), json.dumps(timestamp),
+                                       retain=retain)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                return False
+        info = self.client.publish(topic, payload, retain=retain)
+        return info.rc == mqtt.MQTT_ERR_SUCCESS
 
-    def start_loop(self):
-        self.client.loop_start()
+    @staticmethod
+    def timestamp_topic(topic):
+        """
+        Topic with the time of a buffered value published on the state
+        topic "topic".
+        """
+        return topic[:-len('/state')] + '/timestamp'
+
+    def start_loop(self, thread=True):
+        """
+        Start the network thread of the client and the buffer. Without
+        "thread" the caller runs the network loop, i.e. aio_runtime.
+        """
+        if thread:
+            self.client.loop_start()
+        if self.buffer is not None:
+            self.buffer.start(self.send)
 
     def stop_loop(self):
+        if self.buffer is not None:
+            self.buffer.stop()
         self.client.loop_stop()
 
-    def initialize_pid(self, pid, name, unit, pid_id):
+    def safe_id(self, pid_id):
+        """
+        Return the MQTT safe id of a PID, cached as it is needed for every value.
+        """
+        safe_pid_id = self._safe_ids.get(pid_id)
+        if safe_pid_id is None:
+            safe_pid_id = self._safe_ids[pid_id] = make_safe_id(pid_id)
+        return safe_pid_id
+
+    def group_topic(self, group):
+        """
+        Return the state topic of a JSON document in the aggregated state modes.
+        """
+        if self.state_mode == "cycle" or group == DEFAULT_GROUP:
+            return f"{self.topic_prefix}/{DEFAULT_GROUP}"
+        return f"{self.topic_prefix}/{make_safe_id(group)}/state"
+
+    @property
+    def device(self):
+        """
+        The device block of the discovery configs.
+        """
+        return {
+            "identifiers": [f"obd2_device_{self.mac_address}"],
+            "name": self.device_name,
+            "manufacturer": "Michael Krasselt",
+            "model": "OBD2 Dongle via PI"
+        }
+
+    def initialize_pid(self, pid, name, unit, pid_id, group=None, deadband=None, deadband_rel=None,
+                       state_class=None, entity_category=None, device_class=None):
         """
         Publish Home Assistant MQTT discovery message for a new PID.
+        In the aggregated state modes "group" selects the JSON document
+        the value is published in. "deadband" (absolute) and "deadband_rel"
+        (relative to the last published value) suppress small changes.
+        "entity_category" "diagnostic" lists the sensor apart from the car data.
+        Device and state class are inferred from the unit unless given.
+        In the device discovery mode the sensor is only added to the
+        device config, publish_discovery sends it.
         """
         if pid_id in self.initialized_pids:
             return  # Avoid reinitializing the same PID
 
-        safe_pid_id = make_safe_id(pid_id)  # Make the PID ID safe for MQTT
+        if deadband or deadband_rel:
+            self._deadbands[pid_id] = (deadband or 0, deadband_rel or 0)
+
+        safe_pid_id = self.safe_id(pid_id)  # Make the PID ID safe for MQTT
         discovery_topic = f"homeassistant/sensor/{safe_pid_id}/config"
-        state_topic = f"{self.topic_prefix}/{safe_pid_id}/state"
+        group = group or DEFAULT_GROUP
+        self._pid_groups[pid_id] = group
+        if self.state_mode == "field":
+            state_topic = f"{self.topic_prefix}/{safe_pid_id}/state"
+        else:
+            state_topic = self.group_topic(group)
+        inferred_device_class, inferred_state_class = infer_classes(unit, pid_id)
         payload = {
             "name": name,
             "state_topic": state_topic,
             "unit_of_measurement": unit,
-            "device_class": None,  # Optional: Define Home Assistant device class if applicable
-            "state_class": "measurement",  # Define state class (e.g., measurement)
+            "device_class": device_class or inferred_device_class,
+            "state_class": state_class or inferred_state_class,
             "unique_id": f"obd2_{safe_pid_id}",
-            "device": {
-                "identifiers": [f"obd2_device_{self.mac_address}"],
-                "name": self.device_name,
-                "manufacturer": "Michael Krasselt",
-                "model": "OBD2 Dongle via PI"
-            }
         }
-        # Publish discovery message
-        self.publish(discovery_topic, payload, retain=True)
-        if self.log_enabled:
-            print(f"Initialized PID {name} with MQTT ID {pid_id} in Home Assistant")
+        if entity_category:
+            payload["entity_category"] = entity_category
+        if self.state_mode != "field":
+            payload["value_template"] = f"{{{{ value_json['{safe_pid_id}'] }}}}"
         self.initialized_pids.add(pid_id)
 
+        if self.discovery_mode == "device":
+            payload = {key: value for key, value in payload.items() if value is not None}
+            payload["platform"] = "sensor"
+            self._components[safe_pid_id] = payload
+            self._components_changed = True
+            return
+
+        payload["device"] = self.device
+        self.prune_discovery()
+        # Publish discovery message, unless the broker has it retained already
+        if self.discovery.announce(discovery_topic, payload) and self.log_enabled:
+            print(f"Initialized PID {name} with MQTT ID {pid_id} in Home Assistant")
+
+    def device_topic(self):
+        """
+        Topic of the device discovery config.
+        """
+        return f"homeassistant/device/obd2_device_{self.mac_address.replace(':', '')}/config"
+
+    def prune_discovery(self):
+        """
+        Remove the discovery configs an earlier run published in the other
+        discovery mode, before the first config of this mode is sent, so
+        entities never show up twice.
+        """
+        if self._pruned:
+            return
+        self._pruned = True
+        if self.discovery_mode == "device":
+            self.discovery.prune("homeassistant/sensor/")
+        else:
+            self.discovery.prune("homeassistant/device/")
+
+    def publish_discovery(self):
+        """
+        Send the pending discovery config and save the discovery state.
+        In the device mode this is one retained message declaring the device
+        with all its sensors.
+        """
+        if self.discovery_mode == "device" and self._components_changed:
+            self._components_changed = False
+            self.prune_discovery()
+            payload = {
+                "device": self.device,
+                "origin": {"name": "raspberry-obd2-to-homeassistant"},
+                "components": self._components,
+            }
+            if self.discovery.announce(self.device_topic(), payload) and self.log_enabled:
+                print(f"Published device config with {len(self._components)} sensors")
+        self.discovery.save()
+
     def update_pid_value(self, pid_id, value):
         """
         Update the value of a PID in Home Assistant.
         """
-        safe_pid_id = make_safe_id(pid_id)  # Make the PID ID safe for MQTT
+        safe_pid_id = self.safe_id(pid_id)  # Make the PID ID safe for MQTT
         state_topic = f"{self.topic_prefix}/{safe_pid_id}/state"
         self.publish(state_topic, value)
         if self.log_enabled:
             print(f"Updated PID with MQTT ID {pid_id} to value {value}")
+
+    def ignore_pid(self, pid_id):
+        """
+        Leave a PID out when publishing with update_values.
+        """
+        self.ignored_pids.add(pid_id)
+
+    def has_changed(self, pid_id, value, now):
+        """
+        Check if a value needs to be published: it moved out of the deadband
+        around the last published value, or the heartbeat is due. Values
+        without discovery config only get published with the heartbeat.
+        """
+        last = self._last_published.get(pid_id)
+        if last is None:
+            return True
+        last_value, last_time = last
+        if now - last_time >= self.heartbeat:
+            return True
+        if value == last_value or pid_id not in self.initialized_pids:
+            return False
+        deadband = self._deadbands.get(pid_id)
+        if deadband is None or value is None or last_value is None:
+            return True
+        try:
+            return abs(value - last_value) > max(deadband[0], deadband[1] * abs(last_value))
+        except TypeError:
+            return True
+
+    def update_values(self, values):
+        """
+        Update all PIDs in the "values" mapping. Depending on the state mode
+        this sends one message per PID, per group or for all values.
+        With a heartbeat set only changed values, or the documents
+        containing them, are sent. Values that are None, like the location
+        without a GPS fix, are left out: Home Assistant rejects a null state
+        for sensors with a unit or device class.
+        """
+        ignored = self.ignored_pids
+        values = {k: v for k, v in values.items() if v is not None and k not in ignored}
+
+        if self.heartbeat is not None:
+            now = monotonic()
+            changed = {pid_id for pid_id, value in values.items()
+                       if self.has_changed(pid_id, value, now)}
+            if not changed:
+                return
+        else:
+            changed = values
+
+        if self.state_mode == "field":
+            for pid_id in changed:
+                self.update_pid_value(pid_id, values[pid_id])
+            sent = changed
+        elif self.state_mode == "cycle":
+            # Always send the full document, so all templates find their key
+            self.publish(self.group_topic(DEFAULT_GROUP),
+                         {self.safe_id(k): v for k, v in values.items()})
+            sent = values
+        else:
+            # Send every document holding at least one changed value
+            groups = self._pid_groups
+            documents = {groups.get(pid_id, DEFAULT_GROUP): {} for pid_id in changed}
+            sent = []
+            for pid_id, value in values.items():
+                document = documents.get(groups.get(pid_id, DEFAULT_GROUP))
+                if document is not None:
+                    document[self.safe_id(pid_id)] = value
+                    sent.append(pid_id)
+            for group, document in documents.items():
+                self.publish(self.group_topic(group), document)
+
+        if self.heartbeat is not None:
+            for pid_id in sent:
+                self._last_published[pid_id] = (values[pid_id], now)
+        if self.log_enabled:
+            print(f"Updated {len(sent)} of {len(values)} PIDs")
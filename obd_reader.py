@@ -1,6 +1,6 @@
 import time
 import serial
-import re
+from torque_formula import compile_formula
 
 
 
@@ -52,61 +52,17 @@ class ObdReader:
     
 
     def parse_formula(self, equation, data_bytes):
-        context = {}
-        context_lower = {}
-        offset = 0  # Standardmäßig kein Offset
-        if len(data_bytes) > 3:
-            # Prüfe, ob die ersten drei Bytes wie erwartet sind (optional)
-            offset = 2  # oder offset = 3, wenn du immer ab dem 4. Byte starten willst
-        for idx, byte in enumerate(data_bytes[offset:]):
-            # Generate Excel-style column names (A, B, ..., Z, AA, AB, ...)
-            def excel_col_name(n):
-                name = ""
-                while n >= 0:
-                    name = chr(n % 26 + ord('A')) + name
-                    n = n // 26 - 1
-                return name
-
-            var = excel_col_name(idx)
-            context[var] = byte
-            context_lower[var.lower()] = byte
-        print(f"Context for equation '{equation}': {context}")  # <--- Hier wird das Dictionary ausgegeben
-        context = {**context, **context_lower}
+        """
+        Werte eine Torque-Gleichung aus. Die Gleichung wird beim ersten Aufruf
+        in eine Funktion übersetzt und danach aus dem Cache verwendet.
+        """
+        formula = compile_formula(equation)
+        if formula is None:
+            return None
+        if self.debug:
+            print(f"Data bytes for equation '{equation}': {list(data_bytes)}")
         try:
-            equation = equation.replace('>', '>>').replace('<', '<<')
-            def preprocess_expr(expr):
-                # Int64(A,B,C,D) → (A << 24 | B << 16 | C << 8 | D) (big endian)
-                def int64_fn_repl(match):
-                    bytes_vars = [v.strip() for v in match.group(1).split(',')]
-                    n = len(bytes_vars)
-                    exprs = [f"({v} << {8 * (n - i - 1)})" for i, v in enumerate(bytes_vars)]
-                    return "(" + " | ".join(exprs) + ")"
-                expr = re.sub(r'Int64\s*\(\s*([^)]+)\s*\)', int64_fn_repl, expr)
-
-                # Signed <expr> → signed_int(<expr>)
-                def signed_repl(match):
-                    # Wir wrappen den Ausdruck in signed_int()
-                    inner = match.group(1)
-                    return f"signed_int({inner})"
-                expr = re.sub(r'Signed\s+([^\s:()]+(?:\([^)]+\))?)', signed_repl, expr)
-                
-                # <expr>:<n> → ((<expr> >> n) & 1)
-                # Funktioniert für Variablen, Funktionsaufrufe und Klammerausdrücke
-                expr = re.sub(r'([a-zA-Z_][\w() ,]*)\s*:\s*(\d+)', r'((\1 >> \2) & 1)', expr)
-                return expr
-
-            def signed_int(x, bits=64):
-                """Interpretiert x als signed Integer mit angegebener Bitbreite (default: 64)."""
-                mask = (1 << bits) - 1
-                x = x & mask
-                sign_bit = 1 << (bits - 1)
-                return x - (1 << bits) if (x & sign_bit) else x
-
-            def safe_eval(expr, context=None):
-                expr_transformed = preprocess_expr(expr)
-                return eval(expr_transformed, {"signed_int": signed_int}, context or {})
-            
-            return safe_eval(equation, context)
+            return formula(data_bytes)
         except Exception as e:
             if self.debug:
                 print(f"Error evaluating equation '{equation}' with bytes {data_bytes}: {e}")
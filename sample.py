@@ -0,0 +1,119 @@
+""" Fixed-schema records for the data of a polling cycle. The names of the
+    fields are known once the field tables are compiled, so a sample is a
+    list of values plus a shared name to index map instead of a dict. """
+from collections.abc import Mapping
+
+
+class _Missing:
+    """ Type of Missing """
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'Missing'
+
+
+# Value of a field that was not read (yet). Such fields are left out when
+# a sample is iterated, like a key that is not in a dict.
+Missing = _Missing()
+
+
+class SampleLayout:
+    """ The fields of a sample, shared by all samples of a car. A name used
+        more than once keeps its first position. """
+
+    def __init__(self, names, defaults=None):
+        defaults = defaults or {}
+        self.index = {}
+        for name in names:
+            self.index.setdefault(name, len(self.index))
+        self.names = tuple(self.index)
+        self._defaults = [defaults.get(name, Missing) for name in self.names]
+        self._slots = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def new(self):
+        """ Return a sample holding the defaults """
+        return Sample(self, self._defaults[:])
+
+    def slot(self, names):
+        """ Return where the values of "names" go for Sample.write: a slice
+            if they are next to each other, else a tuple of indexes """
+        slot = self._slots.get(names)
+        if slot is None:
+            indexes = tuple(self.index[name] for name in names)
+            start = indexes[0] if indexes else 0
+            if indexes == tuple(range(start, start + len(indexes))):
+                slot = slice(start, start + len(indexes))
+            else:
+                slot = indexes
+            self._slots[names] = slot
+        return slot
+
+
+class SampleView(Mapping):
+    """ Read-only sample as handed to the data callbacks """
+    __slots__ = ('layout', '_values')
+
+    def __init__(self, layout, values):
+        self.layout = layout
+        self._values = values
+
+    def __getitem__(self, name):
+        value = self._values[self.layout.index[name]]
+        if value is Missing:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        idx = self.layout.index.get(name)
+        return idx is not None and self._values[idx] is not Missing
+
+    def __iter__(self):
+        return (name for name, value in zip(self.layout.names, self._values)
+                if value is not Missing)
+
+    def __len__(self):
+        return sum(value is not Missing for value in self._values)
+
+    def get(self, name, default=None):
+        idx = self.layout.index.get(name)
+        if idx is None or self._values[idx] is Missing:
+            return default
+        return self._values[idx]
+
+    def items(self):
+        """ Return the (name, value) pairs of the fields that were read """
+        return [(name, value) for name, value in zip(self.layout.names, self._values)
+                if value is not Missing]
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, dict(self.items()))
+
+
+class Sample(SampleView):
+    """ Sample the car and its decoders write into. Only fields of the
+        layout can be set. """
+    __slots__ = ()
+
+    def __setitem__(self, name, value):
+        self._values[self.layout.index[name]] = value
+
+    def update(self, values):
+        """ Set the fields of a mapping """
+        index = self.layout.index
+        for name, value in values.items():
+            self._values[index[name]] = value
+
+    def write(self, slot, values):
+        """ Set a slot from SampleLayout.slot to a sequence of values """
+        if isinstance(slot, slice):
+            self._values[slot] = values
+        else:
+            for idx, value in zip(slot, values):
+                self._values[idx] = value
+
+    def view(self):
+        """ Return a read-only copy """
+        return SampleView(self.layout, self._values[:])
@@ -0,0 +1,250 @@
+""" Module for CAN interfaces supported by python-can, i.e. SocketCAN with a
+    CAN HAT on a Raspberry Pi. ISO-TP is done here instead of in a dongle,
+    so requests to different ECUs can be in flight at the same time. """
+from collections import deque
+from threading import Lock
+from time import monotonic
+import asyncio
+import can
+from elm327 import CanError, NoData, PollInterval, wait_fileno
+import metrics
+
+# Fill byte of frames shorter than 8 bytes
+Padding = 0xaa
+
+# Flow control after a first frame: send all, no separation time
+FlowControl = bytes((0x30, 0x00, 0x00)).ljust(8, bytes((Padding,)))
+
+# Negative response code: the ECU needs more time
+ResponsePending = 0x78
+
+
+class _Transfer:
+    """ State of one request waiting for its response """
+    __slots__ = ('index', 'cmd', 'cantx', 'canrx', 'started', 'deadline',
+                 'data', 'size', 'seq')
+
+    def __init__(self, index, cmd, cantx, canrx, timeout):
+        self.index = index
+        self.cmd = cmd
+        self.cantx = cantx
+        self.canrx = canrx
+        self.started = monotonic()
+        self.deadline = self.started + timeout
+        self.data = None
+        self.size = 0
+        self.seq = 0
+
+
+class SocketCan:
+    """ Dongle talking to the car through python-can. Offers the interface
+        of Elm327 used by the cars, plus send_commands_ex for sending
+        several requests at once. """
+
+    def __init__(self, config, bus=None):
+        """ "bus" replaces the python-can bus, i.e. with one on the
+            virtual interface for tests. """
+        interface = config.get('can_interface', 'socketcan')
+        channel = config.get('can_channel', 'can0')
+        print(f"[DEBUG] Initializing CAN interface {interface} on channel {channel}...")
+        if bus is None:
+            bus = can.Bus(interface=interface, channel=channel,
+                          bitrate=config.get('can_bitrate', 500000))
+        self._bus = bus
+        try:
+            self._fileno = bus.fileno()
+        except (AttributeError, NotImplementedError, OSError):
+            self._fileno = None     # i.e. the virtual interface
+        self._lock = Lock()
+        # Coroutines awaiting replies must not block the loop on _lock
+        self._async_lock = asyncio.Lock()
+        self._timeout = config.get('timeout', 2.0)
+        self._is_extended = False
+        self._filters = None
+        self._metrics = metrics.Registry
+        self.last_rtt = None
+        print("[DEBUG] CAN interface initialized successfully.")
+
+    def set_protocol(self, prot):
+        """ Set the variant of CAN protocol. The bitrate is a setting of
+            the interface. """
+        print(f"[DEBUG] Setting protocol: {prot}")
+        if prot == 'CAN_11_500':
+            self._is_extended = False
+        elif prot == 'CAN_29_500':
+            self._is_extended = True
+        else:
+            print(f"[ERROR] Unsupported protocol: {prot}")
+            raise ValueError(f"Unsupported protocol {prot}")
+
+    def send_command_ex(self, cmd, cantx, canrx, canmask=None, frames=None):
+        """ Send "cmd" to "cantx" and return the ISO-TP payload of the
+            response from "canrx". "canmask" and "frames" are accepted for
+            compatibility with Elm327; the filters are set from the
+            response ids and the end of a response is known anyway. """
+        ret = self.send_commands_ex(((cmd, cantx, canrx),))[0]
+        if isinstance(ret, Exception):
+            raise ret
+        return ret
+
+    async def send_command_ex_async(self, cmd, cantx, canrx, canmask=None, frames=None):
+        """ send_command_ex for the asyncio runtime """
+        ret = (await self.send_commands_ex_async(((cmd, cantx, canrx),)))[0]
+        if isinstance(ret, Exception):
+            raise ret
+        return ret
+
+    def send_commands_ex(self, requests):
+        """ Send the (cmd, cantx, canrx) requests and return their
+            responses in the same order, the exception instead for those
+            that failed. Requests to different ECUs run concurrently,
+            requests to the same ECU one after the other. """
+        with self._lock:
+            exchange = self._exchange(requests)
+            try:
+                timeout = next(exchange)
+                while True:
+                    timeout = exchange.send(self._bus.recv(timeout))
+            except StopIteration as stop:
+                return stop.value
+
+    async def send_commands_ex_async(self, requests):
+        """ send_commands_ex for the asyncio runtime: waits for frames on
+            the socket of the bus instead of blocking in recv. For a bus
+            used from a single event loop only. """
+        async with self._async_lock:
+            exchange = self._exchange(requests)
+            try:
+                timeout = next(exchange)
+                while True:
+                    msg = self._bus.recv(0)
+                    if msg is None:
+                        if self._fileno is None:
+                            await asyncio.sleep(min(timeout, PollInterval))
+                        else:
+                            await wait_fileno(self._fileno, timeout)
+                        msg = self._bus.recv(0)
+                    timeout = exchange.send(msg)
+            except StopIteration as stop:
+                return stop.value
+
+    def _exchange(self, requests):
+        """ The requests of send_commands_ex as a generator: yields the
+            time to wait for the next frame and expects the received
+            message, or None, to be sent back. Returns the responses. """
+        results = [None] * len(requests)
+        queues = {}
+        for index, (cmd, cantx, canrx) in enumerate(requests):
+            queues.setdefault(canrx, deque()).append(index)
+
+        self._set_filters(queues)
+        active = {}
+
+        def done(transfer, result):
+            results[transfer.index] = result
+            del active[transfer.canrx]
+            self._start_next(requests, queues[transfer.canrx], active)
+
+        for canrx in queues:
+            self._start_next(requests, queues[canrx], active)
+
+        while active:
+            timeout = min(transfer.deadline for transfer in active.values()) - monotonic()
+            msg = yield max(timeout, 0.0)
+            if msg is not None and not msg.is_error_frame:
+                transfer = active.get(msg.arbitration_id)
+                if transfer is not None:
+                    try:
+                        if self._receive(transfer, msg.data):
+                            done(transfer, self._finish(transfer))
+                    except (CanError, NoData) as err:
+                        done(transfer, self._fail(transfer, err))
+
+            now = monotonic()
+            for transfer in [t for t in active.values() if t.deadline <= now]:
+                if transfer.data is None:
+                    err = NoData('NO DATA')
+                else:
+                    err = CanError("Timeout after %d of %d bytes" % (transfer.size, len(transfer.data)))
+                done(transfer, self._fail(transfer, err))
+        return results
+
+    def _set_filters(self, canrxs):
+        """ Only receive the response ids, the kernel drops the rest """
+        filters = sorted(canrxs)
+        if filters != self._filters:
+            mask = 0x1fffffff if self._is_extended else 0x7ff
+            self._bus.set_filters([{'can_id': canrx, 'can_mask': mask,
+                                    'extended': self._is_extended}
+                                   for canrx in filters])
+            self._filters = filters
+
+    def _send(self, can_id, data):
+        self._bus.send(can.Message(arbitration_id=can_id, data=data,
+                                   is_extended_id=self._is_extended))
+
+    def _start_next(self, requests, queue, active):
+        """ Send the next request of an ECU, if there is one """
+        if not queue:
+            return
+        index = queue.popleft()
+        cmd, cantx, canrx = requests[index]
+        if len(cmd) > 7:
+            raise ValueError("Requests longer than a single frame are not supported")
+        print(f"[DEBUG] Sending CAN request: {cmd.hex()}, CAN TX: {cantx:X}, CAN RX: {canrx:X}")
+        active[canrx] = _Transfer(index, cmd, cantx, canrx, self._timeout)
+        self._send(cantx, (bytes((len(cmd),)) + cmd).ljust(8, bytes((Padding,))))
+
+    def _receive(self, transfer, frame):
+        """ Add a frame to the response. Returns True once it is complete. """
+        frame_type = frame[0] >> 4
+        if frame_type == 0:         # Single frame
+            size = frame[0] & 0xf
+            data = frame[1:1 + size]
+            if len(data) >= 3 and data[0] == 0x7f and data[2] == ResponsePending:
+                transfer.deadline = monotonic() + self._timeout
+                return False
+            if len(data) >= 1 and data[0] == 0x7f:
+                raise NoData('NEGATIVE RESPONSE %s' % bytes(data).hex())
+            transfer.data = bytearray(data)
+            transfer.size = len(data)
+        elif frame_type == 1:       # First frame
+            transfer.data = bytearray(((frame[0] & 0xf) << 8) | frame[1])
+            transfer.size = min(len(frame) - 2, len(transfer.data))
+            transfer.data[:transfer.size] = frame[2:2 + transfer.size]
+            transfer.seq = 1
+            self._send(transfer.cantx, FlowControl)
+        elif frame_type == 2:       # Consecutive frame
+            if transfer.data is None:
+                return False
+            if frame[0] & 0xf != transfer.seq:
+                raise CanError("Bad frame order: idx(%X) expected(%X)" % (frame[0] & 0xf, transfer.seq))
+            transfer.seq = (transfer.seq + 1) & 0xf
+            size = min(len(frame) - 1, len(transfer.data) - transfer.size)
+            transfer.data[transfer.size:transfer.size + size] = frame[1:1 + size]
+            transfer.size += size
+        else:
+            return False
+        return transfer.size >= len(transfer.data)
+
+    def _finish(self, transfer):
+        """ Record a complete response """
+        self.last_rtt = monotonic() - transfer.started
+        self._metrics.observe('can_rtt_seconds', self.last_rtt, transfer.cmd.hex())
+        print(f"[DEBUG] CAN response: {transfer.data.hex()}")
+        return transfer.data
+
+    def _fail(self, transfer, err):
+        """ Record a failed request """
+        cmd = transfer.cmd.hex()
+        if isinstance(err, NoData):
+            print(f"[WARNING] No data for {cmd} from {transfer.canrx:X}.")
+            self._metrics.count('can_no_data_total', cmd)
+        else:
+            print(f"[ERROR] CAN error for {cmd}: {err}")
+            self._metrics.count('can_error_total', cmd)
+        return err
+
+    def close(self):
+        """ Release the CAN interface """
+        self._bus.shutdown()
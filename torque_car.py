@@ -0,0 +1,34 @@
+""" Car defined by a Torque Pro PID list instead of a built-in field table """
+from car import Car
+from isotp_decoder import IsoTpDecoder
+from torque_pids import load_fields
+
+
+class TorqueCar(Car):
+    """ Polls the requests planned from the PID list in obd.pid_file """
+
+    def __init__(self, config, dongle, gps):
+        super().__init__(config, dongle, gps)
+        obd = config['obd']
+        self._dongle.set_protocol(obd.get('protocol', 'CAN_11_500'))
+        self._fields = load_fields(obd['pid_file'], obd.get('pid_cache'),
+                                   obd.get('pid_period'))
+        self._isotp = IsoTpDecoder(self._dongle, self._fields)
+        self._isotp.attach(self.sample)
+
+    def next_deadline(self):
+        """ Return the deadline of the next due command """
+        return self._isotp.next_deadline()
+
+    def get_fields(self):
+        """ Return the expanded fields of the PID list """
+        return self._isotp.fields
+
+    def read_dongle(self, data):
+        """ Fetch data from CAN-bus and decode it.
+            The decoder writes straight into the sample "data" """
+        self._isotp.get_data()
+
+    async def read_dongle_async(self, data):
+        """ read_dongle awaiting the dongle """
+        await self._isotp.get_data_async()
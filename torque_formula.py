@@ -0,0 +1,207 @@
+""" Compiler for the equations of Torque Pro PID lists.
+
+    Equations name the response bytes like spreadsheet columns (A, B, ...,
+    Z, AA, ...). They are rewritten to Python once, checked against a
+    whitelist of AST nodes and compiled into a function that reads the
+    bytes by index. Compiled formulas are cached per equation string. """
+import ast
+import re
+import sys
+
+# Node types an equation may contain once rewritten to Python
+AllowedNodes = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp,
+    ast.Name, ast.Load, ast.Call,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
+    ast.LShift, ast.RShift, ast.BitOr, ast.BitAnd, ast.BitXor,
+    ast.USub, ast.UAdd, ast.Invert, ast.Not, ast.And, ast.Or,
+    ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+) + tuple(getattr(ast, name) for name in ('Constant', 'Num') if hasattr(ast, name))
+
+# Functions an equation may call
+Functions = ('signed_int',)
+
+# Largest literal exponent of ** and shift of <<. Anything larger, like
+# 9**9**9, would hang or exhaust the memory when evaluated.
+MaxExponent = 16
+MaxShift = 64
+
+# Compiled formulas by equation, None for equations that failed to compile
+_formula_cache = {}
+# Compiled functions by (equation, offset), see compile_function
+_function_cache = {}
+
+
+def signed_int(x, bits=64):
+    """Interpretiert x als signed Integer mit angegebener Bitbreite (default: 64)."""
+    mask = (1 << bits) - 1
+    x = x & mask
+    sign_bit = 1 << (bits - 1)
+    return x - (1 << bits) if (x & sign_bit) else x
+
+
+def column_index(name):
+    """ Index of a spreadsheet style column name: A -> 0, Z -> 25, AA -> 26 """
+    idx = 0
+    for char in name.upper():
+        if not 'A' <= char <= 'Z':
+            raise ValueError(f"Invalid variable {name}")
+        idx = idx * 26 + ord(char) - ord('A') + 1
+    return idx - 1
+
+
+def preprocess(equation):
+    """ Rewrite the Torque syntax to a Python expression """
+    expr = equation.replace('>', '>>').replace('<', '<<')
+
+    # Int64(A,B,C,D) → (A << 24 | B << 16 | C << 8 | D) (big endian)
+    def int64_fn_repl(match):
+        bytes_vars = [v.strip() for v in match.group(1).split(',')]
+        n = len(bytes_vars)
+        exprs = [f"({v} << {8 * (n - i - 1)})" for i, v in enumerate(bytes_vars)]
+        return "(" + " | ".join(exprs) + ")"
+    expr = re.sub(r'Int64\s*\(\s*([^)]+)\s*\)', int64_fn_repl, expr)
+
+    # Signed <expr> → signed_int(<expr>)
+    expr = re.sub(r'Signed\s+([^\s:()]+(?:\([^)]+\))?)', r'signed_int(\1)', expr)
+
+    # <expr>:<n> → ((<expr> >> n) & 1)
+    # Funktioniert für Variablen, Funktionsaufrufe und Klammerausdrücke
+    expr = re.sub(r'([a-zA-Z_][\w() ,]*)\s*:\s*(\d+)', r'((\1 >> \2) & 1)', expr)
+    return expr
+
+
+class _BindBytes(ast.NodeTransformer):
+    """ Replace the column variables by b[index + offset] """
+
+    def __init__(self, offset):
+        self.offset = offset
+
+    def visit_Name(self, node):
+        if node.id in Functions:
+            return node
+        index = ast.Constant(column_index(node.id) + self.offset)
+        if sys.version_info < (3, 9):
+            index = ast.Index(index)
+        return ast.copy_location(
+            ast.Subscript(ast.Name('b', ast.Load()), index, ast.Load()), node)
+
+
+def _literal(node):
+    """ Value of a numeric literal, possibly negated, else None """
+    sign = 1
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        sign = -1 if isinstance(node.op, ast.USub) else 1
+        node = node.operand
+    value = getattr(node, 'value', getattr(node, 'n', None))
+    if type(node).__name__ in ('Constant', 'Num') and isinstance(value, (int, float)):
+        return sign * value
+    return None
+
+
+def check(tree):
+    """ Raise ValueError if the expression has anything but arithmetic on
+        numbers, variables and the whitelisted functions. Powers need a
+        small literal exponent and can not be nested, shifts by a literal
+        have to be small. """
+    for node in ast.walk(tree):
+        if not isinstance(node, AllowedNodes):
+            raise ValueError(f"{type(node).__name__} not allowed")
+        if isinstance(node, ast.Call) and not (
+                isinstance(node.func, ast.Name) and node.func.id in Functions
+                and not node.keywords):
+            raise ValueError("Call not allowed")
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+            exponent = _literal(node.right)
+            if exponent is None or abs(exponent) > MaxExponent:
+                raise ValueError(f"Exponent must be a number up to {MaxExponent}")
+            if any(isinstance(sub, ast.Pow) for sub in ast.walk(node.left)):
+                raise ValueError("Nested powers not allowed")
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.LShift):
+            shift = _literal(node.right)
+            if shift is not None and shift > MaxShift:
+                raise ValueError(f"Shift must be up to {MaxShift}")
+        value = getattr(node, 'value', getattr(node, 'n', 0))
+        if type(node).__name__ in ('Constant', 'Num') and \
+                not isinstance(value, (int, float)):
+            raise ValueError(f"Constant {value!r} not allowed")
+
+
+def parse(equation):
+    """ Parse and check an equation, return the AST """
+    tree = ast.parse(preprocess(equation).strip(), mode='eval')
+    check(tree)
+    return tree
+
+
+def byte_count(equation):
+    """ Number of bytes an equation needs, from its highest variable """
+    names = [node.id for node in ast.walk(parse(equation))
+             if isinstance(node, ast.Name) and node.id not in Functions]
+    return max((column_index(name) + 1 for name in names), default=0)
+
+
+def build(equation, offset):
+    """ Compile an equation into func(b) reading its variables from b
+        starting at "offset" """
+    body = _BindBytes(offset).visit(parse(equation)).body
+    args = ast.arguments(posonlyargs=[], args=[ast.arg('b')], vararg=None,
+                         kwonlyargs=[], kw_defaults=[], kwarg=None, defaults=[])
+    if sys.version_info < (3, 8):
+        del args.posonlyargs
+    func = ast.Expression(ast.Lambda(args, body))
+    ast.fix_missing_locations(func)
+    code = compile(func, f"<equation {equation}>", 'eval')
+    return eval(code, {'__builtins__': {}, 'signed_int': signed_int})
+
+
+class Formula:
+    """ A compiled equation. Calling it with the data bytes of a response
+        returns the value. Like the interpreter it replaces, the variables
+        start at the third byte if there are more than three bytes. """
+    __slots__ = ('equation', '_short', '_long')
+
+    def __init__(self, equation):
+        self.equation = equation
+        self._short = build(equation, 0)
+        self._long = build(equation, 2)
+
+    def __call__(self, data_bytes):
+        if len(data_bytes) > 3:
+            return self._long(data_bytes)
+        return self._short(data_bytes)
+
+
+def compile_formula(equation):
+    """ Return the cached Formula of an equation, or None if it does not
+        compile or uses anything outside the whitelist """
+    try:
+        return _formula_cache[equation]
+    except KeyError:
+        pass
+    try:
+        formula = Formula(equation)
+    except (SyntaxError, ValueError, TypeError) as err:
+        print(f"[ERROR] Invalid equation '{equation}': {err}")
+        formula = None
+    _formula_cache[equation] = formula
+    return formula
+
+
+def compile_function(equation, offset):
+    """ Return the cached func(b) of an equation whose first variable is
+        b[offset], or None if it does not compile. For responses decoded
+        by IsoTpDecoder "offset" is the length of the command, so A is
+        the first byte after the echoed service and PID. """
+    key = (equation, offset)
+    try:
+        return _function_cache[key]
+    except KeyError:
+        pass
+    try:
+        func = build(equation, offset)
+    except (SyntaxError, ValueError, TypeError) as err:
+        print(f"[ERROR] Invalid equation '{equation}': {err}")
+        func = None
+    _function_cache[key] = func
+    return func
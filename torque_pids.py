@@ -0,0 +1,158 @@
+""" Importer for Torque Pro PID lists (CSV).
+
+    Equations that share mode/PID and header become fields of a single
+    command, so every ECU request is sent once per cycle no matter how
+    many values it carries. The result is a field table for IsoTpDecoder.
+    The parsed plan is cached next to the PID list, keyed by the hash of
+    the list, so large lists load without parsing. """
+from hashlib import sha256
+import csv
+import io
+import json
+import os
+
+# Columns of a Torque PID list
+Columns = ('name', 'short_name', 'mode_pid', 'equation', 'min', 'max', 'units', 'header')
+
+# Functional request and first response id, used without a header
+DefaultHeader = 0x7df
+DefaultResponse = 0x7e8
+
+CacheVersion = 1
+
+
+def response_id(header):
+    """ CAN id of the responses to requests sent with "header" """
+    if header == DefaultHeader:
+        return DefaultResponse
+    if header > 0x7ff:
+        # 29 bit: 18DA<target><source> is answered by 18DA<source><target>
+        return (header & 0xffff0000) | (header & 0xff) << 8 | (header >> 8) & 0xff
+    return header + 8
+
+
+def _number(text):
+    """ Parse a min/max column, None if empty or not a number """
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def parse_rows(text):
+    """ Parse the lines of a PID list into dicts with the keys of Columns.
+        Comments, the title line and lines without equation are skipped. """
+    rows = []
+    for row in csv.reader(io.StringIO(text)):
+        if not row or row[0].lstrip().startswith('#') or len(row) < 4:
+            continue
+        row = [col.strip() for col in row] + [''] * (len(Columns) - len(row))
+        entry = dict(zip(Columns, row))
+        if entry['mode_pid'].lower() in ('modeandpid', 'mode and pid') or not entry['equation']:
+            continue
+        try:
+            mode_pid = entry['mode_pid'].lower()
+            if mode_pid.startswith('0x'):
+                mode_pid = mode_pid[2:]
+            entry['cmd'] = bytes.fromhex(mode_pid.rjust(len(mode_pid) + len(mode_pid) % 2, '0'))
+            entry['header'] = int(entry['header'], 16) if entry['header'] else DefaultHeader
+        except ValueError:
+            print(f"[WARNING] Skipping PID {entry['name']}: bad mode/PID or header")
+            continue
+        rows.append(entry)
+    return rows
+
+
+def plan_commands(rows):
+    """ Group the rows by header and mode/PID into the commands of a field
+        table, in the order of their first appearance. Names have to be
+        unique, later duplicates are dropped. """
+    commands = {}
+    names = set()
+    for row in rows:
+        name = row['name'] or row['short_name']
+        if name in names:
+            print(f"[WARNING] Skipping duplicate PID {name}")
+            continue
+        names.add(name)
+        key = (row['header'], row['cmd'])
+        command = commands.get(key)
+        if command is None:
+            command = commands[key] = {
+                'cmd': row['cmd'],
+                'cantx': row['header'],
+                'canrx': response_id(row['header']),
+                # Lists cover many ECUs and variants, not every one answers
+                'optional': True,
+                'fields': [],
+            }
+        field = {'name': name, 'equation': row['equation']}
+        if row['units']:
+            field['units'] = row['units']
+        for limit in ('min', 'max'):
+            value = _number(row[limit])
+            if value is not None:
+                field[limit] = value
+        command['fields'].append(field)
+    return [dict(command, fields=tuple(command['fields'])) for command in commands.values()]
+
+
+def read_pid_files(path):
+    """ Return the text of a PID list, or of all lists in a directory """
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, name) for name in os.listdir(path)
+                       if name.lower().endswith(('.csv', '.txt')))
+    else:
+        files = [path]
+    texts = []
+    for file_name in files:
+        with open(file_name, 'rb') as file:
+            texts.append(file.read().decode('utf-8', errors='replace'))
+    return '\n'.join(texts)
+
+
+def _to_json(commands):
+    return [dict(command, cmd=command['cmd'].hex(), fields=list(command['fields']))
+            for command in commands]
+
+
+def _from_json(commands):
+    return [dict(command, cmd=bytes.fromhex(command['cmd']), fields=tuple(command['fields']))
+            for command in commands]
+
+
+def load_fields(path, cache_file=None, period=None):
+    """ Return the field table planned from the PID list(s) at "path".
+        The plan is read from "cache_file" (default: path + '.plan.json')
+        if it was made from the same content. "period" sets the polling
+        period of every command. """
+    text = read_pid_files(path)
+    digest = sha256(text.encode()).hexdigest()
+    if cache_file is None:
+        cache_file = path.rstrip(os.sep) + '.plan.json'
+
+    commands = None
+    try:
+        with open(cache_file) as file:
+            cached = json.load(file)
+        if cached.get('version') == CacheVersion and cached.get('hash') == digest:
+            commands = _from_json(cached['commands'])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    if commands is None:
+        commands = plan_commands(parse_rows(text))
+        try:
+            with open(cache_file + '.tmp', 'w') as file:
+                json.dump({'version': CacheVersion, 'hash': digest,
+                           'commands': _to_json(commands)}, file)
+            os.replace(cache_file + '.tmp', cache_file)
+        except OSError as err:
+            print(f"[WARNING] Could not write PID plan cache {cache_file}: {err}")
+
+    print(f"[INFO] {sum(len(c['fields']) for c in commands)} PIDs in "
+          f"{len(commands)} requests from {path}")
+    if period is not None:
+        commands = [dict(command, period=period) for command in commands]
+    return tuple(commands)
+